@@ -4,6 +4,8 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging 
+from .control_modules.config_overlay import ConfigOverlay
+from .control_modules.profiles import read_profiles, DEFAULT_PROFILE
 
 class ApeControl:
     def __init__(self, config):
@@ -11,24 +13,162 @@ class ApeControl:
         self.name = config.get_name().split()[-1] # (heater) name
         self.algo = config.get('control', 'pid_control')
         self.old_control = None
+        self.config = config
+        self.overrides = {} # options changed at runtime by APE_SET
+        self.profile = DEFAULT_PROFILE
+        self.profile_options = read_profiles(config, self.name)
 
-        
-        # Logic to dynamically load from the ape_modules folder
-        if self.algo == 'pp_control':
+        profile_algos = [opts.get('control', self.algo) for opts in self.profile_options.values()]
+        if 'pp_control' in [self.algo] + profile_algos:
             from .control_modules.pp_calibrate import PPCalibrate
             self.printer.add_object('pp_calibrate', PPCalibrate(config)) # must import this before the controller
+        self.new_controller = self._load_controller(self.algo, config)
+        if self.new_controller is None:
+            logging.error("Unknown architecture type specified: %s. Defaulting to original Klipper Control algorithm.", self.algo)
+        # Every profile is built up front, switching is a swap of prepared controllers
+        self.profiles = {DEFAULT_PROFILE: (self.algo, self.new_controller)}
+        for name, options in sorted(self.profile_options.items()):
+            self.profiles[name] = self._load_profile(config, name, options)
+
+        # Per update observers, handed on to every controller of this heater
+        self.monitors = []
+        self.kpis = None
+        if config.getboolean('kpi_tracking', True):
+            from .control_modules.kpi_tracker import ControlKPIs
+            self.kpis = ControlKPIs(config)
+            self.monitors.append(self.kpis)
+        self.health = None
+        if config.getboolean('health_monitor', False):
+            from .control_modules.health_monitor import HealthMonitor
+            self.health = HealthMonitor(config, self)
+            self.monitors.append(self.health)
+        for algo, controller in self.profiles.values():
+            if controller is not None:
+                controller.monitors = self.monitors
+
+        # Optional heat soak tracking (beds), independent of the control algorithm
+        self.soak_tracker = None
+        if config.getboolean('soak_tracking', False):
+            from .control_modules.soak_tracker import SoakTracker
+            self.soak_tracker = SoakTracker(config)
+        
+        self.printer.register_event_handler("klippy:ready", self.exchange_controller)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command("APE_SET", "HEATER", self.name, self.cmd_APE_SET,
+                                   desc=self.cmd_APE_SET_help)
+        gcode.register_mux_command("APE_PROFILE", "HEATER", self.name, self.cmd_APE_PROFILE,
+                                   desc=self.cmd_APE_PROFILE_help)
+
+    def _load_controller(self, algo, config):
+        # Logic to dynamically load from the ape_modules folder
+        if algo == 'pp_control':
             from .control_modules.pp_control import PPControl 
-            self.new_controller = PPControl(config)
-        elif self.algo == 'pid_control':
+            return PPControl(config)
+        elif algo == 'pid_control':
             from .control_modules.pid_control import PIDControl 
-            self.new_controller = PIDControl(config)
-        elif self.algo == 'mpc':
+            return PIDControl(config)
+        elif algo == 'mpc':
             from .control_modules.mpc_control import ControlMPC 
-            self.new_controller = ControlMPC(config)
+            return ControlMPC(config)
+        elif algo == 'pipeline':
+            from .control_modules.pipeline_control import PipelineControl
+            return PipelineControl(config)
+        return None
+
+    def _load_profile(self, config, name, options):
+        options = dict(options)
+        algo = options.pop('control', self.algo).lower()
+        overlay = ConfigOverlay(config, options)
+        controller = self._load_controller(algo, overlay)
+        if controller is None:
+            raise config.error("Profile '%s' of %s: unknown control '%s'" % (name, self.name, algo))
+        unused = overlay.unused()
+        if unused:
+            raise config.error("Profile '%s' of %s: options not used by %s: %s"
+                               % (name, self.name, algo, ", ".join(unused)))
+        return algo, controller
+
+    cmd_APE_SET_help = "Switch control algorithm and/or change its parameters without a restart"
+
+    def cmd_APE_SET(self, gcmd):
+        """APE_SET HEATER=<name> [CONTROL=<algo>] [<option>=<value> ...]
+
+        Builds the new controller from the config section with the given
+        options replaced, hands over the running state and swaps it in.
+        Overrides accumulate over calls and are lost on a restart.
+        """
+        algo = gcmd.get('CONTROL', self.algo).lower()
+        overrides = dict(self.overrides)
+        for key, value in gcmd.get_command_parameters().items():
+            if key.upper() not in ('HEATER', 'CONTROL'):
+                overrides[key.lower()] = value
+        # On top of the active profile's options
+        options = dict(self.profile_options.get(self.profile, {}))
+        options.pop('control', None)
+        options.update(overrides)
+        overlay = ConfigOverlay(self.config, options)
+        try:
+            controller = self._load_controller(algo, overlay)
+        except self.printer.config_error as e:
+            raise gcmd.error(str(e))
+        if controller is None:
+            raise gcmd.error("APE_SET: unknown control '%s'" % (algo,))
+        unused = [opt for opt in overlay.unused() if opt in overrides]
+        if unused:
+            raise gcmd.error("APE_SET: options not used by %s: %s" % (algo, ", ".join(unused)))
+        if hasattr(controller, 'post_init'):
+            controller.post_init()
         else:
-            logging.error("Unknown architecture type specified: %s. Defaulting to original Klipper Control algorithm.", self.algo)
-        
-        self.printer.register_event_handler("klippy:ready", self.exchange_controller)
+            controller.handle_ready()
+        controller.monitors = self.monitors
+        self._swap_in(algo, controller)
+        self.overrides = overrides
+        logging.info("ApeControl: %s live swapped to %s, overrides %s", self.name, algo, overrides)
+        gcmd.respond_info("%s: control %s%s" % (
+            self.name, algo,
+            "".join("\n  %s: %s" % item for item in sorted(overrides.items()))))
+
+    def _swap_in(self, algo, controller):
+        """Hand the running state over to a ready controller and make it active"""
+        heater = self.printer.lookup_object('heaters').lookup_heater(self.name)
+        # One lock section and no set_control, which zeroes the target: a sensor
+        # callback in between would see the heater off and undo the handover
+        with heater.lock:
+            state = self.new_controller.export_state() if self.new_controller is not None else {}
+            state["target"] = heater.target_temp
+            controller.import_state(state)
+            if controller.power_slot is not None:
+                controller.power_slot.controller = controller
+            heater.control = controller
+        self.new_controller = controller
+        self.algo = algo
+
+    cmd_APE_PROFILE_help = "Switch to a named filament/nozzle profile"
+
+    def cmd_APE_PROFILE(self, gcmd):
+        """APE_PROFILE HEATER=<name> [NAME=<profile>]
+
+        Swaps in the controller prepared for the profile at startup, without
+        NAME the profiles are listed. Clears APE_SET overrides.
+        """
+        name = gcmd.get('NAME', None)
+        if name is None:
+            gcmd.respond_info("%s profiles: %s (active: %s)" % (
+                self.name, ", ".join(sorted(self.profiles)), self.profile))
+            return
+        name = name.lower()
+        if name not in self.profiles:
+            raise gcmd.error("APE_PROFILE: %s has no profile '%s', available: %s"
+                             % (self.name, name, ", ".join(sorted(self.profiles))))
+        algo, controller = self.profiles[name]
+        if controller is None:
+            raise gcmd.error("APE_PROFILE: profile '%s' has no ApeControl controller" % (name,))
+        if controller is not self.new_controller:
+            self._swap_in(algo, controller)
+        self.profile = name
+        self.overrides = {}
+        logging.info("ApeControl: %s switched to profile '%s' (%s)", self.name, name, algo)
+        gcmd.respond_info("%s: profile %s, control %s" % (self.name, name, algo))
 
     def exchange_controller(self):
         # load objects
@@ -40,11 +180,64 @@ class ApeControl:
                 self.new_controller.post_init() # if there is a post_init script run it now
             except:
                 pass
+            for algo, controller in self.profiles.values():
+                if controller is not self.new_controller and hasattr(controller, 'post_init'):
+                    controller.post_init()
+            # Prepared profiles registered with the power budget too, the active one owns the slot
+            if getattr(self.new_controller, 'power_slot', None) is not None:
+                self.new_controller.power_slot.controller = self.new_controller
             logging.info("ApeControl: Heater object '%s' controller exchanged with %s algorithm", self.name, self.algo)
         except self.printer.config_error as e:
             logging.error("ApeControl: %s Heater object could not be found for name %s", str(e), self.name)        
             raise e
 
+    def get_status(self, eventtime):
+        status = {"control": self.algo, "profile": self.profile}
+        status.update(self.new_controller.get_status(eventtime))
+        if self.new_controller.power_slot is not None:
+            status.update(self.new_controller.power_slot.get_status())
+        if self.new_controller.shaper is not None:
+            status.update(self.new_controller.shaper.get_status())
+        if self.soak_tracker is not None:
+            status.update(self.soak_tracker.get_status(eventtime))
+        if self.kpis is not None:
+            status["kpi"] = self.kpis.get_status(eventtime)
+        if self.health is not None:
+            status["health"] = self.health.get_status(eventtime)
+        return status
+
+
+class ApeControlShared:
+    """Printer wide [ape_control] section hosting services shared by every heater"""
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.services = {}
+        if config.getboolean('lookahead', False):
+            from .control_modules.lookahead import GcodeLookahead
+            self._add_service('ape_lookahead', GcodeLookahead(config))
+        if config.getboolean('ambient_estimator', False):
+            from .control_modules.ambient_estimator import AmbientEstimator
+            self._add_service('ape_ambient', AmbientEstimator(config))
+        if config.getfloat('power_budget', None, above=0.) is not None:
+            from .control_modules.power_budget import PowerBudget
+            self._add_service('ape_power_budget', PowerBudget(config))
+        if config.getboolean('reheat_scheduler', False):
+            from .control_modules.reheat_scheduler import ReheatScheduler
+            self._add_service('ape_reheat_scheduler', ReheatScheduler(
+                config, self.services.get('ape_lookahead')))
+
+    def _add_service(self, name, service):
+        # Controllers find services with printer.lookup_object(name, None)
+        self.printer.add_object(name, service)
+        self.services[name] = service
+
+    def get_status(self, eventtime):
+        return {name: service.get_status(eventtime)
+                for name, service in self.services.items()}
+
+def load_config(config):
+    return ApeControlShared(config)
+
 def load_config_prefix(config):
     return ApeControl(config)
 
@@ -0,0 +1,77 @@
+# ApeControl-Klipper shared chamber/ambient temperature estimator
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# One ambient temperature for the whole printer. Heaters contribute estimates
+# from their own steady-state power balance (power = f(temp - ambient)), an
+# optional chamber sensor contributes directly. The estimate is fused and low
+# pass filtered once per interval, controllers only read 'temp'.
+
+AMBIENT_TEMP = 25.
+UPDATE_INTERVAL = 1.0
+STALE_TIME = 60. # [s] contributions older than this are ignored
+
+
+class AmbientEstimator:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.temp = config.getfloat('ambient_temp', AMBIENT_TEMP)
+        self.time_constant = config.getfloat('ambient_time_constant', 120., above=0.)
+        self.sensor_name = config.get('chamber_sensor', None)
+        self.sensor_weight = config.getfloat('chamber_sensor_weight', 4., minval=0.)
+        self.sensor = None
+        # name -> [estimate, weight, eventtime], entries are created by register()
+        # on the reactor thread, contribute() from the sensor threads only updates them
+        self.contributions = {}
+        self.last_update = None
+        self.printer.register_event_handler("klippy:ready", self.handle_ready)
+
+    def handle_ready(self):
+        self.reactor = self.printer.get_reactor()
+        if self.sensor_name is not None:
+            self.sensor = self.printer.lookup_object(self.sensor_name, None)
+            if self.sensor is None:
+                raise self.printer.config_error(
+                    "ApeControl: unknown chamber_sensor '%s'" % (self.sensor_name,))
+        self.reactor.register_timer(self._update_event, self.reactor.NOW)
+
+    def register(self, name):
+        """Heaters register when ready, before they contribute"""
+        self.contributions.setdefault(name, [self.temp, 0., -STALE_TIME])
+
+    def contribute(self, name, estimate, weight=1.):
+        """Called by controllers with an ambient estimate from their power balance"""
+        entry = self.contributions.get(name)
+        if entry is None:
+            return # not registered
+        entry[0] = estimate
+        entry[1] = weight
+        entry[2] = self.reactor.monotonic()
+
+    def _update_event(self, eventtime):
+        total = weight_sum = 0.
+        for estimate, weight, stamp in self.contributions.values():
+            if eventtime - stamp < STALE_TIME:
+                total += estimate * weight
+                weight_sum += weight
+        if self.sensor is not None:
+            sensor_temp = self.sensor.get_temp(eventtime)[0]
+            if sensor_temp:
+                if self.last_update is None:
+                    self.temp = sensor_temp
+                total += sensor_temp * self.sensor_weight
+                weight_sum += self.sensor_weight
+        if weight_sum > 0. and self.last_update is not None:
+            alpha = min(1., (eventtime - self.last_update) / self.time_constant)
+            self.temp += alpha * (total / weight_sum - self.temp)
+        self.last_update = eventtime
+        return eventtime + UPDATE_INTERVAL
+
+    def get_status(self, eventtime):
+        return {
+            "temp": self.temp,
+            "contributions": {name: entry[0] for name, entry in self.contributions.items()
+                              if eventtime - entry[2] < STALE_TIME},
+        }
@@ -6,9 +6,21 @@
 import logging
 from abc import ABC, abstractmethod
 
+MAX_UPDATE_INTERVAL = 2.0 # [s] Klipper turns a heater off whose pwm is not refreshed within 3s
+
+def clamp(value, low, high):
+    """max(low, min(high, value)) without the builtins' per call argument tuple, nan gives low"""
+    if value > high:
+        return high
+    if value > low:
+        return value
+    return low
+
 class BaseController(ABC):
-    def __init__(self, config):
+    def __init__(self, config, embedded=False):
         self.config = config
+        # Embedded controllers (e.g. PP's feedback PID) never drive the heater themselves
+        self.embedded = embedded
         self.printer = config.get_printer()
         self.heater_name = config.get_name().split()[-1]
         self.target_temp = None
@@ -16,6 +28,30 @@ class BaseController(ABC):
         # self.heater = None
         # Universal config parameters
         self.heater_max_power = config.getfloat('max_power', 1.0)
+        # Heater wattage, needed to take part in a shared power budget
+        self.heater_watts = config.getfloat('heater_power', None, above=0.)
+        self.power_slot = None
+        self.last_pwm = 0.
+        # Slower control updates while steady, sensor callbacks in between only refresh the pwm
+        self.steady_update_interval = config.getfloat('steady_update_interval', 0., minval=0.,
+                                                      maxval=MAX_UPDATE_INTERVAL)
+        self.update_interval = 0.
+        self.last_update_time = None
+        self.last_update_target = None
+        # Per update observers (KPIs, health), attached by ApeControl
+        self.monitors = []
+        # Measured minus model predicted sensor temperature of the last update,
+        # for controllers that run a model of their own (MPC)
+        self.model_innovation = None
+        # Optional printer wide [ape_control] services, looked up when ready
+        self.lookahead = None
+        self.ambient = None
+        # Optional reference trajectory for target steps, the owner of an embedded controller shapes
+        self.shaper = None
+        self.setpoint_ramping = False # the setpoint is a shaped reference still moving to the target
+        if not embedded and config.getboolean('setpoint_shaping', False):
+            from .setpoint_shaper import SetpointShaper
+            self.shaper = SetpointShaper(config, self, self.heater_max_power)
         
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
 
@@ -26,10 +62,65 @@ class BaseController(ABC):
         self.part_fan = self.printer.lookup_object('fan')
         self.gcode_move = self.printer.lookup_object('gcode_move')
         self.reactor = self.printer.get_reactor()
+        # Optional printer wide [ape_control] services
+        self.lookahead = self.printer.lookup_object('ape_lookahead', None)
+        self.ambient = self.printer.lookup_object('ape_ambient', None)
+        if self.ambient is not None:
+            self.ambient.register(self.heater_name)
+        power_budget = self.printer.lookup_object('ape_power_budget', None)
+        if power_budget is not None and not self.embedded:
+            if self.heater_watts is None:
+                logging.warning("ApeControl: %s has no 'heater_power', not part of the power budget",
+                                self.heater_name)
+            else:
+                self.power_slot = power_budget.register(self.heater_name, self.heater_watts, self)
 
-    @abstractmethod
     def temperature_update(self, read_time, temp, target_temp):
-        """Called by heater to update control logic and set PWM"""
+        """Called by heater, runs the control law and then the attached monitors
+
+        With setpoint shaping the control law tracks the shaped reference,
+        the monitors always see the actual target.
+        """
+        if self.power_slot is not None:
+            # The budget ranks heaters on these, it must not query heaters under their lock
+            self.power_slot.note(temp, target_temp)
+        setpoint = target_temp
+        if self.shaper is not None:
+            setpoint = self.shaper.update(read_time, temp, target_temp)
+            self.setpoint_ramping = setpoint != target_temp
+        if self.steady_update_interval:
+            if (setpoint == self.last_update_target
+                    and 0. <= read_time - self.last_update_time < self.update_interval):
+                # Decimated, hold the output. Other heaters may have moved the
+                # power budget since, renew the last request. The budget ranks
+                # on the readings noted above and never takes a heater lock.
+                slot = self.power_slot
+                if slot is not None and slot.requested > 0.:
+                    self.last_pwm = slot.budget.request(slot, self.reactor.monotonic(),
+                                                        slot.requested / slot.watts)
+                self.heater.set_pwm(read_time, self.last_pwm)
+                return
+            self.last_update_time = read_time
+            self.last_update_target = setpoint
+        self.control_update(read_time, temp, setpoint)
+        for monitor in self.monitors:
+            monitor.update(read_time, temp, target_temp, self.last_pwm)
+        if self.steady_update_interval:
+            self.update_interval = self.requested_update_interval(read_time, temp, setpoint)
+
+    def requested_update_interval(self, read_time, temp, target_temp):
+        """Seconds until the next control update, 0 runs on every sensor report
+
+        Controllers must handle the variable time step. The default runs at
+        the full rate until check_busy reports the heater settled.
+        """
+        if target_temp <= 0. or self.check_busy(read_time, temp, target_temp):
+            return 0.
+        return self.steady_update_interval
+
+    @abstractmethod
+    def control_update(self, read_time, temp, target_temp):
+        """Update control logic and set PWM"""
         pass
 
     @abstractmethod
@@ -37,9 +128,70 @@ class BaseController(ABC):
         """Return True if heater is still stabilizing (default: False)"""
         pass
 
+    def estimate_heat_time(self, from_temp, to_temp):
+        """Seconds to heat from from_temp to to_temp, None if the controller has no model"""
+        return None
+
+    def heat_model(self):
+        """(tau, dead_time, temp_inf(power)) first order plus dead time model, None without"""
+        return None
+
+    def get_status(self, eventtime):
+        """Controller specific status, reported through the ape_control object"""
+        return {}
+
+    def export_state(self):
+        """State handed to a replacement controller on a live swap (APE_SET)"""
+        return {"output": self.last_pwm}
+
+    def import_state(self, state):
+        """Continue from a replaced controller's exported state, without an output bump
+
+        Called after handle_ready/post_init. Keys are optional, 'target' is
+        always present and 'temp'/'time' are the last sensor update.
+        """
+        self.last_pwm = state.get("output", 0.)
+
+    def register_command(self, cmd, desc):
+        """Mux command routed to whichever controller is active on this heater
+
+        After an APE_SET swap the command reaches the new controller, a
+        command the active controller does not implement raises an error.
+        """
+        gcode = self.printer.lookup_object('gcode')
+        try:
+            gcode.register_mux_command(cmd, "HEATER", self.heater_name,
+                                       self._route_command(cmd), desc=desc)
+        except self.printer.config_error:
+            pass # registered by an earlier controller of this heater
+
+    def _route_command(self, cmd):
+        def handler(gcmd):
+            ape = self.printer.lookup_object('ape_control ' + self.heater_name, None)
+            controller = ape.new_controller if ape is not None else self
+            func = getattr(controller, 'cmd_' + cmd, None)
+            if func is None:
+                raise gcmd.error("%s is not available with control '%s'" % (cmd, ape.algo))
+            func(gcmd)
+        return handler
+
     def set_pwm(self, read_time, value):
-        """Can be e overwriten for things like AutoTune classes"""
+        """Can be e overwriten for things like AutoTune classes
+
+        Returns the value actually applied, which is lower than requested when
+        a shared power budget limits this heater. Embedded controllers only
+        record the value, their owner reads last_pwm.
+        """
+        if self.embedded:
+            self.last_pwm = value
+            return value
+        if self.power_slot is not None and value > 0.:
+            value = self.power_slot.budget.request(self.power_slot, self.reactor.monotonic(), value)
+        elif self.power_slot is not None:
+            self.power_slot.requested = self.power_slot.granted = 0.
         self.heater.set_pwm(read_time, value)
+        self.last_pwm = value
+        return value
     '''
     def set_pwm(self, read_time, value): # simplest form, place inside your control class
         self.heater.set_pwm(read_time, value)
@@ -0,0 +1,62 @@
+# ApeControl-Klipper calibration checkpoints
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Calibration routines store every completed phase (measurements and the
+# results derived from them) in <trace_dir>/<heater>_<test>.checkpoint as
+# json, replaced atomically after each phase. A run with RESUME=1 loads it
+# when it was written by a run with the same parameters, skips the phases
+# it holds and deletes it once the calibration completes.
+import json, logging, os, time
+
+EXTENSION = ".checkpoint"
+MAX_AGE = 12. * 3600. # [s] older checkpoints are not resumed, the printer may have changed
+
+
+class CalibrationCheckpoint:
+    def __init__(self, directory, heater_name, test, params):
+        self.filename = os.path.join(directory, "%s_%s%s" % (heater_name, test, EXTENSION))
+        self.params = params # run parameters a resumed checkpoint must match
+        self.phases = {}
+
+    def resume(self, max_age=MAX_AGE):
+        """Load the checkpoint, returns None when resumed or why it was not"""
+        try:
+            with open(self.filename, 'r') as f:
+                data = json.load(f)
+        except (IOError, OSError):
+            return "no checkpoint %s" % (self.filename,)
+        except ValueError:
+            return "checkpoint %s is unreadable" % (self.filename,)
+        if data.get('params') != self.params:
+            return "checkpoint %s was written with other parameters %s" % (
+                self.filename, data.get('params'))
+        age = time.time() - data.get('time', 0.)
+        if age > max_age:
+            return "checkpoint %s is %.1f hours old" % (self.filename, age / 3600.)
+        self.phases = data.get('phases', {})
+        return None
+
+    def get(self, phase, default=None):
+        return self.phases.get(phase, default)
+
+    def save(self, phase, value):
+        """Store a completed phase, a failed write only costs the resume"""
+        self.phases[phase] = value
+        data = {'params': self.params, 'time': time.time(), 'phases': self.phases}
+        tmp = self.filename + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.filename)
+        except (IOError, OSError):
+            logging.exception("ApeControl: unable to write calibration checkpoint %s", self.filename)
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
@@ -0,0 +1,87 @@
+# ApeControl-Klipper runtime config overrides
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# A config section view with options replaced at runtime (APE_SET). Values
+# are strings as they would appear in printer.cfg, options that are not
+# overridden are read from the original section. Option names are case
+# insensitive, as in Klipper's config.
+import configparser
+
+
+class ConfigOverlay:
+    def __init__(self, config, overrides):
+        self.config = config
+        self.overrides = overrides
+        self.accessed = set()
+        self.error = config.error
+
+    def __getattr__(self, name):
+        # get_printer, get_name, getsection, ... of the wrapped section
+        return getattr(self.config, name)
+
+    def unused(self):
+        """Overridden options no getter asked for, usually a typo"""
+        return sorted(set(self.overrides) - self.accessed)
+
+    def _override(self, option, parse, minval=None, maxval=None, above=None, below=None, **kwargs):
+        self.accessed.add(option)
+        try:
+            value = parse(self.overrides[option])
+        except (ValueError, KeyError):
+            raise self.error("Unable to parse option '%s' in section '%s'"
+                             % (option, self.config.get_name()))
+        if minval is not None and value < minval:
+            raise self.error("Option '%s' in section '%s' must have minimum of %s"
+                             % (option, self.config.get_name(), minval))
+        if maxval is not None and value > maxval:
+            raise self.error("Option '%s' in section '%s' must have maximum of %s"
+                             % (option, self.config.get_name(), maxval))
+        if above is not None and value <= above:
+            raise self.error("Option '%s' in section '%s' must be above %s"
+                             % (option, self.config.get_name(), above))
+        if below is not None and value >= below:
+            raise self.error("Option '%s' in section '%s' must be below %s"
+                             % (option, self.config.get_name(), below))
+        return value
+
+    def get(self, option, *args, **kwargs):
+        option = option.lower()
+        if option not in self.overrides:
+            return self.config.get(option, *args, **kwargs)
+        return self._override(option, str)
+
+    def getint(self, option, *args, **kwargs):
+        option = option.lower()
+        if option not in self.overrides:
+            return self.config.getint(option, *args, **kwargs)
+        return self._override(option, int, **kwargs)
+
+    def getfloat(self, option, *args, **kwargs):
+        option = option.lower()
+        if option not in self.overrides:
+            return self.config.getfloat(option, *args, **kwargs)
+        return self._override(option, float, **kwargs)
+
+    def getboolean(self, option, *args, **kwargs):
+        option = option.lower()
+        if option not in self.overrides:
+            return self.config.getboolean(option, *args, **kwargs)
+        states = configparser.RawConfigParser.BOOLEAN_STATES
+        return self._override(option, lambda v: states[v.strip().lower()])
+
+    def getfloatlist(self, option, *args, sep=',', **kwargs):
+        option = option.lower()
+        if option not in self.overrides:
+            return self.config.getfloatlist(option, *args, sep=sep, **kwargs)
+        return self._override(
+            option, lambda v: [float(p) for p in v.split(sep) if p.strip()])
+
+    def getlist(self, option, *args, sep=',', **kwargs):
+        option = option.lower()
+        if option not in self.overrides:
+            return self.config.getlist(option, *args, sep=sep, **kwargs)
+        return self._override(
+            option, lambda v: [p.strip() for p in v.split(sep) if p.strip()])
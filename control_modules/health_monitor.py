@@ -0,0 +1,167 @@
+# ApeControl-Klipper model residual heater health monitor
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Compares the measured temperature with the controller's thermal model. MPC
+# hands over the innovation of its own sensor prediction, PP/PID a first
+# order plus dead time model (heat_model) run by a slowly corrected observer.
+# A persistent bias means the heater delivers less (or more) heat than the
+# model expects: degraded cartridge, detached sock, thermistor slipping out of
+# the block. A raised residual spread means a loose or noisy thermistor.
+import math, logging
+from collections import deque
+
+MAX_DT = 5. # [s] larger gaps restart the statistics
+TRACK_BAND = 10. # [degC] statistics only near the target, heat-up is verify_heater's job
+NO_FAULT = None
+
+
+class FopdtObserver:
+    """First order plus dead time model, corrected towards the measurement
+    with the time constant 'correction_time' so it follows slow drift but a
+    model mismatch shows up as a residual"""
+    def __init__(self, correction_time):
+        self.correction_time = correction_time
+        self.temp = None
+        self.last_time = None
+        self.powers = deque() # (time, power) covering the dead time
+
+    def reset(self):
+        self.temp = None
+        self.last_time = None
+        self.powers.clear()
+
+    def update(self, read_time, temp, power, model):
+        tau, dead_time, temp_inf = model
+        if self.temp is None or not 0. < read_time - self.last_time <= MAX_DT:
+            self.reset()
+            self.temp = temp
+            self.last_time = read_time
+            self.powers.append((read_time, power))
+            return None
+        dt = read_time - self.last_time
+        self.last_time = read_time
+        # Power that acts now, applied dead_time ago
+        powers = self.powers
+        powers.append((read_time, power))
+        while len(powers) > 1 and powers[1][0] <= read_time - dead_time:
+            powers.popleft()
+        target = temp_inf(powers[0][1])
+        self.temp = target + (self.temp - target) * math.exp(-dt / tau)
+        residual = temp - self.temp
+        self.temp += residual * min(1., dt / self.correction_time)
+        return residual
+
+
+class HealthMonitor:
+    """Monitor attached to the controllers of one heater (see BaseController.monitors)"""
+    def __init__(self, config, ape):
+        self.printer = config.get_printer()
+        self.ape = ape
+        self.heater_name = config.get_name().split()[-1]
+        self.window = config.getfloat('health_window', 120., above=0.)
+        self.max_bias = config.getfloat('health_max_bias', 3., above=0.)
+        self.max_noise = config.getfloat('health_max_noise', 1.5, above=0.)
+        self.fault_time = config.getfloat('health_fault_time', 30., minval=0.)
+        self.action = config.getchoice('health_action', {'none': 'none', 'pause': 'pause',
+                                                         'shutdown': 'shutdown'}, 'none')
+        self.observer = FopdtObserver(self.window)
+        self._reset()
+
+    def _reset(self):
+        self.bias = 0.
+        self.var = 0.
+        self.weight = 0.
+        self.last_time = None
+        self.prev_residual = None
+        self.score = None
+        self.fault = NO_FAULT
+        self.fault_since = None
+        self.acted = False
+
+    def update(self, read_time, temp, target_temp, pwm):
+        controller = self.ape.new_controller
+        if target_temp <= 0.:
+            self.observer.reset()
+            self.last_time = self.prev_residual = None
+            return
+        residual = controller.model_innovation
+        if residual is None:
+            model = controller.heat_model()
+            if model is None:
+                self.score = None
+                return
+            residual = self.observer.update(read_time, temp, pwm, model)
+            if residual is None:
+                return
+        # Exponentially weighted bias and spread, time constant 'window'
+        dt = read_time - self.last_time if self.last_time is not None else 0.
+        self.last_time = read_time
+        if not 0. < dt <= MAX_DT or abs(target_temp - temp) > TRACK_BAND:
+            self.prev_residual = None
+            return
+        alpha = min(1., dt / self.window)
+        self.weight += alpha * (1. - self.weight)
+        self.bias += alpha * (residual - self.bias)
+        # Spread from successive differences, a drifting bias does not raise it
+        if self.prev_residual is not None:
+            diff = residual - self.prev_residual
+            self.var += alpha * (.5 * diff * diff - self.var)
+        self.prev_residual = residual
+        if self.weight < 0.6:
+            return # less than about one window of data
+        self._evaluate(read_time)
+
+    def _evaluate(self, read_time):
+        noise = math.sqrt(self.var)
+        bias_ratio = abs(self.bias) / self.max_bias
+        noise_ratio = noise / self.max_noise
+        self.score = max(0., 1. - max(bias_ratio, noise_ratio))
+        if noise_ratio >= 1.:
+            fault = "sensor noise"
+        elif bias_ratio >= 1. and self.bias < 0.:
+            fault = "heating below model"
+        elif bias_ratio >= 1.:
+            fault = "heating above model"
+        else:
+            fault = NO_FAULT
+        if fault != self.fault:
+            self.fault = fault
+            self.fault_since = read_time
+            self.acted = False
+            if fault is not NO_FAULT:
+                logging.warning("ApeControl: %s health: %s (bias %.2f, noise %.2f)",
+                                self.heater_name, fault, self.bias, noise)
+        if (fault is not NO_FAULT and not self.acted
+                and read_time - self.fault_since >= self.fault_time):
+            self.acted = True
+            self._act(fault, noise)
+
+    def _act(self, fault, noise):
+        msg = ("ApeControl: %s %s, model residual bias %.2f noise %.2f"
+               % (self.heater_name, fault, self.bias, noise))
+        # Runs on the sensor thread, hand over to the reactor thread safely
+        if self.action == 'shutdown':
+            self.printer.invoke_async_shutdown(msg)
+        elif self.action == 'pause':
+            reactor = self.printer.get_reactor()
+            reactor.register_async_callback(lambda eventtime: self._pause(msg))
+
+    def _pause(self, msg):
+        pause_resume = self.printer.lookup_object('pause_resume', None)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.respond_info(msg)
+        if pause_resume is None:
+            return
+        # Through the command, a user PAUSE macro (parking, ...) runs too
+        gcode.run_script("PAUSE")
+
+    def get_status(self, eventtime):
+        return {
+            "score": self.score,
+            "fault": self.fault,
+            "residual_bias": self.bias,
+            "residual_noise": math.sqrt(self.var),
+        }
@@ -0,0 +1,125 @@
+# ApeControl-Klipper online control quality KPIs
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Step response metrics per target change and regulation error while
+# printing, updated per temperature update with running accumulators only.
+import math
+
+MIN_STEP = 1. # [degC] smaller target changes do not start a step response
+
+
+class StepResponse:
+    """Running metrics of one target change"""
+    def __init__(self, start_time, start_temp, target):
+        self.start_time = start_time
+        self.target = target
+        self.step = target - start_temp
+        self.direction = 1. if self.step >= 0. else -1.
+        self.time_10 = self.time_90 = None
+        self.peak = 0. # furthest excursion past the target, in step direction
+        self.last_outside = start_time # last update outside the settle band
+        self.iae = 0.
+        self.ss_sq_err = 0.
+        self.ss_time = 0.
+        self.settled = False
+
+    def update(self, read_time, dt, temp, settle_band, settle_time):
+        error = self.target - temp
+        self.iae += abs(error) * dt
+        if abs(self.step) >= MIN_STEP:
+            progress = (temp - (self.target - self.step)) / self.step
+            if self.time_10 is None and progress >= 0.1:
+                self.time_10 = read_time
+            if self.time_90 is None and progress >= 0.9:
+                self.time_90 = read_time
+            self.peak = max(self.peak, -error * self.direction)
+        if abs(error) > settle_band:
+            self.last_outside = read_time
+            self.settled = False
+        elif read_time - self.last_outside >= settle_time:
+            self.settled = True
+        if self.settled:
+            self.ss_sq_err += error * error * dt
+            self.ss_time += dt
+
+    def get_status(self):
+        rise = None
+        if self.time_10 is not None and self.time_90 is not None:
+            rise = self.time_90 - self.time_10
+        return {
+            "target": self.target,
+            "step": self.step,
+            "rise_time": rise,
+            "overshoot": self.peak,
+            "overshoot_pct": 100. * self.peak / abs(self.step) if abs(self.step) >= MIN_STEP else None,
+            "settling_time": self.last_outside - self.start_time if self.settled else None,
+            "iae": self.iae,
+            "steady_state_rms": math.sqrt(self.ss_sq_err / self.ss_time) if self.ss_time else None,
+        }
+
+
+class ControlKPIs:
+    """Monitor attached to a controller (see BaseController.monitors)"""
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.settle_band = config.getfloat('kpi_settle_band', 1., above=0.)
+        self.settle_time = config.getfloat('kpi_settle_time', 10., minval=0.)
+        self.print_stats = None
+        self.response = None
+        self.last_response = None
+        self.responses = 0
+        self.last_time = None
+        # Regulation error while printing, restarted per print
+        self.print_state = None
+        self.print_sq_err = 0.
+        self.print_time = 0.
+        self.printer.register_event_handler("klippy:ready", self.handle_ready)
+
+    def handle_ready(self):
+        self.print_stats = self.printer.lookup_object('print_stats', None)
+
+    def update(self, read_time, temp, target_temp, pwm):
+        dt = read_time - self.last_time if self.last_time is not None else 0.
+        self.last_time = read_time
+        if dt < 0. or dt > 5.:
+            dt = 0.
+        response = self.response
+        if response is None or target_temp != response.target:
+            if response is not None and response.target > 0.:
+                self.last_response = response
+                self.responses += 1
+            response = self.response = StepResponse(read_time, temp, target_temp)
+        printing = self._is_printing()
+        if target_temp <= 0.:
+            return
+        response.update(read_time, dt, temp, self.settle_band, self.settle_time)
+        if response.settled and printing:
+            error = target_temp - temp
+            self.print_sq_err += error * error * dt
+            self.print_time += dt
+
+    def _is_printing(self):
+        if self.print_stats is None:
+            return False
+        state = self.print_stats.state
+        if state == "printing" and self.print_state not in ("printing", "paused"):
+            # New print, restart the regulation accumulators
+            self.print_sq_err = 0.
+            self.print_time = 0.
+        self.print_state = state
+        return state == "printing"
+
+    def get_status(self, eventtime):
+        status = {
+            "responses": self.responses,
+            "print_regulation_rms": (math.sqrt(self.print_sq_err / self.print_time)
+                                     if self.print_time else None),
+        }
+        if self.response is not None and self.response.target > 0.:
+            status["current"] = self.response.get_status()
+        if self.last_response is not None:
+            status["last"] = self.last_response.get_status()
+        return status
@@ -0,0 +1,389 @@
+# ApeControl-Klipper G-code lookahead service
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Publishes a timeline of upcoming heater targets, part fan speeds and tool
+# changes in toolhead print time. Two sources feed it:
+#  - M104/M109, M106/M107 and tool change commands as gcode processes them,
+#    timed exactly through toolhead lookahead callbacks at the end of the
+#    moves queued before them (a few seconds of horizon, any gcode source).
+#    Pruned as print time passes them.
+#  - The file being printed from virtual_sdcard, read ahead of the gcode
+#    processing position with move times estimated from feedrate and
+#    distance (acceleration ignored), up to 'lookahead_time' seconds.
+import math, logging
+from collections import deque
+
+SCAN_INTERVAL = 1.0 # [s] reactor interval of the file read-ahead
+SCAN_LINES_PER_TICK = 2000 # parse budget per scan
+MAX_CHECKPOINTS = 50000 # bound on the file position -> time map
+
+FAN = "fan"
+TOOL = "tool"
+
+
+class Timeline:
+    """Time ordered (print_time, value) events of one channel
+
+    Written from the reactor, read from the heaters' sensor threads: the
+    events are an immutable tuple that every change replaces in one
+    assignment, readers iterate whichever tuple they picked up.
+    """
+    def __init__(self, events=()):
+        self.events = ()
+        self.set(events)
+
+    def set(self, events):
+        """Replace all events"""
+        self.events = tuple(sorted(events, key=lambda event: event[0]))
+
+    def add(self, print_time, value):
+        events = self.events
+        idx = len(events)
+        while idx > 0 and events[idx - 1][0] > print_time:
+            idx -= 1 # rare out of order insert
+        self.events = events[:idx] + ((print_time, value),) + events[idx:]
+
+    def prune(self, print_time):
+        """Drop events at or before print_time, returns the last dropped value (or None)"""
+        events = self.events
+        idx = 0
+        while idx < len(events) and events[idx][0] <= print_time:
+            idx += 1
+        if not idx:
+            return None
+        self.events = events[idx:]
+        return events[idx - 1][1]
+
+    def value_at(self, print_time, default):
+        value = default
+        for event_time, event_value in self.events:
+            if event_time > print_time:
+                break
+            value = event_value
+        return value
+
+    def next_event(self, print_time):
+        for event in self.events:
+            if event[0] > print_time:
+                return event
+        return None
+
+    def clear(self):
+        self.events = ()
+
+
+def _earliest(*events):
+    """Earliest of (print_time, value) events, None entries ignored"""
+    found = None
+    for event in events:
+        if event is not None and (found is None or event[0] < found[0]):
+            found = event
+    return found
+
+
+class GcodeLookahead:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.lookahead_time = config.getfloat('lookahead_time', 60., above=0.)
+        # Optional tool -> heater map, 'T0:extruder, T1:extruder1'
+        self.tool_heaters = {}
+        for item in config.getlist('tool_heaters', []):
+            try:
+                tool, heater = [v.strip() for v in item.split(':')]
+            except ValueError:
+                raise config.error("Unable to parse tool_heaters entry '%s' in section '%s', "
+                                   "expected 'T0:extruder'" % (item, config.get_name()))
+            self.tool_heaters[tool.upper()] = heater
+        # Queued (exactly timed) and read-ahead (estimated) timelines
+        self.queue_fan = Timeline()
+        self.queue_targets = {}
+        self.queue_tools = Timeline()
+        self.file_fan = Timeline()
+        self.file_targets = {}
+        self.file_tools = Timeline()
+        self.toolhead = self.sdcard = self.mcu = None
+        self._reset_scan(None)
+        self.printer.register_event_handler("klippy:ready", self.handle_ready)
+
+    def handle_ready(self):
+        self.reactor = self.printer.get_reactor()
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.mcu = self.printer.lookup_object('mcu')
+        self.sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        gcode = self.printer.lookup_object('gcode')
+        commands = [('M106', self._parse_fan), ('M107', self._parse_fan),
+                    ('M104', self._parse_target), ('M109', self._parse_target)]
+        commands += [(tool, self._parse_tool) for tool in sorted(self.tool_heaters)]
+        for cmd, parse in commands:
+            prev = gcode.register_command(cmd, None)
+            if prev is None:
+                continue
+            gcode.register_command(cmd, self._wrap_cmd(cmd, prev, parse))
+        if self.sdcard is not None:
+            self.reactor.register_timer(self._scan_event, self.reactor.NOW)
+
+    # --- Queue source, exact print times of commands gcode is processing ---
+    def _wrap_cmd(self, cmd, prev, parse):
+        def wrapper(gcmd):
+            timeline, value = parse(cmd, gcmd)
+            self._prune_queue(self._now(self.reactor.monotonic()))
+            self.toolhead.register_lookahead_callback(
+                lambda print_time: timeline.add(print_time, value))
+            prev(gcmd)
+        return wrapper
+
+    def _parse_fan(self, cmd, gcmd):
+        if cmd == 'M106':
+            return self.queue_fan, gcmd.get_float('S', 255., minval=0.) / 255.
+        return self.queue_fan, 0.
+
+    def _parse_target(self, cmd, gcmd):
+        index = gcmd.get_int('T', None, minval=0)
+        if index is None:
+            heater = self.toolhead.get_extruder().get_name()
+        else:
+            heater = self.tool_heaters.get('T%d' % (index,), 'extruder')
+        timeline = self.queue_targets.get(heater)
+        if timeline is None:
+            timeline = self.queue_targets[heater] = Timeline()
+        return timeline, gcmd.get_float('S', 0.)
+
+    def _parse_tool(self, cmd, gcmd):
+        return self.queue_tools, cmd
+
+    def _prune_queue(self, print_time):
+        """Drop queued events print time has passed, the printer state holds them now"""
+        self.queue_fan.prune(print_time)
+        self.queue_tools.prune(print_time)
+        for timeline in self.queue_targets.values():
+            timeline.prune(print_time)
+
+    # --- Query interface ---
+    def get_fan_speed(self, print_time, current_speed):
+        """Part fan speed expected at print_time (queued changes first, then read-ahead)"""
+        speed = self.queue_fan.value_at(print_time, current_speed)
+        return self.file_fan.value_at(print_time, speed)
+
+    def get_target(self, heater_name, print_time, current_target):
+        target = current_target
+        for timelines in (self.queue_targets, self.file_targets):
+            timeline = timelines.get(heater_name)
+            if timeline is not None:
+                target = timeline.value_at(print_time, target)
+        return target
+
+    def next_target_change(self, heater_name, print_time):
+        """(print_time, target) of the next queued or read-ahead target change or None"""
+        events = [timelines[heater_name].next_event(print_time)
+                  for timelines in (self.queue_targets, self.file_targets)
+                  if heater_name in timelines]
+        return _earliest(*events)
+
+    def next_tool_change(self, print_time):
+        """(print_time, tool) of the next queued or read-ahead tool change or None"""
+        return _earliest(self.queue_tools.next_event(print_time),
+                         self.file_tools.next_event(print_time))
+
+    def next_tool_pickup(self, tool, print_time):
+        """Print time of the next queued or read-ahead change to 'tool' or None"""
+        for timeline in (self.queue_tools, self.file_tools):
+            for event_time, value in timeline.events:
+                if event_time > print_time and value == tool:
+                    return event_time
+        return None
+
+    def heater_for_tool(self, tool):
+        return self.tool_heaters.get(tool)
+
+    def get_status(self, eventtime):
+        now = self._now(eventtime)
+        tool_change = self.next_tool_change(now)
+        fan_change = _earliest(self.file_fan.next_event(now), self.queue_fan.next_event(now))
+        heaters = set(self.file_targets) | set(self.queue_targets)
+        return {
+            "horizon": max(0., self.scan_time - self.cur_time),
+            "next_tool_change": list(tool_change) if tool_change else None,
+            "next_fan_change": list(fan_change) if fan_change else None,
+            "next_target_changes": {
+                name: list(ev) for name, ev in (
+                    (name, self.next_target_change(name, now)) for name in heaters)
+                if ev is not None},
+        }
+
+    # --- File read-ahead source ---
+    def _now(self, eventtime):
+        return self.mcu.estimated_print_time(eventtime)
+
+    def _queue_end_time(self, eventtime):
+        """Print time at which the command being processed right now will run"""
+        status = self.toolhead.get_status(eventtime)
+        return max(status['print_time'], status['estimated_print_time'])
+
+    def _reset_scan(self, path):
+        self.scan_path = path
+        self.scan_file = None
+        self.scan_pos = 0
+        self.consumed_pos = 0 # gcode processing position
+        self.scan_time = 0. # estimated motion time at scan_pos
+        self.cur_time = 0. # estimated motion time at the gcode processing position
+        self.checkpoints = deque() # (file_pos, motion time)
+        self.pending = deque() # (motion time, file_pos, channel, key, value)
+        self.file_fan.clear()
+        self.file_tools.clear()
+        for timeline in self.file_targets.values():
+            timeline.clear()
+        # Parser modal state
+        self.pos = [0., 0., 0., 0.]
+        self.absolute_coord = True
+        self.absolute_extrude = True
+        self.feedrate = 25. # [mm/s]
+        self.active_tool = None
+
+    def _scan_event(self, eventtime):
+        path = self.sdcard.file_path() if self.sdcard.is_active() else None
+        if path is None:
+            if self.scan_path is not None:
+                self._close_scan()
+                self._reset_scan(None)
+            return eventtime + SCAN_INTERVAL
+        cur_pos = self.sdcard.get_status(eventtime)['file_position']
+        if path != self.scan_path or cur_pos < self.consumed_pos:
+            self._close_scan()
+            self._reset_scan(path)
+            self.scan_pos = cur_pos
+            try:
+                self.scan_file = open(path, 'rb')
+                self.scan_file.seek(cur_pos)
+            except (IOError, OSError):
+                logging.exception("ApeControl: lookahead unable to open '%s'", path)
+                self.scan_path = None
+                return eventtime + SCAN_INTERVAL
+            if self.active_tool is None:
+                extruder = self.toolhead.get_extruder()
+                for tool, heater in self.tool_heaters.items():
+                    if heater == extruder.get_name():
+                        self.active_tool = tool
+        # Advance the processing position
+        checkpoints = self.checkpoints
+        while checkpoints and checkpoints[0][0] <= cur_pos:
+            self.cur_time = checkpoints.popleft()[1]
+        self.consumed_pos = cur_pos
+        # Read ahead within the horizon
+        lines = 0
+        while (self.scan_time - self.cur_time < self.lookahead_time
+               and lines < SCAN_LINES_PER_TICK and len(checkpoints) < MAX_CHECKPOINTS):
+            line = self.scan_file.readline()
+            if not line:
+                break
+            self.scan_pos += len(line)
+            self._parse_line(line.decode('utf-8', 'replace'))
+            checkpoints.append((self.scan_pos, self.scan_time))
+            lines += 1
+        self._publish(eventtime, cur_pos)
+        return eventtime + SCAN_INTERVAL
+
+    def _close_scan(self):
+        if self.scan_file is not None:
+            self.scan_file.close()
+            self.scan_file = None
+
+    def _publish(self, eventtime, cur_pos):
+        """Convert pending read-ahead events to print time timelines"""
+        pending = self.pending
+        while pending and pending[0][1] <= cur_pos:
+            pending.popleft() # now in the gcode queue, the command itself takes over
+        anchor = self._queue_end_time(eventtime) - self.cur_time
+        # Built aside and swapped in, readers never see a partial timeline
+        fan, tools, targets = [], [], {}
+        for motion_time, _pos, channel, key, value in pending:
+            event = (anchor + motion_time, value)
+            if channel == FAN:
+                fan.append(event)
+            elif channel == TOOL:
+                tools.append(event)
+            else:
+                targets.setdefault(key, []).append(event)
+        self.file_fan.set(fan)
+        self.file_tools.set(tools)
+        for key, timeline in self.file_targets.items():
+            timeline.set(targets.pop(key, ()))
+        for key, events in targets.items():
+            self.file_targets[key] = Timeline(events)
+        self._prune_queue(self._now(eventtime))
+
+    def _add_pending(self, channel, key, value):
+        self.pending.append((self.scan_time, self.scan_pos, channel, key, value))
+
+    def _parse_line(self, line):
+        line = line.split(';', 1)[0].strip().upper()
+        if not line:
+            return
+        parts = line.split()
+        cmd = parts[0]
+        params = {}
+        for part in parts[1:]:
+            if '=' in part:
+                key, value = part.split('=', 1)
+                params[key] = value
+            else:
+                params[part[0]] = part[1:]
+        try:
+            self._parse_cmd(cmd, params)
+        except ValueError:
+            pass
+
+    def _parse_cmd(self, cmd, params):
+        if cmd in ('G0', 'G1'):
+            if 'F' in params:
+                self.feedrate = max(float(params['F']) / 60., 0.1)
+            new_pos = list(self.pos)
+            for idx, axis in enumerate('XYZE'):
+                if axis not in params:
+                    continue
+                value = float(params[axis])
+                absolute = self.absolute_extrude if axis == 'E' else self.absolute_coord
+                new_pos[idx] = value if absolute else self.pos[idx] + value
+            dist = math.sqrt(sum((new_pos[i] - self.pos[i])**2 for i in range(3)))
+            if not dist:
+                dist = abs(new_pos[3] - self.pos[3])
+            self.scan_time += dist / self.feedrate
+            self.pos = new_pos
+        elif cmd == 'G90':
+            self.absolute_coord = self.absolute_extrude = True
+        elif cmd == 'G91':
+            self.absolute_coord = self.absolute_extrude = False
+        elif cmd == 'M82':
+            self.absolute_extrude = True
+        elif cmd == 'M83':
+            self.absolute_extrude = False
+        elif cmd == 'G92':
+            for idx, axis in enumerate('XYZE'):
+                if axis in params:
+                    self.pos[idx] = float(params[axis])
+        elif cmd == 'G4':
+            if 'P' in params:
+                self.scan_time += float(params['P']) / 1000.
+            elif 'S' in params:
+                self.scan_time += float(params['S'])
+        elif cmd in ('M104', 'M109'):
+            tool = 'T' + params['T'] if 'T' in params else self.active_tool
+            heater = self.tool_heaters.get(tool, 'extruder') if tool else 'extruder'
+            self._add_pending(None, heater, float(params.get('S', 0.)))
+        elif cmd in ('M140', 'M190'):
+            self._add_pending(None, 'heater_bed', float(params.get('S', 0.)))
+        elif cmd == 'M106':
+            self._add_pending(FAN, None, float(params.get('S', 255.)) / 255.)
+        elif cmd == 'M107':
+            self._add_pending(FAN, None, 0.)
+        elif cmd[0] == 'T' and cmd[1:].isdigit():
+            self.active_tool = cmd
+            self._add_pending(TOOL, None, cmd)
+        elif cmd == 'ACTIVATE_EXTRUDER' and 'EXTRUDER' in params:
+            heater = params['EXTRUDER'].lower()
+            for tool, name in self.tool_heaters.items():
+                if name == heater:
+                    self.active_tool = tool
+                    self._add_pending(TOOL, None, tool)
@@ -5,9 +5,18 @@ import logging
 import math
 import types
 from .base_controller import BaseController
+from .profiles import profile_section
+from .calibration_checkpoint import CalibrationCheckpoint
+from .perturbation_ident import PerturbationIdentifier
 
 AMBIENT_TEMP = 25.0
 PIN_MIN_TIME = 0.100
+RESUME_AMBIENT_DELTA = 2.0 # [degC] a resumed heat-up test reuses the ambient reading this close to it
+IDENT_MIN_CHANGE = 0.01 # identified constants closer than this fraction are not applied
+IDENT_MAX_CHANGE = 1.5 # nor those further than this factor, that takes MPC_CALIBRATE
+IDENT_CONSTS = (("block_heat_capacity", "const_block_heat_capacity"),
+                ("sensor_responsiveness", "const_sensor_responsiveness"),
+                ("ambient_transfer", "const_ambient_transfer"))
 
 FILAMENT_TEMP_SRC_AMBIENT = "ambient"
 FILAMENT_TEMP_SRC_FIXED = "fixed"
@@ -15,8 +24,8 @@ FILAMENT_TEMP_SRC_SENSOR = "sensor"
 
 
 class ControlMPC(BaseController):
-    def __init__(self, config, load_clean=False, register=True):
-        super().__init__(config)
+    def __init__(self, config, load_clean=False, register=True, embedded=False):
+        super().__init__(config, embedded)
         
         self._load_config_variables(config)
         self.profile = self.get_profile()
@@ -31,6 +40,14 @@ class ControlMPC(BaseController):
         self.last_temp_time = 0.0
 
         
+        # Calibration checkpoints for MPC_CALIBRATE RESUME=1
+        self.trace_dir = config.get('trace_dir', '/tmp')
+
+        # Model identification by a small power perturbation while regulating
+        self.ident = None
+        if register and not embedded and config.getboolean('perturbation_ident', False):
+            self.ident = PerturbationIdentifier(config)
+
         self.state_block_temp = AMBIENT_TEMP # default states before getting updated by post_init
         self.state_sensor_temp = self.state_block_temp
         self.toolhead = None # the none-check that calls this can also be used to call post_init
@@ -39,21 +56,8 @@ class ControlMPC(BaseController):
             return
         
         self.heater_name = config.get_name().split()[-1]
-        gcode = self.printer.lookup_object("gcode")
-        gcode.register_mux_command(
-            "MPC_CALIBRATE",
-            "HEATER",
-            self.heater_name,
-            self.cmd_MPC_CALIBRATE,
-            desc=self.cmd_MPC_CALIBRATE_help,
-        )
-        gcode.register_mux_command(
-            "MPC_SET",
-            "HEATER",
-            self.heater_name,
-            self.cmd_MPC_SET,
-            desc=self.cmd_MPC_SET_help,
-        )
+        self.register_command("MPC_CALIBRATE", self.cmd_MPC_CALIBRATE_help)
+        self.register_command("MPC_SET", self.cmd_MPC_SET_help)
         # Non mux version
         #gcode.register_command('MPC_CALIBRATE', self.cmd_MPC_CALIBRATE, # might need to change this to a mux function later
         #                       desc=self.cmd_MPC_CALIBRATE_help)
@@ -303,13 +307,14 @@ class ControlMPC(BaseController):
 
     # Control interface
 
-    def temperature_update(self, read_time, temp, target_temp):
+    def control_update(self, read_time, temp, target_temp):
         if not self.is_valid():
-            self.heater.set_pwm(read_time, 0.0)
+            self.set_pwm(read_time, 0.0)
             return
 
         dt = read_time - self.last_temp_time
-        if self.last_temp_time == 0.0 or dt < 0.0 or dt > 1.0:
+        # Decimated updates are steady_update_interval apart
+        if self.last_temp_time == 0.0 or dt < 0.0 or dt > self.steady_update_interval + 1.0:
             dt = 0.1
 
         # Extruder position
@@ -384,28 +389,39 @@ class ControlMPC(BaseController):
 
         # Correct
 
+        self.model_innovation = temp - self.state_sensor_temp
         smoothing = 1 - (1 - self.const_smoothing) ** dt
         adjustment_dT = (temp - self.state_sensor_temp) * smoothing
         self.state_block_temp += adjustment_dT
         self.state_sensor_temp += adjustment_dT
 
-        if self.want_ambient_refresh:
-            temp = self.ambient_sensor.get_temp(read_time)[0]
-            if temp != 0.0:
-                self.state_ambient_temp = temp
-                self.want_ambient_refresh = False
-        if (self.last_power > 0 and self.last_power < 1.0) or abs(
-            expected_block_dT + adjustment_dT
-        ) < self.const_steady_state_rate * dt:
-            if adjustment_dT > 0.0:
-                ambient_delta = max(
-                    adjustment_dT, self.const_min_ambient_change * dt
-                )
-            else:
-                ambient_delta = min(
-                    adjustment_dT, -self.const_min_ambient_change * dt
-                )
-            self.state_ambient_temp += ambient_delta
+        if self.ambient is not None:
+            # Shared estimate, feed it with this heater's power balance when steady
+            if (ambient_transfer > 0.
+                    and abs(expected_block_dT + adjustment_dT) < self.const_steady_state_rate * dt):
+                self.ambient.contribute(
+                    self.heater_name,
+                    self.state_block_temp
+                    - (self.last_power - self.last_loss_filament) / ambient_transfer)
+            self.state_ambient_temp = self.ambient.temp
+        else:
+            if self.want_ambient_refresh:
+                ambient_temp = self.ambient_sensor.get_temp(read_time)[0]
+                if ambient_temp != 0.0:
+                    self.state_ambient_temp = ambient_temp
+                    self.want_ambient_refresh = False
+            if (self.last_power > 0 and self.last_power < 1.0) or abs(
+                expected_block_dT + adjustment_dT
+            ) < self.const_steady_state_rate * dt:
+                if adjustment_dT > 0.0:
+                    ambient_delta = max(
+                        adjustment_dT, self.const_min_ambient_change * dt
+                    )
+                else:
+                    ambient_delta = min(
+                        adjustment_dT, -self.const_min_ambient_change * dt
+                    )
+                self.state_ambient_temp += ambient_delta
 
         # Output
 
@@ -441,6 +457,9 @@ class ControlMPC(BaseController):
             power = 0
 
         duty = power / self.const_heater_power
+        if self.ident is not None:
+            duty += self.ident.perturbation(read_time, temp, target_temp, duty,
+                                            self.heater_max_power / self.const_heater_power)
 
         # logging.info(
         #     "mpc: [%.3f/%.3f] %.2f => %.2f / %.2f / %.2f = %.2f[%.2f+%.2f+%.2f] / %.2f, dT %.2f, E %.2f=>%.2f",
@@ -460,11 +479,47 @@ class ControlMPC(BaseController):
         #     extrude_speed_next,
         # )
 
-        self.last_power = power
+        # The model must see the power actually applied (shared power budget)
+        self.last_power = self.set_pwm(read_time, duty) * self.const_heater_power
         self.last_loss_ambient = loss_ambient
         self.last_loss_filament = loss_filament
         self.last_temp_time = read_time
-        self.heater.set_pwm(read_time, duty)
+        if self.ident is not None:
+            self._ident_record(read_time, temp, ambient_transfer)
+
+    def _ident_record(self, read_time, temp, ambient_transfer):
+        net_power = loss = None
+        if self.ambient_sensor is not None and self.const_ambient_transfer:
+            # Power balance against the sensor, the model's own ambient absorbs transfer errors
+            ambient_temp = self.ambient_sensor.get_temp(read_time)[0]
+            if ambient_temp:
+                net_power = self.last_power - self.last_loss_filament
+                loss = ((self.state_block_temp - ambient_temp)
+                        * ambient_transfer / self.const_ambient_transfer)
+        self.ident.record(read_time, temp, self.last_power, ambient_transfer, net_power, loss)
+        if self.ident.updated:
+            self.ident.updated = False
+            self._apply_ident()
+
+    def _apply_ident(self):
+        """Take over identified constants that are confident and plausible"""
+        for name, attr in IDENT_CONSTS:
+            value = self.ident.confident_value(name)
+            current = getattr(self, attr)
+            if value is None or abs(value - current) <= IDENT_MIN_CHANGE * current:
+                continue
+            if not 1. / IDENT_MAX_CHANGE <= value / current <= IDENT_MAX_CHANGE:
+                logging.warning("ApeControl: %s identified %s=%.4f is too far from %.4f, "
+                                "not applied (run MPC_CALIBRATE)", self.heater_name, name,
+                                value, current)
+                continue
+            if attr == "const_ambient_transfer":
+                scale = value / current
+                self.const_fan_ambient_transfer = [
+                    v * scale for v in self.const_fan_ambient_transfer]
+            setattr(self, attr, value)
+            logging.info("ApeControl: %s %s %.4f -> %.4f (identified while printing)",
+                         self.heater_name, name, current, value)
 
     def filament_temp(self, read_time, ambient_temp):
         src = self.filament_temp_src
@@ -481,6 +536,28 @@ class ControlMPC(BaseController):
     def check_busy(self, eventtime, smoothed_temp, target_temp):
         return abs(target_temp - smoothed_temp) > 1.0
 
+    def estimate_heat_time(self, from_temp, to_temp):
+        if not self.is_valid() or not self.const_ambient_transfer:
+            return None
+        if to_temp <= from_temp:
+            return 0.
+        # Block settles at ambient + P / h with time constant C / h, the sensor lags by ~1/responsiveness
+        temp_max = self.state_ambient_temp + self.heater_max_power / self.const_ambient_transfer
+        if to_temp >= temp_max:
+            return None
+        tau = self.const_block_heat_capacity / self.const_ambient_transfer
+        return (tau * math.log((temp_max - from_temp) / (temp_max - to_temp))
+                + 1. / self.const_sensor_responsiveness)
+
+    def heat_model(self):
+        if not self.is_valid() or not self.const_ambient_transfer:
+            return None
+        # Block time constant C / h, the sensor lag stands in for the dead time
+        h = self.const_ambient_transfer
+        power = self.const_heater_power
+        return (self.const_block_heat_capacity / h, 1. / self.const_sensor_responsiveness,
+                lambda duty: self.state_ambient_temp + duty * power / h)
+
     def update_smooth_time(self):
         pass
 
@@ -511,6 +588,25 @@ class ControlMPC(BaseController):
     def get_type(self):
         return "mpc"
 
+    def export_state(self):
+        state = super().export_state()
+        state.update({"temp": self.state_sensor_temp, "time": self.last_temp_time,
+                      "block_temp": self.state_block_temp,
+                      "ambient_temp": self.state_ambient_temp})
+        return state
+
+    def import_state(self, state):
+        super().import_state(state)
+        if "time" not in state:
+            return
+        self.last_temp_time = state["time"]
+        self.state_sensor_temp = state["temp"]
+        self.state_block_temp = state.get("block_temp", state["temp"])
+        if state.get("ambient_temp") is not None:
+            self.state_ambient_temp = state["ambient_temp"]
+            self.want_ambient_refresh = False
+        self.last_power = state.get("output", 0.) * self.const_heater_power
+
     def get_status(self, eventtime):
         return {
             "temp_block": self.state_block_temp,
@@ -522,6 +618,7 @@ class ControlMPC(BaseController):
             "filament_temp": self.filament_temp_src,
             "filament_heat_capacity": self.const_filament_heat_capacity,
             "filament_density": self.const_filament_density,
+            "ident": self.ident.get_status() if self.ident is not None else None,
         }
 
 
@@ -568,18 +665,52 @@ class MpcCalibrate:
             "THRESHOLD", max(50.0, min(100, target_temp - 100.0))
         )
 
+        # Completed phases are checkpointed, RESUME=1 continues an interrupted run
+        checkpoint = CalibrationCheckpoint(
+            self.orig_control.trace_dir, self.heater.get_name(), "mpc_calibrate",
+            {"target": target_temp, "threshold": threshold_temp,
+             "fan_breakpoints": fan_breakpoints, "use_analytic": use_analytic,
+             "heater_power": self.orig_control.heater_max_power})
+        if gcmd.get_int("RESUME", 0, minval=0, maxval=1):
+            reason = checkpoint.resume()
+            if reason is None:
+                gcmd.respond_info("Resuming MPC calibration, completed: %s"
+                                  % (", ".join(sorted(checkpoint.phases)),))
+            else:
+                gcmd.respond_info("Not resuming, %s" % (reason,))
+
         control = TuningControl(self.heater)
         old_control = self.heater.set_control(control)
         try:
-            ambient_temp = self.await_ambient(gcmd, control, threshold_temp)
-            samples = self.heatup_test(gcmd, target_temp, control)
-            first_res = self.process_first_pass(
-                samples,
-                self.orig_control.heater_max_power,
-                ambient_temp,
-                threshold_temp,
-                use_analytic,
-            )
+            first_res = checkpoint.get("first_pass")
+            if first_res is None:
+                ambient_temp = checkpoint.get("ambient")
+                if (ambient_temp is None
+                        or self._heater_temp() > ambient_temp + RESUME_AMBIENT_DELTA):
+                    # The heat-up has to start from ambient
+                    ambient_temp = self.await_ambient(gcmd, control, threshold_temp)
+                    checkpoint.save("ambient", ambient_temp)
+                samples = self.heatup_test(gcmd, target_temp, control)
+                first_res = self.process_first_pass(
+                    samples,
+                    self.orig_control.heater_max_power,
+                    ambient_temp,
+                    threshold_temp,
+                    use_analytic,
+                )
+                checkpoint.phases.pop("ambient")
+                checkpoint.save("first_pass", dict(first_res, ambient_temp=ambient_temp,
+                                                   samples=samples))
+            else:
+                # The heat-up ended earlier, the model starts from the measured
+                # temperature and the transfer test keeps its original target
+                # The stored heat-up samples are for the checkpoint only, not the log
+                first_res = dict(first_res)
+                first_res.pop("samples", None)
+                ambient_temp = first_res.pop("ambient_temp")
+                temp = self._heater_temp()
+                first_res.update(transfer_target=first_res["post_block_temp"],
+                                 post_block_temp=temp, post_sensor_temp=temp)
             logging.info("First pass: %s", first_res)
 
 
@@ -612,6 +743,7 @@ class MpcCalibrate:
                 ambient_measure_sample_time,
                 fan_breakpoints,
                 first_res,
+                checkpoint,
             )
             second_res = self.process_second_pass(
                 first_res,
@@ -636,7 +768,7 @@ class MpcCalibrate:
                 [f"{p:.6g}" for p in second_res["fan_ambient_transfer"]]
             )
 
-            cfgname = "ape_control " + self.heater.get_name()
+            cfgname = profile_section(self.heater.get_name(), gcmd.get("PROFILE", None))
             gcmd.respond_info(
                 f"Finished MPC calibration of heater '{cfgname}'\n"
                 "Measured:\n "
@@ -666,12 +798,18 @@ class MpcCalibrate:
                 fan_ambient_transfer,
             )
 
+            checkpoint.remove()
+
         except self.printer.command_error as e:
-            raise gcmd.error("%s failed: %s" % (gcmd.get_command(), e))
+            raise gcmd.error("%s failed: %s (completed phases are kept, RESUME=1 continues)"
+                             % (gcmd.get_command(), e))
         finally:
             self.heater.set_control(old_control)
             self.heater.alter_target(0.0)
 
+    def _heater_temp(self):
+        return self.heater.get_temp(self.reactor.monotonic())[0]
+
     def wait_stable(self, cycles=5):
         """
         We wait for the extruder to cycle x amount of times above and below the target
@@ -783,8 +921,10 @@ class MpcCalibrate:
         ambient_measure_sample_time,
         fan_breakpoints,
         first_pass_results,
+        checkpoint=None,
     ):
-        target_temp = round(first_pass_results["post_block_temp"])
+        target_temp = round(first_pass_results.get("transfer_target",
+                                                   first_pass_results["post_block_temp"]))
         self.heater.set_temp(target_temp)
         gcmd.respond_info(
             "Performing ambient transfer tests, target is %.1f degrees"
@@ -796,6 +936,7 @@ class MpcCalibrate:
         fan = self.orig_control.cooling_fan
         
         fan_powers = []
+        done = checkpoint.get("fan_powers", []) if checkpoint is not None else []
         if fan is None:
             power_base = self.measure_power(
                 ambient_max_measure_time, ambient_measure_sample_time, self.orig_control.heater_max_power
@@ -804,6 +945,12 @@ class MpcCalibrate:
         else:
             for idx in range(0, fan_breakpoints):
                 speed = idx / (fan_breakpoints - 1)
+                if idx < len(done):
+                    gcmd.respond_info(
+                        f"{speed * 100.0:.0f}% fan average power: {done[idx][1]:.2f} W (checkpoint)"
+                    )
+                    fan_powers.append(tuple(done[idx]))
+                    continue
                 curtime = self.reactor.monotonic()
                 fan.set_speed(speed)
                 gcmd.respond_info("Waiting for temperature to stabilize")
@@ -818,6 +965,8 @@ class MpcCalibrate:
                     f"{speed * 100.0:.0f}% fan average power: {power:.2f} W"
                 )
                 fan_powers.append((speed, power))
+                if checkpoint is not None:
+                    checkpoint.save("fan_powers", fan_powers)
             curtime = self.reactor.monotonic()
             fan.set_speed(0.0)
             power_base = fan_powers[0][1]
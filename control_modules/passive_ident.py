@@ -0,0 +1,194 @@
+# ApeControl-Klipper passive thermal model identification
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Identifies a heater model from ordinary operation (temperature, pwm, fan and
+# extrusion streams) without dedicated calibration cycles. Samples are
+# streamed one at a time, memory use only depends on the delay search range.
+import math
+from collections import deque
+
+AMBIENT_TEMP = 25.
+MAX_GAP = 5. # [s] a larger gap in the recording restarts the history
+N_PARAMS = 5 # pwm, -temp, -fan*(temp-ambient), -ev*(temp-ambient), 1
+
+
+class RecursiveLeastSquares:
+    """Exponentially weighted recursive least squares for a small parameter vector"""
+    def __init__(self, n, forgetting=1.0, init_cov=1e4):
+        self.n = n
+        self.forgetting = forgetting
+        self.theta = [0.] * n
+        self.P = [[init_cov if i == j else 0. for j in range(n)] for i in range(n)]
+        self.count = 0
+        # Weighted residual statistics, used for model selection and confidence
+        self.sq_err = 0.
+        self.weight = 0.
+
+    def update(self, x, y):
+        n = self.n
+        P = self.P
+        Px = [sum(P[i][j] * x[j] for j in range(n)) for i in range(n)]
+        denom = self.forgetting + sum(x[i] * Px[i] for i in range(n))
+        err = y - sum(self.theta[i] * x[i] for i in range(n))
+        gain = [v / denom for v in Px]
+        for i in range(n):
+            self.theta[i] += gain[i] * err
+        inv_lambda = 1. / self.forgetting
+        for i in range(n):
+            gi = gain[i]
+            row = P[i]
+            for j in range(n):
+                row[j] = (row[j] - gi * Px[j]) * inv_lambda
+        self.sq_err = self.forgetting * self.sq_err + err * err
+        self.weight = self.forgetting * self.weight + 1.
+        self.count += 1
+        return err
+
+    def residual_var(self):
+        dof = self.weight - self.n
+        if dof <= 0.:
+            return float('inf')
+        return self.sq_err / dof
+
+    def param_std(self, idx):
+        return math.sqrt(max(0., self.P[idx][idx] * self.residual_var()))
+
+
+class PassiveIdentifier:
+    """Streaming identification of a first order plus dead time heater model
+
+    The regression per candidate dead time L is
+        dT/dt = a * pwm(t - L) - b * T - c * fan * (T - Ta) - e * ev * (T - Ta) + d
+    from which tau = 1/b, K = a/b [degC per unit duty] and Ta = d/b follow.
+    The candidate with the lowest residual is reported, giving PP's tau,
+    dead_time and gain and, with the heater wattage, MPC's block heat
+    capacity, ambient transfer, fan transfer and sensor responsiveness.
+    """
+    def __init__(self, period=1.0, max_delay=30., delay_step=2.,
+                 forgetting=1.0, heater_power=None, ambient=AMBIENT_TEMP):
+        self.period = period
+        self.heater_power = heater_power
+        self.ambient = ambient
+        self.delay_steps = list(range(0, int(max_delay / period) + 1,
+                                      max(1, int(round(delay_step / period)))))
+        self.models = [RecursiveLeastSquares(N_PARAMS, forgetting)
+                       for _ in self.delay_steps]
+        self.pwm_history = deque(maxlen=self.delay_steps[-1] + 2)
+        self.window = deque(maxlen=3) # resampled (temp, fan, ev) for a central difference
+        self.next_time = None
+        self.last_sample = None
+        self.samples = 0
+
+    def reset_history(self):
+        self.pwm_history.clear()
+        self.window.clear()
+        self.next_time = None
+        self.last_sample = None
+
+    def feed(self, time, temp, pwm, fan=0., ev=0.):
+        """Add one recorded sample, samples must be in time order"""
+        last = self.last_sample
+        if last is not None and (time <= last[0] or time - last[0] > MAX_GAP):
+            if time <= last[0]:
+                return
+            self.reset_history()
+            last = None
+        if last is None:
+            self.last_sample = (time, temp, pwm, fan, ev)
+            self.next_time = time
+            self._grid_sample(temp, pwm, fan, ev)
+            self.next_time += self.period
+            return
+        # Resample to a fixed grid, temperature interpolated, inputs held
+        lt, ltemp, lpwm, lfan, lev = last
+        while self.next_time <= time:
+            frac = (self.next_time - lt) / (time - lt)
+            self._grid_sample(ltemp + (temp - ltemp) * frac, lpwm, lfan, lev)
+            self.next_time += self.period
+        self.last_sample = (time, temp, pwm, fan, ev)
+
+    def _grid_sample(self, temp, pwm, fan, ev):
+        self.pwm_history.append(pwm)
+        self.window.append((temp, fan, ev))
+        if len(self.window) < 3:
+            return
+        # Central difference around the middle sample
+        temp_deriv = (self.window[2][0] - self.window[0][0]) / (2. * self.period)
+        temp, fan, ev = self.window[1]
+        rise = temp - self.ambient
+        history = self.pwm_history
+        last_idx = len(history) - 2 # pwm aligned with the middle sample
+        for steps, model in zip(self.delay_steps, self.models):
+            idx = last_idx - steps
+            if idx < 0:
+                continue
+            model.update((history[idx], -temp, -fan * rise, -ev * rise, 1.),
+                         temp_deriv)
+        self.samples += 1
+        # Track the ambient reference used by the fan/extrusion regressors
+        if self.samples % 100 == 0:
+            ambient = self._best_ambient()
+            if ambient is not None:
+                self.ambient = ambient
+
+    def best_model(self):
+        best = None
+        for steps, model in zip(self.delay_steps, self.models):
+            if model.count <= N_PARAMS:
+                continue
+            var = model.residual_var()
+            if best is None or var < best[0]:
+                best = (var, steps, model)
+        return best
+
+    def _best_ambient(self):
+        best = self.best_model()
+        if best is None or best[2].theta[1] <= 0.:
+            return None
+        theta = best[2].theta
+        return max(-20., min(80., theta[4] / theta[1]))
+
+    def result(self):
+        """Identified parameters with relative standard deviations, None if no data"""
+        best = self.best_model()
+        if best is None:
+            return None
+        var, steps, model = best
+        a, b, c, e, d = model.theta
+        if a <= 0. or b <= 0.:
+            return None
+        rel = [model.param_std(i) / abs(model.theta[i]) if model.theta[i] else float('inf')
+               for i in range(N_PARAMS)]
+        tau = 1. / b
+        gain = a / b
+        dead_time = steps * self.period
+        res = {
+            "samples": model.count,
+            "residual_std": math.sqrt(var),
+            "tau": tau,
+            "tau_rel_std": rel[1],
+            "gain": gain,
+            "gain_rel_std": math.hypot(rel[0], rel[1]),
+            "dead_time": dead_time,
+            "ambient_temp": d / b,
+            # PP's steady-state gain in pwm per degree above ambient (ss_map linear term)
+            "k_ss": 1. / gain,
+            "fan_gain": c / b, # fractional increase of ambient transfer at full fan
+            "fan_rel_std": rel[2],
+            "ev_gain": e / b,
+        }
+        if self.heater_power:
+            heat_capacity = self.heater_power / a
+            res.update({
+                "block_heat_capacity": heat_capacity,
+                "block_heat_capacity_rel_std": rel[0],
+                "ambient_transfer": b * heat_capacity,
+                "ambient_transfer_rel_std": math.hypot(rel[0], rel[1]),
+                "fan_ambient_transfer": [b * heat_capacity, (b + c) * heat_capacity],
+                # A first order sensor lag shows up as roughly 1/responsiveness of dead time
+                "sensor_responsiveness": 1. / max(dead_time, self.period),
+            })
+        return res
@@ -0,0 +1,269 @@
+# ApeControl-Klipper in-print model identification by power perturbation
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# During long steady regulation a +-ident_amplitude duty pseudo random binary
+# sequence (PRBS_BITS maximum length sequence, ident_bit_time per bit) is
+# added to the heater output. Over every sequence period the Fourier
+# coefficients of the applied power and of the sensor temperature are taken
+# at the first HARMONICS harmonics of the period, linear trend removed. The
+# sequence is periodic and independent of the sensor noise and of whatever
+# the controller does, so the coefficients averaged over ident_batch periods
+# give the heater's frequency response G = T/P, in closed loop too. For the
+# MPC model
+#   1/G(w) = (j w C + h) (1 + j w / r)
+# Re(1/G) = h - (C / r) w^2 and Im(1/G) / w = C + h / r. Both are fit as
+# a + b w^2 over the harmonics (the w^2 term of Im takes up the dead time the
+# model does not have), giving the block heat capacity C and the sensor
+# responsiveness r. The perturbation hardly excites the slow block time
+# constant, the ambient transfer h comes from the power balance against an
+# ambient sensor instead and is not estimated without one.
+#
+# Every batch adds one estimate per parameter, the mean of the last
+# ESTIMATES batches is reported with the relative standard deviation of that
+# mean. The controller applies a parameter once it is below ident_confidence.
+import math
+import logging
+from collections import deque
+
+PRBS_BITS = 31 # x^5 + x^3 + 1 maximum length sequence
+HARMONICS = 3
+ESTIMATES = 8 # batch estimates averaged
+MIN_ESTIMATES = 4 # batches before a parameter is reported as confident
+PARAMS = ("block_heat_capacity", "sensor_responsiveness", "ambient_transfer")
+
+
+def _prbs_sequence():
+    state = 0x1f
+    sequence = []
+    for _ in range(PRBS_BITS):
+        bit = ((state >> 4) ^ (state >> 2)) & 1
+        state = ((state << 1) | bit) & 0x1f
+        sequence.append(1. if bit else -1.)
+    return tuple(sequence)
+
+PRBS = _prbs_sequence()
+
+
+class PerturbationIdentifier:
+    def __init__(self, config):
+        self.amplitude = config.getfloat('ident_amplitude', 0.02, above=0., maxval=0.1)
+        self.bit_time = config.getfloat('ident_bit_time', 2., above=0.)
+        self.settle_time = config.getfloat('ident_settle_time', 120., minval=0.)
+        self.band = config.getfloat('ident_band', 1., above=0.)
+        self.batch = config.getint('ident_batch', 20, minval=2)
+        self.confidence = config.getfloat('ident_confidence', 0.05, minval=0.)
+        self.period = PRBS_BITS * self.bit_time
+        self.omega = 2. * math.pi / self.period
+        self.target = None
+        self.steady_since = None
+        self.active = False
+        self.periods = 0 # completed periods, all batches
+        # Current period: start, values at the start and the Fourier sums
+        self.period_start = 0.
+        self.temp0 = self.power0 = 0.
+        self.sums = [0.] * (4 * HARMONICS) # temp re, temp im, power re, power im per harmonic
+        self.net_energy = self.loss_energy = 0.
+        # Current batch
+        self.batch_sums = [0.] * (4 * HARMONICS)
+        self.batch_periods = 0
+        self.batch_net = self.batch_loss = 0.
+        self.last_time = None
+        self.last_temp = self.last_power = 0.
+        self.last_net = self.last_loss = None
+        self.ambient_transfer = 0.
+        self.estimates = {name: deque(maxlen=ESTIMATES) for name in PARAMS}
+        self.updated = False # new batch estimates since the owner last looked
+
+    def perturbation(self, read_time, temp, target_temp, duty, max_duty):
+        """Duty to add to this update's output, 0 while not identifying
+
+        Runs once the target is unchanged and the temperature within
+        ident_band of it for ident_settle_time, with room for the
+        perturbation on both sides of the duty. Anything else ends the
+        current period, a partial period is discarded.
+        """
+        if (target_temp <= 0. or target_temp != self.target
+                or abs(target_temp - temp) > self.band
+                or not self.amplitude <= duty <= max_duty - self.amplitude):
+            self.target = target_temp
+            self.steady_since = None
+            if self.active:
+                self.active = False
+                logging.info("ApeControl: perturbation identification paused after %d periods",
+                             self.periods)
+            return 0.
+        if self.steady_since is None:
+            self.steady_since = read_time
+        if not self.active:
+            if read_time - self.steady_since < self.settle_time:
+                return 0.
+            self._start_period(read_time, temp)
+            self.active = True
+        bit = int((read_time - self.period_start) / self.bit_time) % PRBS_BITS
+        return self.amplitude * PRBS[bit]
+
+    def record(self, read_time, temp, power, ambient_transfer, net_power=None, loss=None):
+        """Power [W] applied from read_time on, after the output was set
+
+        ambient_transfer is the model's current (fan dependent) value. For the
+        power balance net_power is the heater power less filament losses and
+        loss the ambient loss the model predicts against the ambient sensor
+        per unit of its fan-off ambient_transfer, both None without a sensor.
+        """
+        if not self.active:
+            self.last_time = None
+            return
+        last_time = self.last_time
+        self.last_time = read_time
+        if last_time is None:
+            self.power0 = power # first update of the period
+        if last_time is None or read_time <= last_time:
+            self._hold(temp, power, ambient_transfer, net_power, loss)
+            return
+        boundary = self.period_start + self.period
+        if read_time >= boundary:
+            # Split the interval at the period boundary
+            temp_b = (self.last_temp + (temp - self.last_temp)
+                      * (boundary - last_time) / (read_time - last_time))
+            self._integrate(last_time, self.last_temp, boundary, temp_b)
+            self._end_period(temp_b)
+            self._start_period(boundary, temp_b)
+            last_time = boundary
+            self.last_temp = temp_b
+        self._integrate(last_time, self.last_temp, read_time, temp)
+        self._hold(temp, power, ambient_transfer, net_power, loss)
+
+    def _hold(self, temp, power, ambient_transfer, net_power, loss):
+        self.last_temp = temp
+        self.last_power = power
+        self.ambient_transfer = ambient_transfer
+        self.last_net = net_power
+        self.last_loss = loss
+
+    def _start_period(self, start, temp):
+        self.period_start = start
+        self.temp0 = temp
+        self.power0 = self.last_power
+        sums = self.sums
+        for i in range(4 * HARMONICS):
+            sums[i] = 0.
+        self.net_energy = self.loss_energy = 0.
+
+    def _integrate(self, t1, temp1, t2, temp2):
+        """Fourier sums of the interval, power held, temperature trapezoidal"""
+        dt = t2 - t1
+        theta = self.omega * (.5 * (t1 + t2) - self.period_start)
+        cos1 = math.cos(theta)
+        sin1 = math.sin(theta)
+        temp = (.5 * (temp1 + temp2) - self.temp0) * dt
+        power = (self.last_power - self.power0) * dt
+        # cos(m theta), sin(m theta) by rotation
+        c, s = cos1, sin1
+        sums = self.sums
+        for i in range(0, 4 * HARMONICS, 4):
+            sums[i] += temp * c
+            sums[i + 1] -= temp * s
+            sums[i + 2] += power * c
+            sums[i + 3] -= power * s
+            c, s = c * cos1 - s * sin1, s * cos1 + c * sin1
+        if self.last_net is not None and self.last_loss is not None:
+            self.net_energy += self.last_net * dt
+            self.loss_energy += self.last_loss * dt
+
+    def _end_period(self, temp_end):
+        # The transform of a linear trend over a whole period is j * rise / w
+        temp_rise = temp_end - self.temp0
+        power_rise = self.last_power - self.power0
+        sums = self.sums
+        batch_sums = self.batch_sums
+        for m in range(1, HARMONICS + 1):
+            i = 4 * (m - 1)
+            w = m * self.omega
+            batch_sums[i] += sums[i]
+            batch_sums[i + 1] += sums[i + 1] - temp_rise / w
+            batch_sums[i + 2] += sums[i + 2]
+            batch_sums[i + 3] += sums[i + 3] - power_rise / w
+        self.batch_net += self.net_energy
+        self.batch_loss += self.loss_energy
+        self.periods += 1
+        self.batch_periods += 1
+        if self.batch_periods >= self.batch:
+            self._fit()
+            for i in range(4 * HARMONICS):
+                batch_sums[i] = 0.
+            self.batch_periods = 0
+            self.batch_net = self.batch_loss = 0.
+
+    def _fit(self):
+        """Block heat capacity and sensor responsiveness from the batch's response"""
+        # Weighted least squares of Re(1/G) and Im(1/G)/w against w^2, weights |P|^2
+        s0 = s1 = s2 = re0 = re1 = im0 = im1 = 0.
+        sums = self.batch_sums
+        for m in range(1, HARMONICS + 1):
+            i = 4 * (m - 1)
+            yr, yi, ur, ui = sums[i], sums[i + 1], sums[i + 2], sums[i + 3]
+            y2 = yr * yr + yi * yi
+            if not y2:
+                return
+            w = m * self.omega
+            inv_re = (ur * yr + ui * yi) / y2
+            inv_im = (ui * yr - ur * yi) / y2 / w
+            weight = ur * ur + ui * ui
+            x = w * w
+            s0 += weight
+            s1 += weight * x
+            s2 += weight * x * x
+            re0 += weight * inv_re
+            re1 += weight * inv_re * x
+            im0 += weight * inv_im
+            im1 += weight * inv_im * x
+        det = s0 * s2 - s1 * s1
+        if det <= 0.:
+            return
+        lag = -(s0 * re1 - s1 * re0) / det # C / r
+        c_plus = (s2 * im0 - s1 * im1) / det # C + h / r
+        # C + h C / (r C) = c_plus with the model's h, a small correction
+        disc = c_plus * c_plus - 4. * self.ambient_transfer * lag
+        if lag <= 0. or c_plus <= 0. or disc < 0.:
+            logging.info("ApeControl: perturbation identification batch rejected "
+                         "(C/r %.3f, C+h/r %.3f)", lag, c_plus)
+            return
+        heat_capacity = .5 * (c_plus + math.sqrt(disc))
+        self.estimates["block_heat_capacity"].append(heat_capacity)
+        self.estimates["sensor_responsiveness"].append(heat_capacity / lag)
+        if self.batch_loss > 0. and self.batch_net > 0.:
+            self.estimates["ambient_transfer"].append(self.batch_net / self.batch_loss)
+        self.updated = True
+
+    def estimate(self, name):
+        """(mean, relative std of the mean, batches), None without estimates"""
+        values = self.estimates[name]
+        n = len(values)
+        if not n:
+            return None
+        mean = sum(values) / n
+        if n < 2 or mean <= 0.:
+            return mean, float('inf'), n
+        var = sum((v - mean) ** 2 for v in values) / (n - 1)
+        return mean, math.sqrt(var / n) / mean, n
+
+    def confident_value(self, name):
+        """Mean estimate once it is confident enough to apply, else None"""
+        est = self.estimate(name)
+        if est is None or not self.confidence:
+            return None
+        mean, rel_std, n = est
+        if n < MIN_ESTIMATES or rel_std > self.confidence:
+            return None
+        return mean
+
+    def get_status(self):
+        status = {"active": self.active, "periods": self.periods}
+        for name in PARAMS:
+            est = self.estimate(name)
+            status[name] = est[0] if est is not None else None
+            status[name + "_rel_std"] = est[1] if est is not None else None
+        return status
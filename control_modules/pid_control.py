@@ -6,8 +6,9 @@
 # Modifications for ApeControl compatiblity: Molomono
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging
-from .base_controller import BaseController
+import logging, bisect
+from .base_controller import BaseController, clamp
+from .signal_filter import TempFilter
 
 PID_PARAM_BASE = 255.
 AMBIENT_TEMP = 25.
@@ -16,8 +17,8 @@ PID_SETTLE_DELTA = 1.
 PID_SETTLE_SLOPE = .1
 
 class PIDControl(BaseController):
-    def __init__(self, config):
-        super().__init__(config)
+    def __init__(self, config, embedded=False):
+        super().__init__(config, embedded)
         # Hardcoded Params
         self.algo_name = "PID-Control"
         
@@ -26,6 +27,7 @@ class PIDControl(BaseController):
         self.Ki = config.getfloat('pid_Ki', 0.0) / PID_PARAM_BASE
         self.Kd = config.getfloat('pid_Kd', 0.0) / PID_PARAM_BASE
         self.min_deriv_time = config.getfloat('pid_deriv_time', 2., above=0.)
+        self.temp_filter = TempFilter(config, self.min_deriv_time)
         self.temp_integ_max = 0.
         
         if self.Ki:
@@ -35,18 +37,56 @@ class PIDControl(BaseController):
         self.prev_temp_deriv = 0.
         self.prev_temp_integ = 0.
 
-    def temperature_update(self, read_time, temp, target_temp):
-        time_diff = read_time - self.prev_temp_time
-        temp_diff = temp - self.prev_temp
-        if time_diff >= self.min_deriv_time:
-            temp_deriv = temp_diff / time_diff
+        # Optional FOPDT model (as written by PP_CALIBRATE), only used by the health monitor
+        tau = config.getfloat('tau', 0., minval=0.)
+        k_ss = config.getfloat('k_ss', 0., minval=0.)
+        self.model = None
+        if tau and k_ss:
+            self.model = (tau, config.getfloat('dead_time', 0., minval=0.), lambda power: power / k_ss)
+
+        # Optional gain schedule, gains interpolated over the target temperature
+        self.gain_schedule = None
+        self.scheduled_target = None
+        table_temps = config.getfloatlist('pid_table_temps', [])
+        if table_temps:
+            self.gain_schedule = GainSchedule(
+                config, table_temps,
+                config.getfloatlist('pid_table_kp'),
+                config.getfloatlist('pid_table_ki'),
+                config.getfloatlist('pid_table_kd'))
+
+    def set_gains(self, Kp, Ki, Kd):
+        """Swap gains (in PID_PARAM_BASE units) without bumping the output"""
+        Ki = Ki / PID_PARAM_BASE
+        # Keep the integral contribution Ki * integ constant
+        if Ki:
+            self.prev_temp_integ *= self.Ki / Ki
         else:
-            temp_deriv = (self.prev_temp_deriv * (self.min_deriv_time - time_diff) + temp_diff) / self.min_deriv_time
+            self.prev_temp_integ = 0.
+        self.Kp = Kp / PID_PARAM_BASE
+        self.Ki = Ki
+        self.Kd = Kd / PID_PARAM_BASE
+        self.temp_integ_max = 0.
+        if self.Ki:
+            self.temp_integ_max = self.heater_max_power / self.Ki
+        self.prev_temp_integ = max(0., min(self.temp_integ_max, self.prev_temp_integ))
+
+    def control_update(self, read_time, temp, target_temp):
+        if self.gain_schedule is not None and target_temp != self.scheduled_target:
+            # Only re-evaluated on a target change, never per update
+            self.scheduled_target = target_temp
+            self.set_gains(*self.gain_schedule.lookup(target_temp))
+        time_diff = read_time - self.prev_temp_time
+        temp = self.temp_filter.update(read_time, temp)
+        temp_deriv = self.temp_filter.deriv
         temp_err = target_temp - temp
-        temp_integ = self.prev_temp_integ + temp_err * time_diff
-        temp_integ = max(0., min(self.temp_integ_max, temp_integ))
+        temp_integ = self.prev_temp_integ
+        if not self.setpoint_ramping:
+            # Tracking a shaped setpoint lags by design, integrating that lag overshoots the target
+            temp_integ += temp_err * time_diff
+        temp_integ = clamp(temp_integ, 0., self.temp_integ_max)
         self.co = self.Kp * temp_err + self.Ki * temp_integ - self.Kd * temp_deriv
-        bounded_co = max(0., min(self.heater_max_power, self.co))
+        bounded_co = clamp(self.co, 0., self.heater_max_power)
         # Set PWM output (assumes heater object is accessible via self.printer)
         self.set_pwm(read_time, bounded_co)
         # optional self.heater.set_pwm(read_time, bounded_co)
@@ -61,5 +101,66 @@ class PIDControl(BaseController):
         return (abs(temp_diff) > PID_SETTLE_DELTA
                 or abs(self.prev_temp_deriv) > PID_SETTLE_SLOPE)
 
-    def set_pwm(self, read_time, value):
-        self.heater.set_pwm(read_time, value)
+    def heat_model(self):
+        return self.model
+
+    def export_state(self):
+        state = super().export_state()
+        state.update({"temp": self.prev_temp, "time": self.prev_temp_time,
+                      "temp_deriv": self.prev_temp_deriv})
+        return state
+
+    def import_state(self, state):
+        super().import_state(state)
+        if "time" not in state:
+            return
+        target = state["target"]
+        if self.gain_schedule is not None:
+            self.scheduled_target = target
+            self.set_gains(*self.gain_schedule.lookup(target))
+        self.prev_temp = state["temp"]
+        self.prev_temp_time = state["time"]
+        self.prev_temp_deriv = state.get("temp_deriv", 0.)
+        self.temp_filter.reset(self.prev_temp_time, self.prev_temp, self.prev_temp_deriv)
+        # Integrator that reproduces the previous output at the current error
+        if self.Ki:
+            temp_err = target - self.prev_temp
+            integ = (state.get("output", 0.) - self.Kp * temp_err
+                     + self.Kd * self.prev_temp_deriv) / self.Ki
+            self.prev_temp_integ = max(0., min(self.temp_integ_max, integ))
+
+
+class GainSchedule:
+    """Piecewise linear PID gains over target temperature
+
+    The table is converted into (offset, slope) segments once, a lookup is a
+    bisect plus three multiply-adds. Targets outside the table are clamped to
+    the first/last entry.
+    """
+    def __init__(self, config, temps, kps, kis, kds):
+        if not (len(temps) == len(kps) == len(kis) == len(kds)):
+            raise config.error(
+                "pid_table_temps, pid_table_kp, pid_table_ki and pid_table_kd "
+                "must have the same length in section '%s'" % (config.get_name(),))
+        rows = sorted(zip(temps, kps, kis, kds))
+        self.temps = [row[0] for row in rows]
+        if len(set(self.temps)) != len(self.temps):
+            raise config.error("pid_table_temps contains duplicate temperatures "
+                               "in section '%s'" % (config.get_name(),))
+        self.segments = []
+        for lo, hi in zip(rows, rows[1:]):
+            span = hi[0] - lo[0]
+            self.segments.append((lo[0],
+                                  tuple(lo[i] for i in (1, 2, 3)),
+                                  tuple((hi[i] - lo[i]) / span for i in (1, 2, 3))))
+        self.first = tuple(rows[0][1:])
+        self.last = tuple(rows[-1][1:])
+
+    def lookup(self, target_temp):
+        if target_temp <= self.temps[0] or not self.segments:
+            return self.first
+        if target_temp >= self.temps[-1]:
+            return self.last
+        t0, gains, slopes = self.segments[bisect.bisect_right(self.temps, target_temp) - 1]
+        dt = target_temp - t0
+        return tuple(g + s * dt for g, s in zip(gains, slopes))
@@ -0,0 +1,279 @@
+# ApeControl-Klipper composable feed-forward + feedback pipeline
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Feed-forward sources, a feedback law and output stages are picked in
+# printer.cfg. When the printer is ready the selection is generated into a
+# single tick function: only the enabled terms are emitted, constants and
+# bound methods are closure variables and all state lives in closure cells,
+# so an update has no dispatch, dict lookups on self or per term calls.
+import logging
+from .base_controller import BaseController
+
+AMBIENT_TEMP = 25.
+SETTLE_DELTA = 1.
+SETTLE_SLOPE = .1
+PID_PARAM_BASE = 255.
+EV_SMOOTHING_PERIOD = 0.3 # [s] update period ev_smoothing is specified for
+
+FEEDFORWARD_SOURCES = ('steady_state', 'fan', 'extrusion', 'first_layer')
+FEEDBACK_LAWS = {'pid': 'pid', 'mpc': 'mpc', 'none': 'none'}
+OUTPUT_STAGES = ('slew',)
+
+
+class PipelineControl(BaseController):
+    def __init__(self, config):
+        super().__init__(config)
+        self.algo_name = "Pipeline-Control"
+        name = config.get_name()
+        self.sources = config.getlist('feedforward', ['steady_state'])
+        self.feedback = config.getchoice('feedback', FEEDBACK_LAWS, 'pid')
+        self.stages = config.getlist('output', [])
+        for source in self.sources:
+            if source not in FEEDFORWARD_SOURCES:
+                raise config.error("Unknown feedforward source '%s' in section '%s', choose from %s"
+                                   % (source, name, ", ".join(FEEDFORWARD_SOURCES)))
+        for stage in self.stages:
+            if stage not in OUTPUT_STAGES:
+                raise config.error("Unknown output stage '%s' in section '%s', choose from %s"
+                                   % (stage, name, ", ".join(OUTPUT_STAGES)))
+        if 'first_layer' in self.sources and 'steady_state' not in self.sources:
+            raise config.error("feedforward 'first_layer' lowers the steady_state reference, "
+                               "add 'steady_state' in section '%s'" % (name,))
+        if self.feedback == 'mpc':
+            # Loads the MPC model compensates itself would be counted twice
+            modeled = ['steady_state', 'extrusion']
+            if config.get('cooling_fan', None) is not None:
+                modeled.append('fan')
+            doubled = [source for source in self.sources if source in modeled]
+            if doubled:
+                raise config.error("feedback 'mpc' already models %s, remove the feedforward "
+                                   "in section '%s'" % (", ".join(doubled), name))
+
+        # Feed-forward constants, same meaning as in pp_control
+        self.k_ss = config.getfloat('k_ss', 0., minval=0.)
+        self.ss_map = config.getfloatlist('ss_map', [])
+        self.ss_map_ambient = config.getfloat('ss_map_ambient', AMBIENT_TEMP)
+        if 'steady_state' in self.sources and not (self.k_ss or self.ss_map):
+            raise config.error("feedforward 'steady_state' requires 'k_ss' or 'ss_map' "
+                               "in section '%s'" % (name,))
+        self.k_fan = config.getfloat('k_fan', 0.)
+        self.fan_lookahead = config.getfloat('fan_lookahead', 0., minval=0.)
+        self.k_ev = config.getfloat('k_ev', 0.)
+        self.ev_smoothing = config.getfloat('ev_smoothing', 0.075, above=0., maxval=1.)
+        self.dt_first_layer = config.getfloat('dt_first_layer', 1.5)
+        self.first_layer_height = config.getfloat('first_layer_height', 0.3, above=0.)
+        self.slew_rate = config.getfloat('output_slew_rate', 1., above=0.) # [pwm/s]
+
+        # Feedback
+        self.Kp = config.getfloat('pid_Kp', 0.) / PID_PARAM_BASE
+        self.Ki = config.getfloat('pid_Ki', 0.) / PID_PARAM_BASE
+        self.Kd = config.getfloat('pid_Kd', 0.) / PID_PARAM_BASE
+        self.min_deriv_time = config.getfloat('pid_deriv_time', 2., above=0.)
+        self.fb_controller = None
+        if self.feedback == 'mpc':
+            from .mpc_control import ControlMPC
+            self.fb_controller = ControlMPC(config, register=False, embedded=True)
+
+        # Optional FOPDT model for the health monitor, as with pid_control
+        self.tau = config.getfloat('tau', 0., minval=0.)
+        self.dead_time = config.getfloat('dead_time', 0., minval=0.)
+
+        self.tick = None
+        self._get_state = None
+        self._set_state = None
+
+    def handle_ready(self):
+        super().handle_ready()
+        if self.fb_controller is not None:
+            self.fb_controller.post_init()
+        self.tick, self._get_state, self._set_state = self._compile()
+
+    # Pipeline generation
+    def _compile(self):
+        """Generate the tick function of the configured pipeline"""
+        sources = self.sources
+        consts = {
+            'MAX_POWER': self.heater_max_power,
+            'DERIV_TIME': self.min_deriv_time,
+        }
+        body = []
+        emit = body.append
+        if 'steady_state' in sources:
+            emit("ref = target_temp")
+            if 'first_layer' in sources:
+                consts.update(gcode_move_status=self.gcode_move.get_status,
+                              FIRST_LAYER_HEIGHT=self.first_layer_height,
+                              DT_FIRST_LAYER=self.dt_first_layer)
+                emit("if gcode_move_status()['position'][2] < FIRST_LAYER_HEIGHT:")
+                emit("    ref = target_temp - DT_FIRST_LAYER")
+            if self.ss_map:
+                consts['ss_map_eval'] = self._ss_map_eval
+                if self.ambient is not None:
+                    consts['ambient_service'] = self.ambient
+                    emit("amb = ambient_service.temp")
+                else:
+                    consts['SS_AMBIENT'] = self.ss_map_ambient
+                    emit("amb = SS_AMBIENT")
+                # Only re-evaluated when the reference or the ambient moves
+                emit("if ref != ss_ref or amb != ss_amb:")
+                emit("    ss_ref = ref")
+                emit("    ss_amb = amb")
+                emit("    ss_power = max(0., ss_map_eval(ref - amb))")
+                emit("u += ss_power")
+            else:
+                consts['K_SS'] = self.k_ss
+                emit("u += ref * K_SS")
+        if 'fan' in sources:
+            consts.update(fan_status=self.part_fan.get_status, K_FAN=self.k_fan)
+            emit("fan_speed = fan_status(read_time)['speed']")
+            if self.fan_lookahead and self.lookahead is not None:
+                consts.update(lookahead_fan=self.lookahead.get_fan_speed,
+                              FAN_LOOKAHEAD=self.fan_lookahead)
+                emit("fan_speed = lookahead_fan(read_time + FAN_LOOKAHEAD, fan_speed)")
+            emit("u += fan_speed * K_FAN")
+        if 'extrusion' in sources:
+            motion_report = self.printer.lookup_object('motion_report')
+            consts.update(motion_status=motion_report.get_status, K_EV=self.k_ev,
+                          EV_KEEP=1. - self.ev_smoothing, EV_PERIOD=EV_SMOOTHING_PERIOD)
+            emit("if dt > 0.:")
+            emit("    ev += ((1. - EV_KEEP ** (dt / EV_PERIOD))")
+            emit("           * (motion_status(read_time)['live_extruder_velocity'] - ev))")
+            emit("    if ev < 0.:")
+            emit("        ev = 0.")
+            emit("u += ev * K_EV")
+        pid = self.feedback == 'pid'
+        if pid:
+            integ_max = self.heater_max_power / self.Ki if self.Ki else 0.
+            # With a feed-forward the feedback also has to take power away
+            consts.update(KP=self.Kp, KI=self.Ki, KD=self.Kd, INTEG_MAX=integ_max,
+                          INTEG_MIN=-integ_max if sources else 0., controller=self)
+            emit("err = target_temp - temp")
+            emit("new_integ = integ")
+            # Tracking a shaped setpoint lags by design, as in pid_control
+            emit("if not controller.setpoint_ramping:")
+            emit("    new_integ += err * dt")
+            emit("if new_integ > INTEG_MAX:")
+            emit("    new_integ = INTEG_MAX")
+            emit("elif new_integ < INTEG_MIN:")
+            emit("    new_integ = INTEG_MIN")
+            emit("u += KP * err + KI * new_integ - KD * deriv")
+        elif self.feedback == 'mpc':
+            consts.update(fb_update=self.fb_controller.control_update, fb=self.fb_controller)
+            emit("fb_update(read_time, temp, target_temp)")
+            emit("u += fb.last_pwm")
+        if 'slew' in self.stages:
+            consts['SLEW_RATE'] = self.slew_rate
+            emit("step = SLEW_RATE * dt")
+            emit("if u > last_out + step:")
+            emit("    u = last_out + step")
+            emit("elif u < last_out - step:")
+            emit("    u = last_out - step")
+        emit("out = MAX_POWER if u > MAX_POWER else 0. if u < 0. else u")
+        if pid:
+            emit("if out == u:") # anti windup
+            emit("    integ = new_integ")
+        emit("last_out = out")
+        emit("return out")
+
+        state = "prev_temp, prev_time, prev_deriv, integ, ev, ss_ref, ss_amb, ss_power, last_out"
+        src = [
+            "def make(%s):" % (", ".join(sorted(consts)),),
+            "    prev_temp = %r" % (AMBIENT_TEMP,),
+            "    prev_time = prev_deriv = integ = ev = ss_power = last_out = 0.",
+            "    ss_ref = ss_amb = None",
+            "    def tick(read_time, temp, target_temp):",
+            "        nonlocal %s" % (state,),
+            "        dt = read_time - prev_time",
+            "        temp_diff = temp - prev_temp",
+            "        if dt >= DERIV_TIME:",
+            "            deriv = temp_diff / dt",
+            "        else:",
+            "            deriv = (prev_deriv * (DERIV_TIME - dt) + temp_diff) / DERIV_TIME",
+            "        prev_temp = temp",
+            "        prev_time = read_time",
+            "        prev_deriv = deriv",
+            "        if target_temp <= 0.:",
+            "            integ = last_out = 0.",
+            "            return 0.",
+            "        u = 0.",
+        ] + ["        " + line for line in body] + [
+            "    def get_state():",
+            "        return prev_temp, prev_time, prev_deriv, integ, last_out",
+            "    def set_state(temp, time, temp_deriv, temp_integ, output):",
+            "        nonlocal %s" % (state,),
+            "        prev_temp, prev_time, prev_deriv = temp, time, temp_deriv",
+            "        integ, last_out = temp_integ, output",
+            "    return tick, get_state, set_state",
+        ]
+        namespace = {}
+        exec(compile("\n".join(src) + "\n", "<%s pipeline>" % (self.heater_name,), "exec"),
+             namespace)
+        logging.info("ApeControl: %s pipeline: feedforward %s, feedback %s, output %s",
+                     self.heater_name, sources, self.feedback, self.stages + ['clamp'])
+        return namespace['make'](**consts)
+
+    # Control interface
+    def control_update(self, read_time, temp, target_temp):
+        self.target_temp = target_temp
+        self.set_pwm(read_time, self.tick(read_time, temp, target_temp))
+
+    def check_busy(self, eventtime, smoothed_temp, target_temp):
+        temp_diff = target_temp - smoothed_temp
+        return (abs(temp_diff) > SETTLE_DELTA
+                or abs(self._get_state()[2]) > SETTLE_SLOPE)
+
+    def get_status(self, eventtime):
+        return {
+            "feedforward": self.sources,
+            "feedback": self.feedback,
+            "output": self.stages,
+        }
+
+    def heat_model(self):
+        if self.feedback == 'mpc':
+            return None
+        if not (self.tau and self.k_ss):
+            return None
+        k_ss = self.k_ss
+        return (self.tau, self.dead_time, lambda power: power / k_ss)
+
+    def export_state(self):
+        state = super().export_state()
+        temp, time, deriv, _, _ = self._get_state()
+        state.update({"temp": temp, "time": time, "temp_deriv": deriv})
+        return state
+
+    def import_state(self, state):
+        super().import_state(state)
+        if "time" not in state:
+            return
+        if self.fb_controller is not None:
+            self.fb_controller.import_state(state)
+        output = state.get("output", 0.)
+        integ = 0.
+        if self.feedback == 'pid' and self.Ki:
+            # Integrator that reproduces the previous output next to the steady state feed-forward
+            target = state["target"]
+            temp_err = target - state["temp"]
+            ff = self._steady_state_power(target) if 'steady_state' in self.sources else 0.
+            integ = (output - ff - self.Kp * temp_err
+                     + self.Kd * state.get("temp_deriv", 0.)) / self.Ki
+            integ_max = self.heater_max_power / self.Ki
+            integ = max(-integ_max if self.sources else 0., min(integ_max, integ))
+        self._set_state(state["temp"], state["time"], state.get("temp_deriv", 0.), integ, output)
+
+    # Steady-state helpers, outside the tick
+    def _steady_state_power(self, temp):
+        if self.ss_map:
+            ambient = self.ambient.temp if self.ambient is not None else self.ss_map_ambient
+            return max(0., self._ss_map_eval(temp - ambient))
+        return temp * self.k_ss
+
+    def _ss_map_eval(self, rise):
+        power = 0.
+        for coeff in reversed(self.ss_map):
+            power = (power + coeff) * rise
+        return power
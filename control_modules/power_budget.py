@@ -0,0 +1,97 @@
+# ApeControl-Klipper shared power budget arbiter
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Every ApeControl controller with a known heater wattage reports the power
+# it requests, the arbiter grants at most 'power_budget' watts in total.
+# Heaters are served in order of their remaining heat-up time, the heater on
+# the critical path to the start of the job gets power first.
+#
+# Requests come from the heaters' sensor callbacks, which run on the MCU
+# threads while holding their heater's lock. The arbiter therefore never asks
+# a heater for its temperature, each controller notes its readings on its
+# slot, and requests are serialized by the arbiter's own lock.
+import logging, threading
+
+DEFAULT_DEG_TIME = 1.0 # [s/degC] remaining time proxy for heaters without a model
+
+
+class PowerSlot:
+    """Book keeping of one heater, requested/granted power in watts"""
+    def __init__(self, budget, name, watts, controller):
+        self.budget = budget
+        self.name = name
+        self.watts = watts
+        self.controller = controller
+        self.requested = 0.
+        self.reserved = 0.
+        self.granted = 0.
+        self.remaining_time = 0.
+        self.temp = self.target = 0. # last sensor reading, noted by the controller
+
+    def note(self, temp, target):
+        self.temp = temp
+        self.target = target
+
+    def get_status(self):
+        return {
+            "power_requested": self.requested,
+            "power_granted": self.granted,
+            "remaining_heat_time": self.remaining_time,
+        }
+
+
+class PowerBudget:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.budget = config.getfloat('power_budget', above=0.)
+        self.slots = {}
+        self.order = [] # slots sorted by priority, replaced on every request
+        self.lock = threading.Lock()
+
+    def register(self, name, watts, controller):
+        slot = self.slots.get(name)
+        if slot is None:
+            slot = self.slots[name] = PowerSlot(self, name, watts, controller)
+            with self.lock:
+                self.order = self.order + [slot]
+            logging.info("ApeControl: %s (%.0fW) added to the %.0fW power budget",
+                         name, watts, self.budget)
+        slot.controller = controller
+        return slot
+
+    def _remaining_time(self, slot):
+        temp, target = slot.temp, slot.target
+        if target <= temp:
+            return 0.
+        heat_time = slot.controller.estimate_heat_time(temp, target)
+        if heat_time is None:
+            heat_time = (target - temp) * DEFAULT_DEG_TIME
+        return heat_time
+
+    def request(self, slot, eventtime, duty):
+        """Returns the granted duty for a requested duty of slot"""
+        with self.lock:
+            slot.requested = duty * slot.watts
+            # Water fill the budget over the latest requests, longest heat-up first
+            for other in self.order:
+                other.remaining_time = self._remaining_time(other)
+            order = self.order = sorted(self.order, key=lambda s: -s.remaining_time)
+            left = self.budget
+            for other in order:
+                other.reserved = min(other.requested, left)
+                left -= other.reserved
+            # Never exceed the budget with what the others currently draw, they
+            # move to their own reservation on their next update
+            others = sum(other.granted for other in order if other is not slot)
+            slot.granted = max(0., min(slot.reserved, self.budget - others))
+            return slot.granted / slot.watts
+
+    def get_status(self, eventtime):
+        return {
+            "budget": self.budget,
+            "allocated": sum(slot.granted for slot in self.order),
+            "heaters": {slot.name: slot.get_status() for slot in self.order},
+        }
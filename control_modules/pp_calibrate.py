@@ -7,6 +7,9 @@
 import math, logging
 import logging
 from types import SimpleNamespace
+from .trace_export import TraceWriter, trace_filename
+from .profiles import profile_section
+from .calibration_checkpoint import CalibrationCheckpoint
 
 PARAM_BASE = 255.
 TEMP_AMBIENT = 20.
@@ -15,6 +18,7 @@ class PPCalibrate:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.heater_name = config.get_name().split()[-1] # (heater) name
+        self.trace_dir = config.get('trace_dir', '/tmp')
         #gcode = self.printer.lookup_object('gcode')
         #gcode.register_command('PP_CALIBRATE', self.cmd_PP_CALIBRATE, # might need to change this to a mux function later
         #                       desc=self.cmd_PP_CALIBRATE_help)
@@ -35,7 +39,17 @@ class PPCalibrate:
         # Target temperature and command arguments
         heater_name = gcmd.get('HEATER')
         target = gcmd.get_float('TARGET')
-        write_file = gcmd.get_int('WRITE_FILE', 0)
+        write_file = gcmd.get_int('WRITE_FILE', 0, minval=0, maxval=2) # 1: trace, 2: trace and csv
+        sweep = gcmd.get('SWEEP', None)
+        ss_map = gcmd.get_int('SS_MAP', 0)
+        ambient = gcmd.get_float('AMBIENT', TEMP_AMBIENT)
+        profile = gcmd.get('PROFILE', None) # store the results as a named profile
+        if sweep is not None:
+            try:
+                sweep_targets = sorted(float(t) for t in sweep.split(',') if t.strip())
+            except ValueError:
+                raise gcmd.error("Unable to parse SWEEP '%s', must be a comma separated "
+                                 "list of temperatures ('180,230,280')" % (sweep,))
         # Load objects
         pheaters = self.printer.lookup_object('heaters')
         try:
@@ -44,34 +58,29 @@ class PPCalibrate:
             raise gcmd.error(str(e))
         self.printer.lookup_object('toolhead').get_last_move_time()
 
+        # Every completed test is checkpointed, RESUME=1 skips them after an interruption
+        checkpoint = CalibrationCheckpoint(
+            self.trace_dir, heater_name, "pp_calibrate",
+            {"target": target, "sweep": sweep, "ss_map": ss_map, "ambient": ambient})
+        if gcmd.get_int('RESUME', 0, minval=0, maxval=1):
+            reason = checkpoint.resume()
+            if reason is None:
+                gcmd.respond_info("Resuming PP calibration, completed: %s"
+                                  % (", ".join(sorted(checkpoint.phases)),))
+            else:
+                gcmd.respond_info("Not resuming, %s" % (reason,))
+
         # Create a new instance of the AutoTune class.
-        
-        calibrate = ControlAutoTune(heater, target)
-        old_control = heater.set_control(calibrate)
-        logging.info("ApeControl: Heater object '%s' controller exchanged with %s algorithm", heater_name, calibrate.algo_name)
-        try:
-            pheaters.set_temperature(heater, target, True)
-        except self.printer.command_error as e:
-            heater.set_control(old_control)
-            raise
-        heater.set_control(old_control) # Restore actual controller after calibration test
-        logging.info("ApeControl: Heater object '%s' controller has been restored to %s", heater_name, old_control.algo_name)
-        if write_file:
-            calibrate.write_file('/tmp/heattest.txt')
-        if calibrate.check_busy(0., 0., 0.):
-            raise gcmd.error("%s interrupted"%(calibrate.algo_name))
-        
+        algo_name, res = self.relay_test(gcmd, pheaters, heater, target, write_file, checkpoint)
+
         ########## Actual calibraiton logic, data has been collected in ControlAutoTune lists.
         # Log and report results
-        Kss,Ku,Tu,tau,L,omega_u, t_overshoot_up, t_overshoot_down, coast_time_up, coast_time_down, pid_kp, pid_ki, pid_kd = calibrate.calc_final_fowdt()
+        Kss,Ku,Tu,tau,L,omega_u, t_overshoot_up, t_overshoot_down, coast_time_up, coast_time_down, pid_kp, pid_ki, pid_kd = res
         #Kp, Ki, Kd = calibrate.calc_final_pid()
-        autotune_report = "%s: Kss=%.6f,Ku=%.3f,Tu=%.3f,omega_u=%.3f,tau=%.3f,L=%.3f" % (calibrate.algo_name, Kss,Ku,Tu,omega_u,tau,L)
+        autotune_report = "%s: Kss=%.6f,Ku=%.3f,Tu=%.3f,omega_u=%.3f,tau=%.3f,L=%.3f" % (algo_name, Kss,Ku,Tu,omega_u,tau,L)
         logging.info(autotune_report)
-        
-        ######## Test for passing config variables as a dict, --> To implement DRY of configfile update/saving function
-        logging.info("%s: ConfigVarsDict = %s", calibrate.algo_name, vars(calibrate.configvars))
 
-        autotune_report_pid = "%s: AMIGO-PID values Kp=%.3f, Ki=%.3f, Kd=%.3f" % (calibrate.algo_name, pid_kp, pid_ki, pid_kd)
+        autotune_report_pid = "%s: AMIGO-PID values Kp=%.3f, Ki=%.3f, Kd=%.3f" % (algo_name, pid_kp, pid_ki, pid_kd)
         logging.info(autotune_report_pid)
         gcmd.respond_info(
             autotune_report + "\n" + autotune_report_pid + "\n"
@@ -79,7 +88,7 @@ class PPCalibrate:
             "with these parameters and restart the printer.")
         
         # Store results for SAVE_CONFIG
-        cfgname = "ape_control " + heater.get_name() # [ape_control heater_name]
+        cfgname = profile_section(heater.get_name(), profile) # [ape_control heater_name] or its profile
         configfile = self.printer.lookup_object('configfile')
         configfile.set(cfgname, 'control', 'pp_control')
         configfile.set(cfgname, 'K_ss', "%.6f" % (Kss,))
@@ -88,36 +97,87 @@ class PPCalibrate:
         configfile.set(cfgname, 't_overshoot_down', "%.3f" % (t_overshoot_down,))
         configfile.set(cfgname, 'coast_time_down', "%.3f" % (coast_time_down  - L/3,))
         configfile.set(cfgname, 'min_duration', "%.3f" % (L,) )
+        # FOPDT model used by model_switching
+        configfile.set(cfgname, 'tau', "%.3f" % (tau,) )
+        configfile.set(cfgname, 'dead_time', "%.3f" % (L,) )
         
         configfile.set(cfgname, 'fb_enable', "True")
         configfile.set(cfgname, 'pid_kp', "%.3f" % (pid_kp,) )
         configfile.set(cfgname, 'pid_ki', "%.3f" % (pid_ki,) )
         configfile.set(cfgname, 'pid_kd', "%.3f" % (pid_kd,) )
 
-        ######## SteadyState Calibration sequence
-        ### WIP ....
-        #self.run_autotune(calibrate,configvars=None)
-        #calibrate = SSAutoTune(heater, target, Kss)
-        #old_control = heater.set_control(calibrate)
-        #logging.info("ApeControl: Heater object '%s' controller exchanged with %s algorithm", heater_name, calibrate.algo_name)
-        #try:
-        #    pheaters.set_temperature(heater, target)
-        #except self.printer.command_error as e:
-        #    heater.set_control(old_control)
-        #    raise
-        #heater.set_control(old_control) # Restore actual controller after calibration test
-        #logging.info("ApeControl: Heater object '%s' controller has been restored to %s", heater_name, old_control.algo_name)
-        #if write_file:
-        #    calibrate.write_file('/tmp/heattest.txt')
-        #if calibrate.check_busy(0., 0., 0.):
-        #    raise gcmd.error("%s interrupted"%(calibrate.algo_name))
-        
-        #self.save_results(cfgname, vars(calibrate.configvars))
-        # Can make the following a function
-        # Args: AutoTuneClass, heater, target
-        # TODO: return dict with tuned vars and values. {'Kss': 0.001, "t_overshoot_up": ..., etc} 
-        # Add self.store_results(cfgname, tuned_var_dict)
-        # load configfile and save dict contents.
+        # Gain schedule, repeat the test at every SWEEP target
+        all_targets = [target]
+        if sweep is not None:
+            all_targets = sorted(set(all_targets + sweep_targets))
+            gain_table = [(target, pid_kp, pid_ki, pid_kd)]
+            for sweep_target in sweep_targets:
+                if sweep_target == target:
+                    continue
+                _, res = self.relay_test(gcmd, pheaters, heater, sweep_target, write_file, checkpoint)
+                gain_table.append((sweep_target, res[-3], res[-2], res[-1]))
+            self.save_gain_table(gcmd, cfgname, sorted(gain_table))
+
+        # Steady-state power map, hold each target and record the pwm
+        if ss_map:
+            calibrate = SSAutoTune(heater, all_targets, Kss, pid_kp, pid_ki, ambient)
+            self.run_autotune(gcmd, pheaters, heater, calibrate, write_file)
+            try:
+                coeffs = calibrate.fit_ss_map()
+            except ValueError as e:
+                raise gcmd.error("%s failed: %s" % (calibrate.algo_name, e))
+            points = ["%.1f: %.4f" % pt for pt in calibrate.steady_points]
+            gcmd.respond_info("Steady-state holding pwm:\n%s\nss_map: %.6g, %.6g (ambient %.1f)"
+                              % ("\n".join(points), coeffs[0], coeffs[1], ambient))
+            configfile.set(cfgname, 'ss_map', "%.6g, %.6g" % (coeffs[0], coeffs[1]))
+            configfile.set(cfgname, 'ss_map_ambient', "%.1f" % (ambient,))
+        checkpoint.remove()
+
+    def relay_test(self, gcmd, pheaters, heater, target, write_file, checkpoint):
+        """FOPDT and AMIGO-PID results of the relay test at target, from the checkpoint if done"""
+        phase = "relay_%.1f" % (target,)
+        res = checkpoint.get(phase)
+        if res is not None:
+            gcmd.respond_info("Relay test at %.1f: from checkpoint" % (target,))
+            return "PP-AutoTune", res
+        calibrate = ControlAutoTune(heater, target)
+        self.run_autotune(gcmd, pheaters, heater, calibrate, write_file)
+        res = calibrate.calc_final_fowdt()
+        logging.info("%s: ConfigVarsDict = %s", calibrate.algo_name, vars(calibrate.configvars))
+        checkpoint.save(phase, list(res))
+        return calibrate.algo_name, res
+
+    def run_autotune(self, gcmd, pheaters, heater, calibrate, write_file=0):
+        """Swap in an AutoTune controller, run it to completion and restore the old controller"""
+        heater_name = heater.get_name()
+        if write_file:
+            filename = trace_filename(self.trace_dir, heater_name, calibrate.algo_name)
+            calibrate.trace = TraceWriter(filename, ('time', 'temp', 'pwm'),
+                                          {'heater': heater_name, 'test': calibrate.algo_name,
+                                           'target': calibrate.target})
+            gcmd.respond_info("Writing trace to %s" % (filename,))
+        old_control = heater.set_control(calibrate)
+        logging.info("ApeControl: Heater object '%s' controller exchanged with %s algorithm", heater_name, calibrate.algo_name)
+        try:
+            pheaters.set_temperature(heater, calibrate.target, True)
+        finally:
+            heater.set_control(old_control) # Restore actual controller after calibration test
+            if calibrate.trace is not None:
+                calibrate.trace.close(csv=write_file == 2)
+        logging.info("ApeControl: Heater object '%s' controller has been restored to %s", heater_name, old_control.algo_name)
+        if calibrate.check_busy(0., 0., 0.):
+            raise gcmd.error("%s interrupted"%(calibrate.algo_name))
+
+    def save_gain_table(self, gcmd, cfgname, gain_table):
+        """Store a (target, Kp, Ki, Kd) table for the PID gain schedule"""
+        lines = ["%.1f: Kp=%.3f, Ki=%.3f, Kd=%.3f" % row for row in gain_table]
+        logging.info("ApeControl: PID gain table %s", lines)
+        gcmd.respond_info("PID gain table:\n" + "\n".join(lines))
+        configfile = self.printer.lookup_object('configfile')
+        for idx, key in enumerate(['pid_table_temps', 'pid_table_kp',
+                                   'pid_table_ki', 'pid_table_kd']):
+            configfile.set(cfgname, key,
+                           ", ".join(["%.3f" % (row[idx],) for row in gain_table]))
 
     def save_results(self, cfgname, tuned_var_dict):
         # Automatically save all variables in passed dictionary
@@ -147,6 +207,7 @@ class ControlAutoTune:
         self.last_pwm = 0.
         self.pwm_samples = []
         self.temp_samples = []
+        self.trace = None # TraceWriter, set by PPCalibrate for WRITE_FILE
 
     # Heater control 
     def set_pwm(self, read_time, value):
@@ -179,6 +240,8 @@ class ControlAutoTune:
             if temp > self.peak:
                 self.peak = temp
                 self.peak_time = read_time
+        if self.trace is not None:
+            self.trace.record(read_time, temp, self.last_pwm)
 
     def check_busy(self, eventtime, smoothed_temp, target_temp):
         if self.heating or len(self.peaks) < 12:
@@ -219,8 +282,7 @@ class ControlAutoTune:
         #TODO: Change the above logic to use:
         #self.pwm_samples = (event_time, value)
         # Load these values self.pwm_samples[pos]
-        logging.info("%s: pwm_samples: %s", self.algo_name, self.pwm_samples)
-        logging.info("%s: peaks: %s", self.algo_name, self.peaks)
+        logging.info("%s: %d pwm switches, peaks: %s", self.algo_name, len(self.pwm_samples), self.peaks)
         # Compute the ratio of on to off time. This is our Kss - sensitivty
         first_peak_temp = self.peaks[2][0]
         first_peak_time = self.peaks[2][1]
@@ -319,14 +381,6 @@ class ControlAutoTune:
 
     
     # Utility Functions
-    def write_file(self, filename):
-        pwm = ["pwm: %.3f %.3f" % (time, value)
-               for time, value in self.pwm_samples]
-        out = ["%.3f %.3f" % (time, temp) for time, temp in self.temp_samples]
-        f = open(filename, "w")
-        f.write('\n'.join(pwm + out))
-        f.close()
-
     def get_avg_temp(self, t_start, t_end):
         # Filter temps within the time range
         temps = [temp for time, temp in self.temp_samples if t_start <= time <= t_end]
@@ -337,31 +391,38 @@ class ControlAutoTune:
 
 
 class SSAutoTune:
-    def __init__(self, heater, target, Kss):
+    """Measure the holding PWM at a list of targets
+
+    Each target is held with the steady-state guess target * Kss plus a small
+    PI correction. Once the temperature sits on the target with a flat slope
+    for min_duration the time averaged PWM is recorded as a steady-state point.
+    """
+    def __init__(self, heater, targets, Kss, pid_kp, pid_ki, ambient=TEMP_AMBIENT):
         self.algo_name = "PP-SS-AutoTune"
         self.configvars = SimpleNamespace()
         self.heater = heater
-        self.target = target # used for Kss computation later
+        self.targets = list(targets)
+        self.target = self.targets[0] # temperature requested when the test is started
+        self.target_idx = 0
         self.heater_max_power = heater.get_max_power()
-        self.calibrate_temp = target
-        # Heating control
-        self.heating = False
-        self.peak = 0.
-        self.peak_time = 0.
-        # Peak recording
-        self.peaks = [] # (temp, time)
+        self.ambient = ambient
         # Sample recording
         self.last_pwm = 0.
         self.pwm_samples = []
         self.temp_samples = []
-        self.prev_temp = 0.
+        self.trace = None # TraceWriter, set by PPCalibrate for WRITE_FILE
         self.Kss = Kss
-        self.min_duration = 10. # 10 seconds at steady state between recomputing Kss value
-        self.slope_threshold = 0.05 # if this is maintained with openloop control we know Kss is acurate at the measured temp
-        self.computed_kss = []
-
+        self.Kp = pid_kp / PARAM_BASE
+        self.Ki = pid_ki / PARAM_BASE
+        self.min_duration = 30. # seconds at steady state before a point is accepted
+        self.slope_threshold = 0.02 # [degC/s] if this is maintained we know the holding PWM at the measured temp
+        self.temp_tolerance = 0.5 # [degC] maximum deviation of the window average from the target
+        self.steady_points = [] # (temp, pwm)
+
+        self.prev_time = None
+        self.temp_integ = 0.
         self.hold_start_time = None
-        self.holding_pwm = False
+        self.pwm_energy = 0. # integral of pwm over the current window
 
     # Heater control 
     def set_pwm(self, read_time, value):
@@ -369,74 +430,101 @@ class SSAutoTune:
             self.pwm_samples.append(
                 (read_time + self.heater.get_pwm_delay(), value))
             self.last_pwm = value
-            self.computed_kss.append((read_time + self.heater.get_pwm_delay(), self.Kss))
         self.heater.set_pwm(read_time, value)
 
     def temperature_update(self, read_time, temp, target_temp):
         self.temp_samples.append((read_time, temp))
-        if not self.holding_pwm:
-            pwm = max(0.0, min(1.0, target_temp * self.Kss))
-            self.set_pwm(read_time, pwm)
+        if self.target_idx >= len(self.targets):
+            self.set_pwm(read_time, 0.)
+            if self.trace is not None:
+                self.trace.record(read_time, temp, 0.)
+            return
+        target = self.targets[self.target_idx]
+        dt = 0. if self.prev_time is None else read_time - self.prev_time
+        self.prev_time = read_time
+        if self.hold_start_time is None:
             self.hold_start_time = read_time
-            self.holding_pwm = True
+            self.pwm_energy = 0.
         else:
-            if read_time - self.hold_start_time >= self.min_duration:
-                avg_temp_slope = self.get_avg_temp_slope(self.hold_start_time, read_time)
-                if abs(avg_temp_slope) > self.slope_threshold:
-                    self.Kss = self.compute_steadystate(read_time)
-                    pwm = max(0.0, min(1.0, target_temp * self.Kss))
-                    self.set_pwm(read_time, pwm)
-                    self.hold_start_time = read_time
-                # else: keep holding current PWM
-        # All logic is event-driven, no blocking or sleep
+            self.pwm_energy += self.last_pwm * dt
+        # Feed-forward guess plus PI correction
+        error = target - temp
+        integ = self.temp_integ + error * dt
+        pwm = self.Kss * target + self.Kp * error + self.Ki * integ
+        bounded_pwm = max(0., min(self.heater_max_power, pwm))
+        if pwm == bounded_pwm:
+            self.temp_integ = integ
+        self.set_pwm(read_time, bounded_pwm)
+        if self.trace is not None:
+            self.trace.record(read_time, temp, bounded_pwm)
+
+        # Steady-state check over a sliding window
+        if read_time - self.hold_start_time < self.min_duration:
+            return
+        avg_temp = self.get_avg_temp(self.hold_start_time, read_time)
+        avg_temp_slope = self.get_avg_temp_slope(self.hold_start_time, read_time)
+        if (abs(avg_temp_slope) < self.slope_threshold
+                and abs(avg_temp - target) < self.temp_tolerance):
+            avg_pwm = self.pwm_energy / (read_time - self.hold_start_time)
+            self.steady_points.append((avg_temp, avg_pwm))
+            logging.info("%s: steady state at %.2f, holding pwm %.4f",
+                         self.algo_name, avg_temp, avg_pwm)
+            self.target_idx += 1
+            if self.target_idx < len(self.targets):
+                self.heater.alter_target(self.targets[self.target_idx])
+        self.hold_start_time = read_time
+        self.pwm_energy = 0.
 
     def check_busy(self, eventtime, smoothed_temp, target_temp):
-        if self.heating or len(self.peaks) < 12:
-            return True
-        return False
-    
+        return self.target_idx < len(self.targets)
+
     @property
     def steady_state_reached(self):
-        if self.holding_pwm and self.hold_start_time is not None:
-            avg_temp_slope = self.get_avg_temp_slope(self.hold_start_time, self.hold_start_time + self.min_duration)
-            return abs(avg_temp_slope) < self.slope_threshold
-        return False
+        return not self.check_busy(0., 0., 0.)
 
     # Analysis
-    def compute_steadystate(self, read_time):
-        avg_temp = self.get_avg_temp(read_time-self.min_duration, self.min_duration)
-        avg_temp_slope = self.get_avg_temp_slope(read_time-self.min_duration, self.min_duration)
-        Kss_calibrated = self.last_pwm/avg_temp
-        self.computed_kss.append((read_time, Kss_calibrated))
-        return Kss_calibrated   
-
-
-    
-    # Offline analysis helper
-    def write_file(self, filename):
-        pwm = ["pwm: %.3f %.3f" % (time, value)
-               for time, value in self.pwm_samples]
-        out = ["%.3f %.3f" % (time, temp) for time, temp in self.temp_samples]
-        f = open(filename, "w")
-        f.write('\n'.join(pwm + out))
-        f.close()
+    def fit_ss_map(self):
+        """Least squares fit of pwm = a * dT + b * dT^2 with dT = temp - ambient
+
+        The curve passes through zero power at ambient. With a single point the
+        quadratic term is dropped.
+        """
+        pts = [(temp - self.ambient, pwm) for temp, pwm in self.steady_points
+               if temp > self.ambient]
+        if not pts:
+            raise ValueError("no steady-state points above ambient")
+        if len(pts) == 1:
+            d, pwm = pts[0]
+            coeffs = [pwm / d, 0.]
+        else:
+            coeffs = self._fit_quadratic(pts)
+        self.configvars.ss_map = coeffs
+        return coeffs
+
+    def _fit_quadratic(self, pts):
+        s2 = sum(d**2 for d, _ in pts)
+        s3 = sum(d**3 for d, _ in pts)
+        s4 = sum(d**4 for d, _ in pts)
+        u1 = sum(pwm * d for d, pwm in pts)
+        u2 = sum(pwm * d**2 for d, pwm in pts)
+        det = s2 * s4 - s3 * s3
+        if abs(det) < 1e-12:
+            return [u1 / s2, 0.]
+        a = (u1 * s4 - u2 * s3) / det
+        b = (s2 * u2 - s3 * u1) / det
+        return [a, b]
 
     def get_avg_temp(self, t_start, t_end):
         # Filter temps within the time range
         temps = [temp for time, temp in self.temp_samples if t_start <= time <= t_end]
-        # Return average, or 0/None if no samples found to avoid DivisionByZero
-        logging.info("%s: Average Temp = %.3f", self.algo_name, sum(temps) / len(temps))
-        
+        # Return average, or 0 if no samples found to avoid DivisionByZero
         return sum(temps) / len(temps) if temps else 0.0
     
     def get_avg_temp_slope(self, t_start, t_end):
-        temps = [temp for time, temp in self.temp_samples if t_start <= time <= t_end]
-        if len(temps) < 2:
+        samples = [(time, temp) for time, temp in self.temp_samples if t_start <= time <= t_end]
+        if len(samples) < 2 or samples[-1][0] <= samples[0][0]:
             return 0.0
-        temp_diff = [t2 - t1 for t1, t2 in zip(temps, temps[1:])]
-        avg_slope = sum(temp_diff) / len(temp_diff)
-        logging.info("%s: Average Temp slope = %.3f", self.algo_name, avg_slope)
-        return avg_slope
+        return (samples[-1][1] - samples[0][1]) / (samples[-1][0] - samples[0][0])
 
 def load_config_prefix(config):
     return PPCalibrate(config)
@@ -5,14 +5,25 @@
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import math
 import logging
-from .base_controller import BaseController
+from .base_controller import BaseController, clamp
+from .signal_filter import TempFilter
 
 SETTLE_DELTA = 1.
 SETTLE_SLOPE = .1
 AMBIENT_TEMP = 25.
 
+LEARN_EPS = 0.01 # NLMS regularisation, keeps steps small when inputs barely move
+LEARN_MEAN_TIME = 120. # [s] time constant of the running means removed before correlating
+EV_SMOOTHING_PERIOD = 0.3 # [s] update period ev_smoothing is specified for
+
+# State machine, states are indices into the tables below
+OFF, MAX_POWER, COAST_UP, REGULATE, MIN_POWER, COAST_DOWN = range(6)
+STATE_NAMES = ("off", "max_power", "coast_up", "regulate", "min_power", "coast_down")
+COASTING = (False, False, True, False, False, True) # a target change ends the coast
+RESETS_INTEGRATOR = (True, False, True, False, False, True) # entering clears the feedback integrator
+
 class PPControl(BaseController):
-    def __init__(self, config):
+    def __init__(self, config, register=True):
         # Initialize the base (hijacks Klipper)
         super().__init__(config)
         # Hardcoded Params
@@ -22,50 +33,112 @@ class PPControl(BaseController):
         self.k_ss = config.getfloat('k_ss', 0.0)
         self.k_fan = config.getfloat('k_fan', 0.0)
         self.k_ev = config.getfloat('k_ev', 0.0)
-        self.ev_smoothing = config.getfloat('ev_smoothing', 0.075)
+        self.ev_smoothing = config.getfloat('ev_smoothing', 0.075, above=0., maxval=1.)
+        # Compensate fan changes this far ahead, needs 'lookahead: True' in [ape_control]
+        self.fan_lookahead = config.getfloat('fan_lookahead', 0.0, minval=0.)
         self.dt_first_layer = config.getfloat('dt_first_layer', 1.5)
 
+        # Optional steady-state power map measured by PP_CALIBRATE SS_MAP=1,
+        # u_ss = a * dT + b * dT^2 ... with dT = target - ambient. Replaces target * k_ss.
+        # The ambient is ss_map_ambient, or the shared estimate when [ape_control] has one.
+        self.ss_map = config.getfloatlist('ss_map', [])
+        self.ss_map_ambient = config.getfloat('ss_map_ambient', AMBIENT_TEMP)
+        self.ss_cache_temp = None
+        self.ss_cache_ambient = None
+        self.ss_cache_power = 0.
+        self.u_hold = 0. # holding power (feed-forward steady-state + feedback) of the last regulate update
+        self.u_loads = 0. # fan and extrusion feed-forward of the last regulate update
+
         # Switching Logic Parameters
         self.t_overshoot_up = config.getfloat('t_overshoot_up', 0.0)
         self.coast_time_up = config.getfloat('coast_time_up', 0.0)
         self.t_overshoot_down = config.getfloat('t_overshoot_down', 0.0)
         self.coast_time_down = config.getfloat('coast_time_down', 0.0)
 
+        # Model based switching, uses the FOPDT model identified by PP_CALIBRATE
+        # instead of the fixed overshoot thresholds and coast times above.
+        self.model_switching = config.getboolean('model_switching', False)
+        self.tau = config.getfloat('tau', 0.0, minval=0.)
+        self.dead_time = config.getfloat('dead_time', 0.0, minval=0.)
+        self.model_valid = (self.k_ss > 0. or bool(self.ss_map)) and self.tau > 0.
+        if self.model_switching and not self.model_valid:
+            raise config.error(
+                "model_switching requires 'k_ss' (or 'ss_map') and 'tau' in section '%s'"
+                % (config.get_name(),))
+        if self.model_valid:
+            # Fraction of the current distance to the asymptote remaining after one dead time
+            self.model_decay = math.exp(-self.dead_time / self.tau)
+            # Temperatures the model settles at with the heater fully on/off,
+            # the ss_map ones follow the ambient (see _model_temp_max)
+            if self.ss_map:
+                self.model_rise_max = self._ss_map_rise(self.heater_max_power)
+            else:
+                self.model_temp_max = self.heater_max_power / self.k_ss
+                self.model_temp_min = 0.
+
         # Regulation max error window
         self.t_delta_regulate = config.getfloat('t_delta_regulate', 10.0)
         self.min_regulation_duration = config.getfloat('min_duration', 10.0) # Minimum duration to stay in a state before transitioning (prevents chatter)
+        # Control Effort log line at most this often, 0 logs every regulate update
+        self.effort_log_interval = config.getfloat('effort_log_interval', 5., minval=0.)
+        self.next_effort_log = 0.
 
         # On off switch for feed-back control
         self.fb_enable = config.getboolean('fb_enable', True)
 
+        # Online learning of k_fan and k_ev from the feedback effort during regulate
+        self.ff_learning = config.getboolean('ff_learning', False)
+        self.ff_learning_rate = config.getfloat('ff_learning_rate', 0.02, above=0., maxval=1.)
+        self.k_fan_max = config.getfloat('k_fan_max', 0.5, above=0.)
+        self.k_ev_max = config.getfloat('k_ev_max', 0.1, above=0.)
+        self.learn_fb_mean = 0.
+        self.learn_fan_mean = 0.
+        self.learn_ev_mean = 0.
+        self.learn_samples = 0
+
         # Min derivative time, for computing temp velocity
         self.min_deriv_time = config.getfloat('deriv_time', 2., above=0.)
+        self.temp_filter = TempFilter(config, self.min_deriv_time)
 
         ## State Machine State
-        self.state = "off"
+        self.state = OFF
         self.last_state_change = 0.0
         self.e_velocity_filtered = 0.0
         self.prev_temp_deriv = 0.
         self.prev_temp = AMBIENT_TEMP
         self.prev_temp_time = 0.
         
-        ## State dispatch table
-        self._states = {
-            "off": self._state_off,
-            "max_power": self._state_max_power,
-            "coast_up": self._state_coast_up,
-            "regulate": self._state_regulate,
-            "min_power": self._state_min_power,
-            "coast_down": self._state_coast_down
-        }
+        ## State dispatch table, bound once and indexed by the state
+        self._handlers = (self._state_off, self._state_max_power, self._state_coast_up,
+                          self._state_regulate, self._state_min_power, self._state_coast_down)
+        self.motion_report = None
 
         if self.fb_enable:
-            self.fb_pwm = 0.0
             from .pid_control import PIDControl
-            self.feedback_controller = PIDControl(config)
-            self.feedback_controller.set_pwm = lambda read_time, value: setattr(self, 'fb_pwm', value)   
+            self.feedback_controller = PIDControl(config, embedded=True)
+
+        if not register:
+            return
+        self.register_command("PP_SAVE_FEEDFORWARD", self.cmd_PP_SAVE_FEEDFORWARD_help)
+
+    def handle_ready(self):
+        super().handle_ready()
+        self.motion_report = self.printer.lookup_object('motion_report')
+
+    cmd_PP_SAVE_FEEDFORWARD_help = "Store the learned k_fan and k_ev for SAVE_CONFIG"
+
+    def cmd_PP_SAVE_FEEDFORWARD(self, gcmd):
+        cfgname = "ape_control " + self.heater_name
+        configfile = self.printer.lookup_object('configfile')
+        configfile.set(cfgname, 'k_fan', "%.6f" % (self.k_fan,))
+        configfile.set(cfgname, 'k_ev', "%.6f" % (self.k_ev,))
+        gcmd.respond_info(
+            "%s: k_fan=%.6f, k_ev=%.6f (%d learning updates)\n"
+            "The SAVE_CONFIG command will update the printer config file\n"
+            "with these parameters and restart the printer."
+            % (self.algo_name, self.k_fan, self.k_ev, self.learn_samples))
 
-    def temperature_update(self, read_time, temp, target_temp):
+    def control_update(self, read_time, temp, target_temp):
         """The PP-Control implementation of Proactive Power Control
         
         Args:
@@ -75,19 +148,16 @@ class PPControl(BaseController):
         """
         #
         if self.fb_enable: # pass inputs to the feedback controller. TODO: move to the ff_fb loop
-            self.feedback_controller.temperature_update(read_time, temp, target_temp)
+            self.feedback_controller.setpoint_ramping = self.setpoint_ramping
+            self.feedback_controller.control_update(read_time, temp, target_temp)
 
         # Check if target changed before updating
         target_changed = (target_temp != self.target_temp)
         
         # Sync local reference with PID target
         self.target_temp = target_temp
-        time_diff = read_time - self.prev_temp_time
-        temp_diff = temp - self.prev_temp
-        if time_diff >= self.min_deriv_time:
-            temp_deriv = temp_diff / time_diff
-        else:
-            temp_deriv = (self.prev_temp_deriv * (self.min_deriv_time - time_diff) + temp_diff) / self.min_deriv_time
+        temp = self.temp_filter.update(read_time, temp)
+        temp_deriv = self.temp_filter.deriv
 
         # Call the original PID to update its internal state and capture the PWM
         # This is critical: it updates pid_self.prev_temp, prev_temp_deriv, etc.
@@ -96,24 +166,21 @@ class PPControl(BaseController):
         # Global Off Trigger
         if target_temp <= 0:
             self.set_pwm(read_time, 0.0)  # Always set hardware to off
-            if self.state != "off":
-                self._transition("off", read_time)
+            if self.state != OFF:
+                self._transition(OFF, read_time)
         else:
             # Calculate Error and Duration
             error = target_temp - temp
             duration = read_time - self.last_state_change
 
             # Handle state transitions when target changes mid-coast (only if target actually changed)
-            if self.state in ["coast_up", "coast_down"] and target_changed:
-                self._transition("regulate", 0.0)  # Force transition to regulate, allowing min duration to be met for min/max state changes
+            if target_changed and COASTING[self.state]:
+                self._transition(REGULATE, 0.0)  # Force transition to regulate, allowing min duration to be met for min/max state changes
 
             # State Dispatch: executes the logic for the current state and returns the power level
-            if self.state == "regulate":
-                co = self._state_regulate(error, duration, read_time)
-            else:
-                co = self._states[self.state](error, duration, read_time)
-            
-            bounded_co = max(0., min(self.heater_max_power, co))
+            co = self._handlers[self.state](error, duration, read_time)
+
+            bounded_co = clamp(co, 0., self.heater_max_power)
             # Set PWM output (assumes heater object is accessible via self.printer)
             self.set_pwm(read_time, bounded_co)
 
@@ -135,39 +202,124 @@ class PPControl(BaseController):
         """
         # this is where the fb function should actually be called
         if self.fb_enable:
-            u_fb_pid = self.fb_pwm
-            u_fb_bidirection = max(-self.heater_max_power, min(self.heater_max_power, self.feedback_controller.co))
+            u_fb_pid = self.feedback_controller.last_pwm
+            u_fb_bidirection = clamp(self.feedback_controller.co, -self.heater_max_power, self.heater_max_power)
         else:
             u_fb_pid = 0.0
             u_fb_bidirection = 0.0
 
         # Access Feed Forward inputs
-        fan_speed = self.part_fan.get_status(read_time)['speed']
-        e_velocity = self.printer.lookup_object('motion_report').get_status(read_time)['live_extruder_velocity'] # realtime, we can also use look-ahead in later versions
-        z_position = self.gcode_move.get_status()['position'][2]
+        # Klipper's fan and gcode_move build a status dict per call, read their fields
+        fan_speed = fan_speed_now = self.part_fan.fan.last_fan_value
+        if self.fan_lookahead and self.lookahead is not None:
+            fan_speed = self.lookahead.get_fan_speed(read_time + self.fan_lookahead, fan_speed_now)
+        e_velocity = self.motion_report.get_status(read_time)['live_extruder_velocity'] # realtime, we can also use look-ahead in later versions
+        z_position = self.gcode_move.last_position[2]
         if z_position < 0.3:
             fist_layer_compensation = self.dt_first_layer
         else:
             fist_layer_compensation = 0.0
 
         # Low-pass filter the error due to stuttery velocity readings. This should be solved by using look-ahead velocity for some known time constant beween power and temperature reading.
-        self.e_velocity_filtered = max(0.0, (1 - self.ev_smoothing) * self.e_velocity_filtered + self.ev_smoothing * e_velocity)
+        # ev_smoothing is per EV_SMOOTHING_PERIOD, scaled to the actual update interval
+        dt = read_time - self.prev_temp_time
+        if dt < 0.:
+            dt = 0.
+        ev_alpha = 1. - (1. - self.ev_smoothing) ** (dt / EV_SMOOTHING_PERIOD)
+        self.e_velocity_filtered = (1 - ev_alpha) * self.e_velocity_filtered + ev_alpha * e_velocity
+        if self.e_velocity_filtered < 0.:
+            self.e_velocity_filtered = 0.
+
+        if (self.ff_learning and self.fb_enable
+                and read_time - self.last_state_change >= self.min_regulation_duration):
+            self._learn_feedforward(u_fb_bidirection, fan_speed_now, read_time - self.prev_temp_time)
         # Feed forward control logic
-        u_ff = (self.target_temp - fist_layer_compensation) * self.k_ss + fan_speed * self.k_fan + self.e_velocity_filtered * self.k_ev
+        u_ss = self._steady_state_power(self.target_temp - fist_layer_compensation)
+        self.u_hold = u_ss + u_fb_bidirection
+        self.u_loads = fan_speed_now * self.k_fan + self.e_velocity_filtered * self.k_ev
+        u_ff = u_ss + fan_speed * self.k_fan + self.e_velocity_filtered * self.k_ev
+
+        if read_time >= self.next_effort_log and logging.getLogger().isEnabledFor(logging.INFO):
+            self.next_effort_log = read_time + self.effort_log_interval
+            logging.info("[%.3f] %s %s: Control Effort: FB_PWM: %.3f, FF_PWM: %.3f, FF_ev: %.3f",
+                         read_time, self.algo_name, self.heater_name, u_fb_bidirection, u_ff,
+                         self.e_velocity_filtered * self.k_ev)
 
-        
-        logging.info("%s: Control Effort: FB_PWM: %.3f, FF_PWM: %.3f, FF_ev: %.3f" % (self.algo_name, u_fb_bidirection, u_ff, self.e_velocity_filtered * self.k_ev))
-        
         if not self.fb_enable:
             return u_ff
         else:           
             return u_fb_bidirection + u_ff # u_fb_pid + u_ff was old implemenation
 
+    def _learn_feedforward(self, u_fb, fan_speed, dt):
+        """Bounded NLMS step of k_fan and k_ev towards zero feedback effort
+
+        Slow running means are removed from the feedback effort and both
+        inputs first, so a constant k_ss error is not attributed to a fan that
+        is always on. Only the correlated part moves the gains.
+        """
+        if dt <= 0.:
+            return
+        alpha = clamp(dt / LEARN_MEAN_TIME, 0., 1.)
+        self.learn_fb_mean += alpha * (u_fb - self.learn_fb_mean)
+        self.learn_fan_mean += alpha * (fan_speed - self.learn_fan_mean)
+        self.learn_ev_mean += alpha * (self.e_velocity_filtered - self.learn_ev_mean)
+        x_fan = fan_speed - self.learn_fan_mean
+        x_ev = self.e_velocity_filtered - self.learn_ev_mean
+        step = (self.ff_learning_rate * clamp(dt, 0., 1.) * (u_fb - self.learn_fb_mean)
+                / (LEARN_EPS + x_fan * x_fan + x_ev * x_ev))
+        self.k_fan = clamp(self.k_fan + step * x_fan, 0., self.k_fan_max)
+        self.k_ev = clamp(self.k_ev + step * x_ev, 0., self.k_ev_max)
+        self.learn_samples += 1
+
+    def get_status(self, eventtime):
+        return {
+            "state": STATE_NAMES[self.state],
+            "k_fan": self.k_fan,
+            "k_ev": self.k_ev,
+            "ff_learning": self.ff_learning,
+            "learn_samples": self.learn_samples,
+        }
+
+    def export_state(self):
+        state = super().export_state()
+        state.update({"temp": self.prev_temp, "time": self.prev_temp_time,
+                      "temp_deriv": self.prev_temp_deriv,
+                      "ambient_temp": self._ambient_temp() if self.ss_map else None})
+        return state
+
+    def import_state(self, state):
+        super().import_state(state)
+        if "time" not in state:
+            return
+        target = state["target"]
+        self.target_temp = target
+        self.prev_temp = state["temp"]
+        self.prev_temp_time = state["time"]
+        self.prev_temp_deriv = state.get("temp_deriv", 0.)
+        self.temp_filter.reset(self.prev_temp_time, self.prev_temp, self.prev_temp_deriv)
+        error = target - self.prev_temp
+        # Enter the state the switching logic would be in, with min_duration already met
+        if target <= 0.:
+            next_state = OFF
+        elif abs(error) < self.t_delta_regulate:
+            next_state = REGULATE
+        elif error > 0.:
+            next_state = MAX_POWER
+        else:
+            next_state = MIN_POWER
+        self._transition(next_state, self.prev_temp_time - self.min_regulation_duration)
+        if self.fb_enable and next_state == REGULATE:
+            # Feedback takes the part of the previous output the feed-forward does not cover
+            fb_state = dict(state)
+            fb_state["output"] = state.get("output", 0.) - self._steady_state_power(target)
+            self.feedback_controller.import_state(fb_state)
+
     def _transition(self, next_state, read_time):
         """Transition to a new state and log the change"""
         if self.state != next_state:
-            logging.info("[%.3f] %s: state transition: %s -> %s" % (read_time, self.algo_name, self.state, next_state))
-            if (next_state is "off" or next_state is "coast_up" or next_state is "coast_down"): # reset integrator to avoid carying prexisting errors into new control states.
+            logging.info("[%.3f] %s %s: state transition: %s -> %s", read_time, self.algo_name,
+                         self.heater_name, STATE_NAMES[self.state], STATE_NAMES[next_state])
+            if self.fb_enable and RESETS_INTEGRATOR[next_state]: # reset integrator to avoid carying prexisting errors into new control states.
                 self.feedback_controller.prev_temp_integ = 0.
             self.state = next_state
             self.last_state_change = read_time
@@ -176,50 +328,170 @@ class PPControl(BaseController):
     def _state_off(self, error, duration, read_time):
         """Off state: wait for non-zero target"""
         if error > 0:
-            self._transition("max_power", read_time)
+            self._transition(MAX_POWER, read_time)
         return 0.0
 
     def _state_max_power(self, error, duration, read_time):
         """Max power state: heat until approaching target"""
-        if error < self.t_overshoot_up:
-            self._transition("coast_up", read_time)
+        if self.model_switching:
+            # Cut power once the heat already in the dead time lands on the target
+            temp = self.target_temp - error
+            if self._model_predict(temp, self._model_temp_max()) >= self.target_temp:
+                self._transition(COAST_UP, read_time)
+        elif error < self.t_overshoot_up:
+            self._transition(COAST_UP, read_time)
         return 1.0
 
     def _state_coast_up(self, error, duration, read_time):
         """Coast up state: reduce power to prevent overshoot"""
         # Immediate jump to regulate if temp slope is 0 or less
         if self.prev_temp_deriv <= 0:
-            self._transition("regulate", read_time)
+            self._transition(REGULATE, read_time)
+        elif self.model_switching:
+            if duration >= self.dead_time:
+                self._transition(REGULATE, read_time)
+            return self._model_hold_power()
         elif duration >= self.coast_time_up:
-            self._transition("regulate", read_time)
+            self._transition(REGULATE, read_time)
         return 0.0
 
     def _state_regulate(self, error, duration, read_time):
         """Regulate state: maintain temperature with feedback control"""
         if abs(error) < self.t_delta_regulate or duration < self.min_regulation_duration: # Temp within regulation window or min duration not met
-            return self.ff_fb_control(read_time)
-        elif error > self.t_delta_regulate:  # Temp too far below target
-            self._transition("max_power", read_time)
+            co = self.ff_fb_control(read_time)
+            if (self.ambient is not None and self.ss_map and self.fb_enable
+                    and duration >= self.min_regulation_duration and abs(error) < SETTLE_DELTA):
+                # Settled: the holding power tells how far above ambient we are
+                temp = self.target_temp - error
+                self.ambient.contribute(self.heater_name, temp - self._ss_map_rise(self.u_hold))
+            return co
+        elif error >= self.t_delta_regulate:  # Temp too far below target
+            self._transition(MAX_POWER, read_time)
             return 1.0
-        elif error < -self.t_delta_regulate:  # Temp too far above target
-            self._transition("min_power", read_time)
+        else:  # Temp too far above target
+            self._transition(MIN_POWER, read_time)
             return 0.0
 
     def _state_min_power(self, error, duration, read_time):
         """Min power state: reduce power when overshot"""
-        if error > -self.t_overshoot_down:  # Error approaching zero from below
-            self._transition("coast_down", read_time)
+        if self.model_switching:
+            temp = self.target_temp - error
+            if self._model_predict(temp, self._model_temp_min()) <= self.target_temp:
+                self._transition(COAST_DOWN, read_time)
+        elif error > -self.t_overshoot_down:  # Error approaching zero from below
+            self._transition(COAST_DOWN, read_time)
         return 0.0
 
     def _state_coast_down(self, error, duration, read_time):
         """Coast down state: coast to prevent undershoot"""
         # Immediate jump to regulate if temp slope is 0 or more
         if self.prev_temp_deriv >= 0:
-            self._transition("regulate", read_time)
+            self._transition(REGULATE, read_time)
+        elif self.model_switching:
+            if duration >= self.dead_time:
+                self._transition(REGULATE, read_time)
+            return self._model_hold_power()
         elif duration >= self.coast_time_down:
-            self._transition("regulate", read_time)
+            self._transition(REGULATE, read_time)
         return 1.0
+
+    # --- FOPDT model helpers for model_switching ---
+    def _model_predict(self, temp, temp_inf):
+        """Sensor temperature one dead time from now for a held power settling at temp_inf
+
+        The first-order model settles where the steady-state relation used by
+        the feed-forward balances the power. Output stays on the old trajectory
+        for dead_time after a switch, so this is where the temperature lands.
+        """
+        return temp_inf + (temp - temp_inf) * self.model_decay
+
+    def estimate_heat_time(self, from_temp, to_temp):
+        """Time to heat from from_temp to to_temp at full power, None without a model"""
+        if not self.model_valid:
+            return None
+        if to_temp <= from_temp:
+            return 0.
+        temp_max = self._model_temp_max()
+        if to_temp >= temp_max:
+            return None
+        return (self.tau * math.log((temp_max - from_temp) / (temp_max - to_temp))
+                + self.dead_time)
+
+    def _model_hold_power(self):
+        """Power which holds the target once the dead time has passed"""
+        return self._steady_state_power(self.target_temp)
+
+    def heat_model(self):
+        if not self.model_valid:
+            return None
+        return (self.tau, self.dead_time, self._model_temp_inf)
+
+    def _model_temp_inf(self, power):
+        """Temperature the model settles at for a heater power, net of fan and extrusion losses"""
+        power = max(0., power - self.u_loads)
+        if self.ss_map:
+            return self._ambient_temp() + self._ss_map_rise(power)
+        return power / self.k_ss
+
+    def _model_temp_max(self):
+        if self.ss_map:
+            return self._ambient_temp() + self.model_rise_max
+        return self.model_temp_max
+
+    def _model_temp_min(self):
+        if self.ss_map:
+            return self._ambient_temp()
+        return self.model_temp_min
+
+    # --- Steady-state feed-forward ---
+    def _ambient_temp(self):
+        if self.ambient is not None:
+            return self.ambient.temp
+        return self.ss_map_ambient
+
+    def _steady_state_power(self, temp):
+        """Holding power for temp, only re-evaluated when temp or the ambient changes"""
+        if self.ss_map:
+            ambient = self._ambient_temp()
+            if temp != self.ss_cache_temp or ambient != self.ss_cache_ambient:
+                self.ss_cache_temp = temp
+                self.ss_cache_ambient = ambient
+                self.ss_cache_power = max(0., self._ss_map_eval(temp - ambient))
+        elif temp != self.ss_cache_temp:
+            self.ss_cache_temp = temp
+            self.ss_cache_power = temp * self.k_ss
+        return self.ss_cache_power
+
+    def _ss_map_eval(self, rise):
+        power = 0.
+        for coeff in reversed(self.ss_map):
+            power = (power + coeff) * rise
+        return power
+
+    def _ss_map_rise(self, power):
+        """Rise above ambient at which the ss_map needs 'power' to hold"""
+        if len(self.ss_map) == 1 or (len(self.ss_map) == 2 and not self.ss_map[1]):
+            return power / self.ss_map[0]
+        if len(self.ss_map) == 2:
+            a, b = self.ss_map
+            disc = a * a + 4. * b * power
+            if disc >= 0.:
+                return (math.sqrt(disc) - a) / (2. * b)
+        lo, hi = 0., 2000.
+        for _ in range(60):
+            mid = .5 * (lo + hi)
+            if self._ss_map_eval(mid) < power:
+                lo = mid
+            else:
+                hi = mid
+        return .5 * (lo + hi)
     
+    def requested_update_interval(self, read_time, temp, target_temp):
+        # Full rate through heat-up and the coast phases
+        if self.state != REGULATE:
+            return 0.
+        return super().requested_update_interval(read_time, temp, target_temp)
+
     def check_busy(self, eventtime, smoothed_temp, target_temp):
         temp_diff = target_temp - smoothed_temp
         return (abs(temp_diff) > SETTLE_DELTA
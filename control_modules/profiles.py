@@ -0,0 +1,37 @@
+# ApeControl-Klipper named filament/nozzle profiles
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# A profile is a [ape_profile <heater> <name>] section holding options of the
+# heater's [ape_control <heater>] section that differ for a material or
+# nozzle (filament constants, block_heat_capacity, K_ss, PID gains, even the
+# control architecture). Every profile is built into its own controller at
+# startup, so its derived constants are computed once and APE_PROFILE only
+# hands over the running state and swaps the controller in.
+import logging
+
+PROFILE_PREFIX = "ape_profile"
+DEFAULT_PROFILE = "default" # the plain [ape_control <heater>] section
+
+
+def profile_section(heater_name, profile=None):
+    """Config section calibration results are stored in"""
+    if profile is None or profile.lower() == DEFAULT_PROFILE:
+        return "ape_control " + heater_name
+    return "%s %s %s" % (PROFILE_PREFIX, heater_name, profile.lower())
+
+
+def read_profiles(config, heater_name):
+    """{name: {option: raw value}} of every [ape_profile <heater> <name>] section"""
+    profiles = {}
+    prefix = "%s %s " % (PROFILE_PREFIX, heater_name)
+    for section in config.get_prefix_sections(prefix):
+        name = section.get_name()[len(prefix):].strip().lower()
+        if not name or ' ' in name or name == DEFAULT_PROFILE:
+            raise config.error("Invalid profile name in section '%s'" % (section.get_name(),))
+        profiles[name] = {option.lower(): section.get(option)
+                          for option in section.get_prefix_options('')}
+        logging.info("ApeControl: %s profile '%s' %s", heater_name, name, profiles[name])
+    return profiles
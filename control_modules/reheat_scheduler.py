@@ -0,0 +1,101 @@
+# ApeControl-Klipper just-in-time reheat scheduler for parked tools
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Parked tools are dropped to a standby temperature. The gcode lookahead
+# tells when a tool is picked up again and the heater's own thermal model
+# (estimate_heat_time) tells how long the reheat takes, so the reheat is
+# started just early enough that the tool is at temperature on pickup.
+import logging
+
+SCHEDULE_INTERVAL = 1.0
+STALE_PICKUP_TIME = 60. # [s] a reheated tool not picked up by then returns to standby
+
+PARKED = "standby"
+REHEATING = "reheating"
+
+
+class ReheatScheduler:
+    def __init__(self, config, lookahead):
+        self.printer = config.get_printer()
+        self.lookahead = lookahead
+        if lookahead is None or not lookahead.tool_heaters:
+            raise config.error("reheat_scheduler needs 'lookahead: True' and 'tool_heaters' "
+                               "in section '%s'" % (config.get_name(),))
+        self.standby_temp = config.getfloat('standby_temp', 150., minval=0.)
+        self.reheat_margin = config.getfloat('reheat_margin', 5., minval=0.)
+        # Used for heaters whose controller has no thermal model
+        self.default_reheat_time = config.getfloat('default_reheat_time', 60., above=0.)
+        self.tools = {} # heater name -> tool state dict
+        self.printer.register_event_handler("klippy:ready", self.handle_ready)
+
+    def handle_ready(self):
+        self.reactor = self.printer.get_reactor()
+        self.toolhead = self.printer.lookup_object('toolhead')
+        self.mcu = self.printer.lookup_object('mcu')
+        self.pheaters = self.printer.lookup_object('heaters')
+        for tool, heater_name in self.lookahead.tool_heaters.items():
+            self.tools[heater_name] = {
+                "tool": tool,
+                "heater": self.pheaters.lookup_heater(heater_name),
+                "state": None,
+                "active_target": 0.,
+                "pickup_time": None,
+                "reheat_time": None,
+            }
+        self.reactor.register_timer(self._schedule_event, self.reactor.NOW)
+
+    def _heat_time(self, heater_name, from_temp, to_temp):
+        ape = self.printer.lookup_object('ape_control ' + heater_name, None)
+        heat_time = None
+        if ape is not None:
+            heat_time = ape.new_controller.estimate_heat_time(from_temp, to_temp)
+        if heat_time is None:
+            heat_time = self.default_reheat_time
+        return heat_time
+
+    def _schedule_event(self, eventtime):
+        now = self.mcu.estimated_print_time(eventtime)
+        active = self.toolhead.get_extruder().get_name()
+        for heater_name, tool in self.tools.items():
+            heater = tool["heater"]
+            temp, target = heater.get_temp(eventtime)
+            if heater_name == active:
+                tool["state"] = None
+                tool["active_target"] = target
+                continue
+            if tool["state"] is None and target > self.standby_temp:
+                # Tool just got parked, hold it at standby
+                tool["active_target"] = target
+                tool["state"] = PARKED
+                heater.set_temp(self.standby_temp)
+                logging.info("ApeControl: %s parked, standby at %.1f", heater_name, self.standby_temp)
+            if tool["state"] == REHEATING:
+                # Planned pickup never happened, park again
+                if tool["pickup_time"] is not None and now > tool["pickup_time"] + STALE_PICKUP_TIME:
+                    tool["state"] = None
+                continue
+            pickup_time = self.lookahead.next_tool_pickup(tool["tool"], now)
+            tool["pickup_time"] = pickup_time
+            if pickup_time is None:
+                continue
+            pickup_target = self.lookahead.get_target(heater_name, pickup_time, tool["active_target"])
+            if pickup_target <= target:
+                continue
+            reheat_time = self._heat_time(heater_name, temp, pickup_target)
+            tool["reheat_time"] = reheat_time
+            if now + reheat_time + self.reheat_margin >= pickup_time:
+                tool["state"] = REHEATING
+                heater.set_temp(pickup_target)
+                logging.info("ApeControl: %s reheating to %.1f, pickup in %.1fs, reheat takes %.1fs",
+                             heater_name, pickup_target, pickup_time - now, reheat_time)
+        return eventtime + SCHEDULE_INTERVAL
+
+    def get_status(self, eventtime):
+        return {name: {"tool": tool["tool"],
+                       "state": tool["state"],
+                       "pickup_time": tool["pickup_time"],
+                       "reheat_time": tool["reheat_time"]}
+                for name, tool in self.tools.items()}
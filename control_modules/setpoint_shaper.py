@@ -0,0 +1,94 @@
+# ApeControl-Klipper setpoint trajectory shaping
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Turns a target step into a temperature reference the heater can follow.
+# The reference starts at the measured temperature and rises no faster than
+# setpoint_rate, or setpoint_rate_margin of what the controller's heat model
+# says full power achieves at that temperature, whichever is lower. Within
+# reach of the target the rate falls off as (target - reference) /
+# setpoint_approach_time, an exponential final approach the controller can
+# track without overshoot. The reference never leads the measurement by more
+# than setpoint_max_lead beyond the lag the dead time explains, so a heater
+# held back (power budget, weak supply) is not left chasing a runaway
+# setpoint. Targets below the measured
+# temperature and 0 (off) pass through unchanged.
+import logging
+
+MIN_RATE = 0.02 # [degC/s] lowest reference rate, the model may report none left near its limit
+SNAP_DELTA = 0.05 # [degC] the reference joins the target this close to it
+DEFAULT_APPROACH_TIME = 20. # [s] without a model dead time
+
+
+class SetpointShaper:
+    def __init__(self, config, controller, max_power):
+        self.controller = controller
+        self.max_power = max_power # duty, some controllers redefine heater_max_power
+        self.rate = config.getfloat('setpoint_rate', 0., minval=0.)
+        self.rate_margin = config.getfloat('setpoint_rate_margin', 0.85, above=0., maxval=1.)
+        self.approach_time = config.getfloat('setpoint_approach_time', 0., minval=0.)
+        self.max_lead = config.getfloat('setpoint_max_lead', 5., above=0.)
+        self.target = None
+        self.reference = None
+        self.last_time = None
+        self.model = None
+        self.dead_time = 0.
+        self.step_approach_time = DEFAULT_APPROACH_TIME
+        self.warned = False
+
+    def update(self, read_time, temp, target_temp):
+        """Reference for this control update"""
+        if target_temp != self.target:
+            self._new_target(read_time, temp, target_temp)
+            return self.reference
+        reference = self.reference
+        if reference >= target_temp:
+            return target_temp
+        dt = read_time - self.last_time
+        self.last_time = read_time
+        if dt <= 0.:
+            return reference
+        rate = self._max_rate(reference)
+        rate = max(MIN_RATE, min(rate, (target_temp - reference) / self.step_approach_time))
+        # The measurement trails a ramp by about rate * dead time
+        lead = self.max_lead + rate * self.dead_time
+        step = min(target_temp, reference + rate * dt, temp + lead)
+        reference = max(reference, step)
+        if target_temp - reference < SNAP_DELTA:
+            reference = target_temp
+        self.reference = reference
+        return reference
+
+    def _new_target(self, read_time, temp, target_temp):
+        self.target = target_temp
+        self.last_time = read_time
+        if target_temp <= 0. or target_temp <= temp:
+            self.reference = target_temp
+            return
+        # Continue a ramp in progress, otherwise start at the measurement
+        start = temp
+        if self.reference is not None and 0. < self.reference < target_temp:
+            start = max(temp, self.reference)
+        self.reference = start
+        self.model = self.controller.heat_model()
+        self.dead_time = self.model[1] if self.model is not None else 0.
+        self.step_approach_time = self.approach_time
+        if not self.step_approach_time:
+            self.step_approach_time = .5 * self.dead_time or DEFAULT_APPROACH_TIME
+        if self.model is None and not self.rate and not self.warned:
+            self.warned = True
+            logging.warning("ApeControl: %s setpoint shaping has neither 'setpoint_rate' nor a "
+                            "heat model, only the final approach is shaped",
+                            self.controller.heater_name)
+
+    def _max_rate(self, reference):
+        rate = self.rate or float('inf')
+        if self.model is not None:
+            tau, dead_time, temp_inf = self.model
+            rate = min(rate, self.rate_margin * (temp_inf(self.max_power) - reference) / tau)
+        return rate
+
+    def get_status(self):
+        return {"setpoint": self.reference}
@@ -0,0 +1,106 @@
+# ApeControl-Klipper temperature conditioning shared by the controllers
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Single sample ADC spikes are rejected before they reach the control law: a
+# reading further from the filter's prediction than spike_threshold plus
+# RESIDUAL_GATE times the recent mean prediction error is replaced by the
+# median of the last spike_window readings. The mean error term keeps fast
+# heaters, whose readings legitimately leave the prediction, from being
+# clipped. At most spike_window // 2 readings in a row are replaced, the next
+# one out of the gate is taken as the temperature moving (a step or a slope
+# change) and accepted, as the median would by then. Only runs that end back
+# inside the gate count as spikes. The temperature
+# rate comes from an alpha-beta tracker whose gains follow the actual time
+# step,
+#   theta = exp(-dt / deriv_time), alpha = 1 - theta^2, beta = (1 - theta)^2
+# (critically damped), so decimated updates and report jitter need no
+# special handling. Updates allocate nothing.
+import math
+
+MAX_SPIKE_WINDOW = 9
+RESIDUAL_GATE = 4.
+RESIDUAL_TIME = 10. # [s] averaging time of the prediction error
+
+
+class TempFilter:
+    """Spike rejection and temperature derivative of one sensor
+
+    update() returns the conditioned reading, the rate is in 'deriv'.
+    Options 'spike_window' (odd, 1 disables) and 'spike_threshold' [degC]
+    are read from the controller's section, deriv_time is given by the
+    controller (its own derivative time option).
+    """
+    __slots__ = ('deriv_time', 'window', 'threshold', 'samples', 'scratch', 'index', 'spikes',
+                 'rejected', 'residual', 'last_time', 'value', 'estimate', 'deriv')
+
+    def __init__(self, config, deriv_time):
+        self.deriv_time = deriv_time
+        self.window = config.getint('spike_window', 3, minval=1, maxval=MAX_SPIKE_WINDOW)
+        if not self.window % 2:
+            raise config.error("spike_window must be odd in section '%s'" % (config.get_name(),))
+        self.threshold = config.getfloat('spike_threshold', 2., above=0.)
+        self.samples = [0.] * self.window
+        self.scratch = [0.] * self.window
+        self.index = 0
+        self.spikes = 0
+        self.rejected = 0 # readings replaced in a row
+        self.residual = 0. # mean absolute prediction error of accepted readings
+        self.reset(None, 0.)
+
+    def reset(self, read_time, temp, deriv=0.):
+        """Start over from a known state (first reading, controller swap)"""
+        self.last_time = read_time
+        self.value = self.estimate = temp
+        self.deriv = deriv
+        self.rejected = 0
+        for i in range(self.window):
+            self.samples[i] = temp
+
+    def update(self, read_time, temp):
+        samples = self.samples
+        samples[self.index] = temp
+        self.index = (self.index + 1) % self.window
+        if self.last_time is None:
+            self.reset(read_time, temp)
+            return temp
+        dt = read_time - self.last_time
+        if dt <= 0.:
+            return self.value
+        predicted = self.estimate + self.deriv * dt
+        residual = temp - predicted
+        outside = abs(residual) > self.threshold + RESIDUAL_GATE * self.residual
+        if self.window > 1 and outside and self.rejected < self.window // 2:
+            temp = self._median()
+            residual = temp - predicted
+            self.rejected += 1
+        else:
+            if not outside:
+                self.spikes += self.rejected
+            self.rejected = 0
+            self.residual += (abs(residual) - self.residual) * (1. - math.exp(-dt / RESIDUAL_TIME))
+        # Alpha-beta tracker, gains for this time step
+        theta = math.exp(-dt / self.deriv_time)
+        self.estimate = predicted + (1. - theta * theta) * residual
+        self.deriv += (1. - theta) * (1. - theta) * residual / dt
+        self.last_time = read_time
+        self.value = temp
+        return temp
+
+    def _median(self):
+        samples = self.samples
+        if self.window == 3:
+            a, b, c = samples
+            return max(min(a, b), min(max(a, b), c))
+        # Insertion sort into the preallocated scratch list
+        scratch = self.scratch
+        for i in range(self.window):
+            value = samples[i]
+            j = i
+            while j and scratch[j - 1] > value:
+                scratch[j] = scratch[j - 1]
+                j -= 1
+            scratch[j] = value
+        return scratch[self.window // 2]
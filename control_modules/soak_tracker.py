@@ -0,0 +1,147 @@
+# ApeControl-Klipper heat soak completion tracker
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Once the sensor sits on the target the heater power keeps falling while the
+# slow thermal mode (plate surface, frame, chamber) still warms up. With the
+# power averaged over equal blocks p0, p1, p2 the slow mode follows from
+#   r = (p2 - p1) / (p1 - p0) = exp(-block / tau_slow)
+# and the power drift still to come is (p2 - p1) * r / (1 - r). The heater is
+# soaked once that drift is below 'soak_tolerance' of the holding power.
+import math, logging
+from collections import deque
+
+SAMPLE_INTERVAL = 1.0
+SETTLE_DELTA = 1. # [degC] soaking starts once the sensor is this close to the target
+TAU_SMOOTHING = 0.5 # weight of a new slow mode fit
+
+IDLE = "idle"
+HEATING = "heating"
+SOAKING = "soaking"
+SOAKED = "soaked"
+
+
+class SoakTracker:
+    def __init__(self, config):
+        self.printer = config.get_printer()
+        self.heater_name = config.get_name().split()[-1]
+        self.block_time = config.getfloat('soak_window', 30., above=5.)
+        self.tolerance = config.getfloat('soak_tolerance', 0.02, above=0.)
+        self.min_time = config.getfloat('soak_min_time', 0., minval=0.)
+        self.max_time = config.getfloat('soak_max_time', 1800., above=0.)
+        # Optional prior of the slow mode, used until a fit is available
+        self.prior_tau = config.getfloat('soak_time_constant', None, above=0.)
+        self._reset(0.)
+        gcode = self.printer.lookup_object('gcode')
+        gcode.register_mux_command(
+            "WAIT_FOR_SOAK",
+            "HEATER",
+            self.heater_name,
+            self.cmd_WAIT_FOR_SOAK,
+            desc=self.cmd_WAIT_FOR_SOAK_help,
+        )
+        self.printer.register_event_handler("klippy:ready", self.handle_ready)
+
+    def handle_ready(self):
+        self.reactor = self.printer.get_reactor()
+        self.heater = self.printer.lookup_object('heaters').lookup_heater(self.heater_name)
+        self.reactor.register_timer(self._sample_event, self.reactor.NOW)
+
+    def _reset(self, target):
+        self.state = IDLE if not target else HEATING
+        self.target = target
+        self.soak_start = None
+        self.block_sum = 0.
+        self.block_count = 0
+        self.blocks = deque(maxlen=3)
+        self.tau = self.prior_tau
+        self.remaining = None
+        self.power_trend = None
+
+    def _sample_event(self, eventtime):
+        status = self.heater.get_status(eventtime)
+        temp, target, power = status['temperature'], status['target'], status['power']
+        if target != self.target:
+            self._reset(target)
+        if self.state == HEATING and abs(target - temp) < SETTLE_DELTA:
+            self.state = SOAKING
+            self.soak_start = eventtime
+            logging.info("ApeControl: %s at target, soak tracking started", self.heater_name)
+        if self.state == SOAKING:
+            self.block_sum += power
+            self.block_count += 1
+            if self.block_count * SAMPLE_INTERVAL >= self.block_time:
+                self.blocks.append(self.block_sum / self.block_count)
+                self.block_sum = 0.
+                self.block_count = 0
+                self._update_estimate()
+            elapsed = eventtime - self.soak_start
+            if (self.remaining is not None and self.remaining <= 0. and elapsed >= self.min_time) \
+                    or elapsed >= self.max_time:
+                self.state = SOAKED
+                logging.info("ApeControl: %s soaked after %.0fs (slow mode tau %s)",
+                             self.heater_name, elapsed,
+                             "%.0fs" % (self.tau,) if self.tau else "unknown")
+        return eventtime + SAMPLE_INTERVAL
+
+    def _update_estimate(self):
+        if len(self.blocks) < 2:
+            return
+        d2 = self.blocks[-1] - self.blocks[-2]
+        self.power_trend = d2 / self.block_time
+        if len(self.blocks) == 3:
+            d1 = self.blocks[-2] - self.blocks[-3]
+            ratio = d2 / d1 if d1 else 0.
+            if 0. < ratio < 1.:
+                tau = -self.block_time / math.log(ratio)
+                self.tau = tau if self.tau is None else self.tau + TAU_SMOOTHING * (tau - self.tau)
+        # Drift still to come, power settles at p2 + drift
+        hold_power = self.blocks[-1]
+        if self.tau is not None:
+            ratio = math.exp(-self.block_time / self.tau)
+            drift = d2 * ratio / (1. - ratio)
+        else:
+            drift = d2 # no slow mode known: one block of drift must be within tolerance
+        limit = self.tolerance * max(abs(hold_power + drift), 1e-3)
+        if abs(drift) <= limit:
+            self.remaining = 0.
+        elif self.tau is not None:
+            self.remaining = self.tau * math.log(abs(drift) / limit)
+        else:
+            self.remaining = None
+
+    cmd_WAIT_FOR_SOAK_help = "Wait until the heater's slow thermal mode has settled"
+
+    def cmd_WAIT_FOR_SOAK(self, gcmd):
+        timeout = gcmd.get_float('TIMEOUT', self.max_time, above=0.)
+        if self.state == IDLE:
+            raise gcmd.error("WAIT_FOR_SOAK: %s has no target" % (self.heater_name,))
+        toolhead = self.printer.lookup_object('toolhead')
+        toolhead.get_last_move_time() # flush queued moves, like M190
+        reactor = self.reactor
+        eventtime = start = reactor.monotonic()
+        last_report = None
+        while not self.printer.is_shutdown() and self.state != SOAKED:
+            if eventtime - start >= timeout:
+                gcmd.respond_info("WAIT_FOR_SOAK: %s timed out after %.0fs"
+                                  % (self.heater_name, timeout))
+                return
+            if last_report is None or eventtime - last_report >= 30.:
+                last_report = eventtime
+                gcmd.respond_info("%s: %s, remaining %s" % (
+                    self.heater_name, self.state,
+                    "%.0fs" % (self.remaining,) if self.remaining is not None else "unknown"))
+            eventtime = reactor.pause(eventtime + SAMPLE_INTERVAL)
+        gcmd.respond_info("%s soaked" % (self.heater_name,))
+
+    def get_status(self, eventtime):
+        elapsed = eventtime - self.soak_start if self.soak_start is not None else 0.
+        return {
+            "soak_state": self.state,
+            "soak_elapsed": elapsed,
+            "soak_remaining": self.remaining,
+            "soak_time_constant": self.tau,
+            "soak_power_trend": self.power_trend,
+        }
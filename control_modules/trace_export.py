@@ -0,0 +1,159 @@
+# ApeControl-Klipper calibration trace export
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Streams samples to disk on a background thread so the reactor never waits
+# on file io. Samples are kept in a bounded buffer and written as blocks of
+# little endian float64 columns:
+#
+#   b"APETRACE1\n", uint32 header length, json header {"columns": [...], ...}
+#   per block: uint32 sample count, then one float64 array per column
+#
+# python trace_export.py <file.apetrace> [out.csv] converts a trace to csv.
+import json, logging, os, struct, sys, threading, time
+from array import array
+from collections import deque
+
+MAGIC = b"APETRACE1\n"
+BLOCK_SIZE = 1024 # samples per written block
+MAX_BUFFER = 64 * BLOCK_SIZE # samples held in memory, newer samples are dropped beyond this
+FLUSH_INTERVAL = 2. # [s] the writer thread wakes at least this often
+EXTENSION = ".apetrace"
+
+
+def trace_filename(directory, heater_name, label, now=None):
+    """Timestamped trace path, one file per heater and test"""
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(now))
+    return os.path.join(directory, "%s_%s_%s%s" % (heater_name, label, stamp, EXTENSION))
+
+
+class TraceWriter:
+    """Background trace writer
+
+    record() only appends a tuple to a deque and is safe to call from the
+    reactor. close() returns immediately, the thread writes what is left,
+    optionally converts the trace to csv and exits.
+    """
+    def __init__(self, filename, columns, info=None, max_buffer=MAX_BUFFER):
+        self.filename = filename
+        self.columns = list(columns)
+        self.info = info or {}
+        self.max_buffer = max_buffer
+        self.buffer = deque()
+        self.dropped = 0
+        self.written = 0
+        self.closing = False
+        self.write_csv = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name="ape-trace", daemon=True)
+        self.thread.start()
+
+    def record(self, *values):
+        if len(self.buffer) >= self.max_buffer:
+            self.dropped += 1
+            return
+        self.buffer.append(values)
+        if len(self.buffer) == BLOCK_SIZE:
+            with self.cond:
+                self.cond.notify()
+
+    def close(self, csv=False, wait=False):
+        with self.cond:
+            self.write_csv = csv
+            self.closing = True
+            self.cond.notify()
+        if wait:
+            self.thread.join()
+
+    # Writer thread
+    def _run(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename) or '.', exist_ok=True)
+            with open(self.filename, 'wb') as f:
+                header = dict(self.info, columns=self.columns)
+                data = json.dumps(header).encode()
+                f.write(MAGIC + struct.pack('<I', len(data)) + data)
+                while True:
+                    with self.cond:
+                        if not self.closing and len(self.buffer) < BLOCK_SIZE:
+                            self.cond.wait(FLUSH_INTERVAL)
+                        closing = self.closing
+                    while self.buffer:
+                        self._write_block(f)
+                    f.flush()
+                    if closing:
+                        break
+            if self.dropped:
+                logging.warning("ApeControl: trace %s dropped %d samples (buffer full)",
+                                self.filename, self.dropped)
+            if self.write_csv:
+                convert_to_csv(self.filename)
+        except (IOError, OSError) as e:
+            self.error = str(e)
+            self.buffer.clear()
+            logging.exception("ApeControl: unable to write trace %s", self.filename)
+
+    def _write_block(self, f):
+        buffer = self.buffer
+        count = min(len(buffer), BLOCK_SIZE)
+        cols = [array('d') for _ in self.columns]
+        for _ in range(count):
+            for col, value in zip(cols, buffer.popleft()):
+                col.append(value)
+        if sys.byteorder != 'little':
+            for col in cols:
+                col.byteswap()
+        f.write(struct.pack('<I', count))
+        for col in cols:
+            f.write(col.tobytes())
+        self.written += count
+
+
+def read_trace(filename):
+    """Return (header, generator of sample rows) of a trace file"""
+    f = open(filename, 'rb')
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError("%s is not an ApeControl trace" % (filename,))
+    size, = struct.unpack('<I', f.read(4))
+    header = json.loads(f.read(size).decode())
+    ncols = len(header['columns'])
+
+    def rows():
+        with f:
+            while True:
+                raw = f.read(4)
+                if len(raw) < 4:
+                    return
+                count, = struct.unpack('<I', raw)
+                cols = []
+                for _ in range(ncols):
+                    col = array('d')
+                    col.frombytes(f.read(8 * count))
+                    if sys.byteorder != 'little':
+                        col.byteswap()
+                    cols.append(col)
+                for row in zip(*cols):
+                    yield row
+    return header, rows()
+
+
+def convert_to_csv(filename, out_filename=None):
+    if out_filename is None:
+        out_filename = os.path.splitext(filename)[0] + ".csv"
+    header, rows = read_trace(filename)
+    with open(out_filename, 'w') as out:
+        out.write(",".join(header['columns']) + "\n")
+        for row in rows:
+            out.write(",".join(["%.6g" % (v,) for v in row]) + "\n")
+    return out_filename
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        sys.stderr.write("usage: trace_export.py <file%s> [out.csv]\n" % (EXTENSION,))
+        sys.exit(1)
+    print(convert_to_csv(*sys.argv[1:]))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# ApeControl passive heater identification from recorded print data
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Usage:
+#   ape_identify.py klippy.log --heater extruder [--heater-power 40]
+#   ape_identify.py recording.csv [--heater-power 40]
+#
+# klippy.log input uses the periodic "Stats" lines (temperature and pwm only).
+# CSV input needs 'time', 'temp' and 'pwm' columns, 'fan' and
+# 'extrude_velocity' are used when present.
+import argparse, csv, os, re, sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from control_modules.passive_ident import PassiveIdentifier
+
+STATS_RE = re.compile(r'^Stats (\d+(?:\.\d+)?):')
+
+def read_klippy_log(path, heater):
+    """Yield (time, temp, pwm, fan, ev) from klippy.log Stats lines"""
+    heater_re = re.compile(r'\b%s: target=(\S+) temp=(\S+) pwm=(\S+)' % (re.escape(heater),))
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            m = STATS_RE.match(line)
+            if m is None:
+                continue
+            h = heater_re.search(line)
+            if h is None:
+                continue
+            yield float(m.group(1)), float(h.group(2)), float(h.group(3)), 0., 0.
+
+def read_csv(path):
+    """Yield (time, temp, pwm, fan, ev) from a csv recording"""
+    with open(path, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            yield (float(row['time']), float(row['temp']), float(row['pwm']),
+                   float(row.get('fan') or 0.), float(row.get('extrude_velocity') or 0.))
+
+def format_result(res):
+    lines = ["samples: %d, residual std: %.4f degC/s" % (res['samples'], res['residual_std']),
+             "",
+             "pp_control (FOPDT):",
+             "  tau       = %.2f s   (+/- %.1f%%)" % (res['tau'], 100. * res['tau_rel_std']),
+             "  dead_time = %.2f s" % (res['dead_time'],),
+             "  gain      = %.1f degC per unit pwm (+/- %.1f%%)" % (res['gain'], 100. * res['gain_rel_std']),
+             "  ss_map    = %.6g, 0   (ss_map_ambient %.1f)" % (res['k_ss'], res['ambient_temp']),
+             "  fan gain  = %.3f (+/- %.1f%%)" % (res['fan_gain'], 100. * res['fan_rel_std'])]
+    if 'block_heat_capacity' in res:
+        lines += ["",
+                  "mpc:",
+                  "  block_heat_capacity   = %.4g J/K (+/- %.1f%%)" % (
+                      res['block_heat_capacity'], 100. * res['block_heat_capacity_rel_std']),
+                  "  ambient_transfer      = %.4g W/K (+/- %.1f%%)" % (
+                      res['ambient_transfer'], 100. * res['ambient_transfer_rel_std']),
+                  "  fan_ambient_transfer  = %s W/K" % (
+                      ", ".join(["%.4g" % v for v in res['fan_ambient_transfer']]),),
+                  "  sensor_responsiveness = %.4g K/s/K (from dead time)" % (
+                      res['sensor_responsiveness'],)]
+    return "\n".join(lines)
+
+def main():
+    parser = argparse.ArgumentParser(description="Identify a heater model from recorded print data")
+    parser.add_argument('files', nargs='+', help="klippy.log or csv recordings, in time order")
+    parser.add_argument('--heater', default='extruder', help="heater name in klippy.log Stats lines")
+    parser.add_argument('--heater-power', type=float, default=None,
+                        help="heater wattage, enables the MPC parameters")
+    parser.add_argument('--period', type=float, default=1.0, help="resample period [s]")
+    parser.add_argument('--max-delay', type=float, default=30., help="largest dead time searched [s]")
+    parser.add_argument('--forgetting', type=float, default=1.0,
+                        help="RLS forgetting factor, <1 tracks a drifting model")
+    args = parser.parse_args()
+
+    ident = PassiveIdentifier(period=args.period, max_delay=args.max_delay,
+                              forgetting=args.forgetting, heater_power=args.heater_power)
+    for path in args.files:
+        if path.endswith('.csv'):
+            samples = read_csv(path)
+        else:
+            samples = read_klippy_log(path, args.heater)
+        for time, temp, pwm, fan, ev in samples:
+            ident.feed(time, temp, pwm, fan, ev)
+        # Separate files are not continuous
+        ident.reset_history()
+    res = ident.result()
+    if res is None:
+        sys.stderr.write("Not enough excitation in the recording to identify a model\n")
+        sys.exit(1)
+    print(format_result(res))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# ApeControl klippy.log analyzer for controller performance across machines
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Usage:
+#   ape_logstats.py logs/*/klippy.log* [--group dir] [--jobs 8] [--series out/]
+#
+# Parses the PP-Control "Control Effort" and "state transition" lines, the
+# PP_CALIBRATE reports and the MPC_CALIBRATE first/second pass results. Every
+# file is read line by line into running summaries (constant memory), files
+# are analyzed in parallel by a process pool and merged per group (machine).
+# Older logs without time stamp and heater name in the Control Effort lines
+# are attributed to the heater 'extruder' (--heater) and timed by the state
+# transitions around them.
+import argparse, ast, csv, gzip, json, os, re, sys
+from multiprocessing import Pool
+
+FLOAT = r'(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|nan|-?inf)'
+EFFORT_RE = re.compile(r'(?:\[%s\] )?PP-Control(?: (\S+))?: Control Effort: FB_PWM: %s, '
+                       r'FF_PWM: %s, FF_ev: %s' % (FLOAT, FLOAT, FLOAT, FLOAT))
+TRANSITION_RE = re.compile(r'\[%s\] PP-Control(?: (\S+))?: state transition: (\S+) -> (\S+)'
+                           % (FLOAT,))
+CAL_START_RE = re.compile(r"Heater object '(\S+)' controller exchanged with (\S+) algorithm")
+PP_CAL_RE = re.compile(r'PP-AutoTune: Kss=%s,Ku=%s,Tu=%s,omega_u=%s,tau=%s,L=%s' % ((FLOAT,) * 6))
+PP_PID_RE = re.compile(r'PP-AutoTune: AMIGO-PID values Kp=%s, Ki=%s, Kd=%s' % ((FLOAT,) * 3))
+MPC_PASS_RE = re.compile(r'(First|Second) pass: (\{.*\})')
+RESTART_RE = re.compile(r'^Start printer at ')
+STATES = ["off", "max_power", "coast_up", "coast_down", "min_power", "regulate"]
+MAX_GAP = 60. # [s] larger gaps between samples of a heater do not count as heater time
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, 'r', errors='replace')
+
+
+def parse_log(path, default_heater='extruder'):
+    """Yield (kind, heater, time, data) events from one log file
+
+    kind is 'effort' (fb, ff, ff_ev), 'transition' (from, to), 'restart',
+    'pp_calibration' or 'mpc_calibration' (dict). time is None when the log
+    line has no time stamp.
+    """
+    cal_heater = default_heater
+    pp_cal = None
+    with open_log(path) as f:
+        for line in f:
+            if 'PP-Control' in line:
+                m = EFFORT_RE.search(line)
+                if m is not None:
+                    t, heater, fb, ff, ff_ev = m.groups()
+                    yield ('effort', heater or default_heater,
+                           float(t) if t is not None else None,
+                           (float(fb), float(ff), float(ff_ev)))
+                    continue
+                m = TRANSITION_RE.search(line)
+                if m is not None:
+                    t, heater, prev_state, next_state = m.groups()
+                    yield ('transition', heater or default_heater, float(t),
+                           (prev_state, next_state))
+                continue
+            if RESTART_RE.match(line):
+                yield ('restart', None, None, None)
+                continue
+            if 'ApeControl: Heater object' in line:
+                m = CAL_START_RE.search(line)
+                if m is not None:
+                    cal_heater = m.group(1)
+                continue
+            if 'PP-AutoTune:' in line:
+                m = PP_CAL_RE.search(line)
+                if m is not None:
+                    pp_cal = dict(zip(['Kss', 'Ku', 'Tu', 'omega_u', 'tau', 'L'],
+                                      map(float, m.groups())))
+                    continue
+                m = PP_PID_RE.search(line)
+                if m is not None and pp_cal is not None:
+                    pp_cal.update(zip(['pid_kp', 'pid_ki', 'pid_kd'], map(float, m.groups())))
+                    yield ('pp_calibration', cal_heater, None, pp_cal)
+                    pp_cal = None
+                continue
+            if ' pass: {' in line:
+                m = MPC_PASS_RE.search(line)
+                if m is not None:
+                    try:
+                        res = ast.literal_eval(m.group(2))
+                    except (ValueError, SyntaxError):
+                        continue
+                    yield ('mpc_calibration', None, None, dict(res, pass_=m.group(1).lower()))
+
+
+class HeaterStats:
+    """Running summary of one heater, mergeable over files"""
+    def __init__(self):
+        self.state_time = dict.fromkeys(STATES, 0.)
+        self.transitions = 0
+        self.regulate_exits = 0 # regulate -> max/min power, the feedback lost the target
+        self.updates = 0
+        self.fb_sum = self.ff_sum = self.abs_fb_sum = self.abs_ff_sum = self.ev_sum = 0.
+        self.fb_saturated = 0
+        self.calibrations = []
+        # Per file position, not merged
+        self.state = None
+        self.last_time = None
+
+    def _advance(self, t):
+        if t is None:
+            return
+        if self.last_time is not None and self.state in self.state_time:
+            dt = t - self.last_time
+            if 0. < dt <= MAX_GAP:
+                self.state_time[self.state] += dt
+        if self.last_time is None or t >= self.last_time or t < self.last_time - MAX_GAP:
+            self.last_time = t
+
+    def effort(self, t, data):
+        fb, ff, ff_ev = data
+        self._advance(t)
+        self.updates += 1
+        self.fb_sum += fb
+        self.ff_sum += ff
+        self.abs_fb_sum += abs(fb)
+        self.abs_ff_sum += abs(ff)
+        self.ev_sum += ff_ev
+        if abs(fb) >= 0.999:
+            self.fb_saturated += 1
+
+    def transition(self, t, data):
+        prev_state, next_state = data
+        self._advance(t)
+        self.state = next_state
+        self.transitions += 1
+        if prev_state == "regulate" and next_state in ("max_power", "min_power"):
+            self.regulate_exits += 1
+        self.state_time.setdefault(next_state, 0.)
+
+    def restart(self):
+        self.state = None
+        self.last_time = None
+
+    def merge(self, other):
+        for state, t in other.state_time.items():
+            self.state_time[state] = self.state_time.get(state, 0.) + t
+        for key in ('transitions', 'regulate_exits', 'updates', 'fb_sum', 'ff_sum',
+                    'abs_fb_sum', 'abs_ff_sum', 'ev_sum', 'fb_saturated'):
+            setattr(self, key, getattr(self, key) + getattr(other, key))
+        self.calibrations.extend(other.calibrations)
+
+    def summary(self):
+        total = sum(self.state_time.values())
+        hours = total / 3600.
+        effort = self.abs_fb_sum + self.abs_ff_sum
+        return {
+            'heater_time': total,
+            'state_share': {s: t / total for s, t in self.state_time.items() if t} if total else {},
+            'updates': self.updates,
+            'transitions': self.transitions,
+            'transitions_per_hour': self.transitions / hours if hours else None,
+            'regulate_exits_per_hour': self.regulate_exits / hours if hours else None,
+            'mean_fb': self.fb_sum / self.updates if self.updates else None,
+            'mean_ff': self.ff_sum / self.updates if self.updates else None,
+            'mean_ff_ev': self.ev_sum / self.updates if self.updates else None,
+            'fb_share': self.abs_fb_sum / effort if effort else None,
+            'fb_saturated': self.fb_saturated / self.updates if self.updates else None,
+            'calibrations': self.calibrations,
+        }
+
+
+class SeriesWriter:
+    """Per heater csv time series of one file, written while parsing"""
+    def __init__(self, directory, source):
+        self.directory = directory
+        # Parent directory (machine) and file name, rotated logs share the name
+        parent = os.path.basename(os.path.dirname(os.path.abspath(source)))
+        self.base = ("%s_%s" % (parent, os.path.basename(source))).replace('.', '_')
+        self.files = {}
+        self.state = {}
+
+    def write(self, kind, heater, t, data):
+        if kind == 'transition':
+            self.state[heater] = data[1]
+            return
+        if heater not in self.files:
+            f = open(os.path.join(self.directory, "%s_%s.csv" % (self.base, heater)), 'w', newline='')
+            writer = csv.writer(f)
+            writer.writerow(['time', 'state', 'fb_pwm', 'ff_pwm', 'ff_ev'])
+            self.files[heater] = (f, writer)
+        self.files[heater][1].writerow(['' if t is None else "%.3f" % (t,),
+                                        self.state.get(heater, '')] + ["%.4f" % (v,) for v in data])
+
+    def close(self):
+        for f, _ in self.files.values():
+            f.close()
+
+
+def analyze_file(job):
+    path, default_heater, series_dir = job
+    heaters = {}
+    mpc_calibrations = []
+    series = SeriesWriter(series_dir, path) if series_dir else None
+    try:
+        for kind, heater, t, data in parse_log(path, default_heater):
+            if kind == 'restart':
+                for stats in heaters.values():
+                    stats.restart()
+                continue
+            if kind == 'mpc_calibration':
+                mpc_calibrations.append(data)
+                continue
+            stats = heaters.get(heater)
+            if stats is None:
+                stats = heaters[heater] = HeaterStats()
+            if kind == 'effort':
+                stats.effort(t, data)
+                if series is not None:
+                    series.write(kind, heater, t, data)
+            elif kind == 'transition':
+                stats.transition(t, data)
+                if series is not None:
+                    series.write(kind, heater, t, data)
+            elif kind == 'pp_calibration':
+                stats.calibrations.append(data)
+    except (IOError, OSError, EOFError) as e:
+        sys.stderr.write("%s: %s\n" % (path, e))
+    finally:
+        if series is not None:
+            series.close()
+    return path, heaters, mpc_calibrations
+
+
+def group_key(path, mode):
+    if mode == 'file':
+        return path
+    if mode == 'dir':
+        return os.path.dirname(os.path.abspath(path))
+    return 'all'
+
+
+def format_group(name, heaters, mpc_calibrations):
+    lines = [name]
+    for heater, stats in sorted(heaters.items()):
+        s = stats.summary()
+        share = ", ".join("%s %.0f%%" % (state, 100. * v) for state, v in s['state_share'].items())
+        lines.append("  %s: %.1f h, %d updates, %d transitions" % (
+            heater, s['heater_time'] / 3600., s['updates'], s['transitions']))
+        if s['transitions_per_hour'] is not None:
+            lines.append("    transitions/h %.1f, regulate exits/h %.1f" % (
+                s['transitions_per_hour'], s['regulate_exits_per_hour']))
+        if share:
+            lines.append("    time in state: %s" % (share,))
+        if s['updates']:
+            lines.append("    mean FB %.3f, mean FF %.3f (ev %.3f), FB share %.0f%%, FB saturated %.1f%%"
+                         % (s['mean_fb'], s['mean_ff'], s['mean_ff_ev'], 100. * s['fb_share'],
+                            100. * s['fb_saturated']))
+        for cal in s['calibrations']:
+            lines.append("    PP_CALIBRATE: %s" % (", ".join("%s=%.4g" % kv for kv in cal.items()),))
+    for cal in mpc_calibrations:
+        keys = ('block_heat_capacity', 'ambient_transfer', 'sensor_responsiveness')
+        lines.append("  MPC_CALIBRATE %s pass: %s" % (cal['pass_'], ", ".join(
+            "%s=%.4g" % (k, cal[k]) for k in keys if k in cal)))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize ApeControl controller behavior from klippy.log files")
+    parser.add_argument('files', nargs='+', help="klippy.log files, rotated and .gz logs included")
+    parser.add_argument('--group', choices=['file', 'dir', 'all'], default='dir',
+                        help="merge results per file, per directory (machine) or over all files")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--heater', default='extruder',
+                        help="heater of log lines without a heater name (older versions)")
+    parser.add_argument('--series', default=None, metavar='DIR',
+                        help="write the reconstructed per heater time series as csv to DIR")
+    parser.add_argument('--json', action='store_true', help="print the summaries as json")
+    args = parser.parse_args()
+    if args.series:
+        os.makedirs(args.series, exist_ok=True)
+
+    groups = {}
+    jobs = [(path, args.heater, args.series) for path in args.files]
+    with Pool(max(1, args.jobs)) as pool:
+        for path, heaters, mpc_cal in pool.imap_unordered(analyze_file, jobs):
+            group = groups.setdefault(group_key(path, args.group), ({}, []))
+            for heater, stats in heaters.items():
+                if heater in group[0]:
+                    group[0][heater].merge(stats)
+                else:
+                    group[0][heater] = stats
+            group[1].extend(mpc_cal)
+
+    if args.json:
+        out = {name: {'heaters': {h: s.summary() for h, s in heaters.items()},
+                      'mpc_calibrations': mpc_cal}
+               for name, (heaters, mpc_cal) in groups.items()}
+        print(json.dumps(out, indent=1, sort_keys=True))
+        return
+    for name in sorted(groups):
+        print(format_group(name, *groups[name]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# ApeControl Monte Carlo robustness analysis of tuned controller parameters
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Usage:
+#   ape_montecarlo.py --config printer.cfg [--section "ape_control extruder"]
+#                     [--plant hotend] [--runs 2000] [--heat-capacity 15]
+#                     [--dead-time 30] [--fan-transfer 30] [--noise 0.02,0.2]
+#
+# Every [ape_control ...] section of the config (SAVE_CONFIG results
+# included) is one candidate, --builtin adds the thermal_sim defaults of each
+# architecture. Each run draws a plant around the nominal one (uniform within
+# +/- the given percentages), heats from ambient to the target with the part
+# fan at --fan and records overshoot, settling time and whether the error
+# still oscillates over the last --tail seconds. Runs are spread over a
+# process pool; a candidate is deployable across a batch of nominally
+# identical heaters when its tail percentiles are acceptable.
+import argparse, configparser, logging, math, os, random
+from multiprocessing import Pool
+
+from thermal_sim import DEFAULT_OPTIONS, PLANT_PRESETS, HeaterPlant, Simulation
+
+AUTOSAVE_PREFIX = "#*# "
+PERCENTILES = (5, 50, 95, 99)
+
+
+def read_sections(path, wanted=None):
+    """[ape_control ...] options of a printer.cfg, SAVE_CONFIG values override"""
+    with open(path, 'r') as f:
+        lines = f.read().splitlines()
+    main, autosave = [], []
+    for line in lines:
+        if line.startswith(AUTOSAVE_PREFIX.rstrip()):
+            line = line[len(AUTOSAVE_PREFIX):]
+            if autosave or line.startswith('['): # skip the SAVE_CONFIG banner
+                autosave.append(line)
+        else:
+            main.append(line)
+    sections = {}
+    for text in ("\n".join(main), "\n".join(autosave)):
+        parser = configparser.RawConfigParser(strict=False, inline_comment_prefixes=('#', ';'))
+        parser.read_string(text)
+        for name in parser.sections():
+            if not name.startswith('ape_control ') or (wanted and name != wanted):
+                continue
+            sections.setdefault(name, {}).update(parser.items(name))
+    return sections
+
+
+class OscillationMonitor:
+    """Limit cycle check over the last 'tail' seconds of a run
+
+    The error is low pass filtered so sensor noise alone does not count, then
+    crossings of its mean (with hysteresis) and its range are evaluated.
+    """
+    def __init__(self, start, band, filter_time=1.5):
+        self.start = start
+        self.band = band
+        self.filter_time = filter_time
+        self.error = None
+        self.last_time = None
+        self.errors = []
+
+    def update(self, read_time, temp, target_temp, pwm):
+        if read_time < self.start or target_temp <= 0.:
+            return
+        error = temp - target_temp
+        if self.error is None:
+            self.error = error
+        else:
+            dt = read_time - self.last_time
+            self.error += (error - self.error) * dt / (dt + self.filter_time)
+        self.last_time = read_time
+        self.errors.append(self.error)
+
+    def oscillating(self):
+        if not self.errors:
+            return False
+        mean = sum(self.errors) / len(self.errors)
+        hysteresis = .2 * self.band
+        crossings = sign = 0
+        for error in self.errors:
+            error -= mean
+            new_sign = 1 if error > hysteresis else -1 if error < -hysteresis else 0
+            if new_sign and new_sign != sign:
+                crossings += sign != 0
+                sign = new_sign
+        return crossings >= 4 and max(self.errors) - min(self.errors) > .5 * self.band
+
+
+def draw_plant(nominal, spread, rng):
+    params = dict(nominal)
+    for key, pct in spread.items():
+        if key in params and pct:
+            params[key] *= 1. + rng.uniform(-pct, pct) / 100.
+    return params
+
+
+def run_one(job):
+    name, control, options, nominal, spread, noise, target, args, seed = job
+    rng = random.Random(seed)
+    params = draw_plant(nominal, spread, rng)
+    params['noise'] = rng.uniform(*noise)
+    sim = Simulation(control, options, plant=HeaterPlant(**params),
+                     report_time=args.report_time, seed=seed, jitter=args.jitter)
+    monitor = OscillationMonitor(args.duration - args.tail, args.settle_band)
+    sim.controller.monitors.append(monitor)
+    sim.kpis.settle_band = args.settle_band
+    sim.run(args.duration, target=lambda now: target, fan=lambda now: args.fan)
+    step = sim.kpis.get_status(0.).get('current', {})
+    return (name, params, step.get('overshoot', 0.), step.get('settling_time'),
+            monitor.oscillating(), step.get('steady_state_rms'))
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * pct / 100.
+    lo = int(math.floor(k))
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def fmt(value, spec="%.2f"):
+    return "n/a" if value is None else spec % (value,)
+
+
+def report(name, control, results, args):
+    overshoot = [r[2] for r in results]
+    settled = [r[3] for r in results if r[3] is not None]
+    oscillating = sum(1 for r in results if r[4])
+    unsettled = len(results) - len(settled)
+    print("%s (%s), %d runs:" % (name, control, len(results)))
+    print("  overshoot [degC]   " + "  ".join("P%d %s" % (p, fmt(percentile(overshoot, p)))
+                                             for p in PERCENTILES))
+    print("  settling time [s]  " + "  ".join("P%d %s" % (p, fmt(percentile(settled, p), "%.0f"))
+                                             for p in PERCENTILES))
+    print("  not settled within %.0fs: %.1f%%, oscillating at the end: %.1f%%"
+          % (args.duration, 100. * unsettled / len(results), 100. * oscillating / len(results)))
+    worst = max(results, key=lambda r: (r[4], r[3] is None, r[2]))
+    print("  worst run: overshoot %s, settling %s, plant %s" % (
+        fmt(worst[2]), fmt(worst[3], "%.0f"),
+        ", ".join("%s=%.4g" % kv for kv in sorted(worst[1].items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monte Carlo robustness of tuned ApeControl parameters")
+    parser.add_argument('--config', action='append', default=[], help="printer.cfg with [ape_control] sections")
+    parser.add_argument('--section', default=None, help="only this section, e.g. 'ape_control extruder'")
+    parser.add_argument('--builtin', action='store_true', help="also run the thermal_sim defaults")
+    parser.add_argument('--plant', default='hotend', choices=sorted(PLANT_PRESETS))
+    parser.add_argument('--plant-param', action='append', default=[], metavar='KEY=VALUE',
+                        help="override a nominal plant parameter (heat_capacity, dead_time, ...)")
+    parser.add_argument('--target', type=float, default=None)
+    parser.add_argument('--runs', type=int, default=1000, help="runs per candidate")
+    parser.add_argument('--heat-capacity', type=float, default=15., help="+/- percent")
+    parser.add_argument('--ambient-transfer', type=float, default=10., help="+/- percent")
+    parser.add_argument('--dead-time', type=float, default=30., help="+/- percent")
+    parser.add_argument('--fan-transfer', type=float, default=30., help="+/- percent")
+    parser.add_argument('--sensor-responsiveness', type=float, default=20., help="+/- percent")
+    parser.add_argument('--heater-power', type=float, default=5., help="+/- percent")
+    parser.add_argument('--noise', default='0.02,0.2', help="sensor noise std range [degC]")
+    parser.add_argument('--fan', type=float, default=0.5, help="part fan speed during the run")
+    parser.add_argument('--duration', type=float, default=900.)
+    parser.add_argument('--tail', type=float, default=180., help="oscillation check window [s]")
+    parser.add_argument('--settle-band', type=float, default=1.)
+    parser.add_argument('--report-time', type=float, default=0.3)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--jobs', type=int, default=os.cpu_count())
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    nominal, default_target = PLANT_PRESETS[args.plant]
+    nominal = dict(nominal)
+    for item in args.plant_param:
+        key, _, value = item.partition('=')
+        if key not in nominal:
+            parser.error("unknown plant parameter '%s'" % (key,))
+        nominal[key] = float(value)
+    target = args.target if args.target is not None else default_target
+    spread = {'heat_capacity': args.heat_capacity, 'ambient_transfer': args.ambient_transfer,
+              'dead_time': args.dead_time, 'fan_transfer': args.fan_transfer,
+              'sensor_responsiveness': args.sensor_responsiveness,
+              'heater_power': args.heater_power}
+    noise = tuple(float(v) for v in args.noise.split(','))
+    if len(noise) == 1:
+        noise = noise * 2
+
+    candidates = []
+    for path in args.config:
+        for name, options in sorted(read_sections(path, args.section).items()):
+            control = options.pop('control', 'pid_control')
+            candidates.append(("%s [%s]" % (os.path.basename(path), name), control, options))
+    if args.builtin:
+        candidates.extend(("thermal_sim default", control, options)
+                          for control, options in sorted(DEFAULT_OPTIONS.items()))
+    if not candidates:
+        parser.error("no candidates, give --config and/or --builtin")
+
+    jobs = [(i, control, options, nominal, spread, noise, target, args, args.seed + run)
+            for i, (_, control, options) in enumerate(candidates)
+            for run in range(args.runs)]
+    results = [[] for _ in candidates]
+    print("%d runs of %.0fs on %s (target %.0f, fan %.2f)"
+          % (len(jobs), args.duration, args.plant, target, args.fan))
+    with Pool(max(1, args.jobs)) as pool:
+        for res in pool.imap_unordered(run_one, jobs, chunksize=8):
+            results[res[0]].append(res)
+    for (name, control, _), res in zip(candidates, results):
+        report(name, control, res, args)
+
+
+if __name__ == '__main__':
+    main()
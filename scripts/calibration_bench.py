@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# ApeControl calibration benchmark against synthetic heaters
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Runs PP_CALIBRATE's ControlAutoTune relay test and MPC_CALIBRATE's heat-up
+# (process_first_pass) and transfer (process_second_pass) analysis against
+# simulated heaters with known parameters, sensor noise, quantization and
+# report jitter. Reports the identification error per parameter, the
+# simulated heater time and the host wall time of each calibration.
+# PP truth is the first order plus dead time view of the plant (sensor lag
+# counted as dead time), so part of its error is the model structure itself.
+#
+# Usage:
+#   calibration_bench.py [--plants hotend,hotend_fast,bed] [--seeds 5]
+#                        [--noise 0.05] [--quantization 0.01] [--jitter 0.1]
+import argparse, logging, math, os, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from control_modules.pp_calibrate import ControlAutoTune
+from control_modules.mpc_control import MpcCalibrate, TuningControl
+from thermal_sim import PLANT_PRESETS, HeaterPlant, Simulation
+
+PLANTS = PLANT_PRESETS # name: (plant parameters, calibration target)
+MAX_CAL_TIME = 6. * 3600. # [s] simulated time limit of one calibration
+FAN_SPEEDS = [0., .5, 1.]
+
+
+def pp_truth(p, target):
+    ambient = p.get('ambient', 25.)
+    hold = p['ambient_transfer'] * (target - ambient) / p['heater_power']
+    return {
+        'tau': p['heat_capacity'] / p['ambient_transfer'],
+        # First order plus dead time approximation: the sensor lag adds to the dead time
+        'L': p['dead_time'] + 1. / p['sensor_responsiveness'],
+        'Kss': hold / target,
+    }
+
+
+def bench_pp(p, target, args, seed):
+    sim = Simulation(plant=HeaterPlant(noise=args.noise, **p), report_time=args.report_time,
+                     seed=seed, jitter=args.jitter, quantization=args.quantization)
+    start = time.perf_counter()
+    cal = ControlAutoTune(sim.heater, target)
+    sim.heater.set_control(cal)
+    sim.heater.set_temp(target)
+    heater_time = sim.run(MAX_CAL_TIME, until=lambda now: not cal.check_busy(now, 0., 0.))
+    try:
+        res = cal.calc_final_fowdt()
+    except Exception as e:
+        return None, heater_time, time.perf_counter() - start, str(e)
+    est = {'tau': res[3], 'L': res[4], 'Kss': res[0]}
+    return est, heater_time, time.perf_counter() - start, None
+
+
+def mpc_truth(p, target):
+    return {
+        'block_heat_capacity': p['heat_capacity'],
+        'ambient_transfer': p['ambient_transfer'],
+        'sensor_responsiveness': p['sensor_responsiveness'],
+        'fan_ambient_transfer_max': p['ambient_transfer'] + p['fan_transfer'],
+    }
+
+
+def hold_power(sim, first, ambient, target, fan_speed, settle_time, measure_time, sample_time):
+    """Hold target with a PI around the first pass model, then average the power
+    over the last sample_time of measure_time like MpcCalibrate.measure_power"""
+    heater_power = sim.plant.heater_power
+    h, C = first['ambient_transfer'], first['block_heat_capacity']
+    kp = C / (heater_power * 30.)
+    ki = kp / 60.
+    state = {'integ': 0., 'samples': [], 'measure': False, 'last': None}
+
+    class Hold:
+        def temperature_update(self, read_time, temp, target_temp):
+            err = target - temp
+            dt = read_time - state['last'] if state['last'] is not None else 0.
+            state['last'] = read_time
+            state['integ'] = max(-0.5 / ki, min(0.5 / ki, state['integ'] + err * dt))
+            u = h * (target - ambient) / heater_power + kp * err + ki * state['integ']
+            u = max(0., min(1., u))
+            sim.heater.set_pwm(read_time, u)
+            if state['measure']:
+                state['samples'].append((dt, u * heater_power * dt))
+
+        def check_busy(self, eventtime, smoothed_temp, target_temp):
+            return True
+    sim.heater.set_control(Hold())
+    sim.heater.set_temp(target)
+    sim.fan['speed'] = fan_speed
+    elapsed = sim.run(settle_time)
+    state['measure'] = True
+    elapsed += sim.run(measure_time)
+    energy = dt_sum = 0.
+    for dt, e in reversed(state['samples']):
+        energy += e
+        dt_sum += dt
+        if dt_sum > sample_time:
+            break
+    return energy / dt_sum, elapsed
+
+
+def bench_mpc(p, target, args, seed):
+    plant = HeaterPlant(noise=args.noise, **p)
+    sim = Simulation(plant=plant, report_time=args.report_time, seed=seed,
+                     jitter=args.jitter, quantization=args.quantization)
+    start = time.perf_counter()
+    cal = MpcCalibrate(sim.printer, sim.heater, None)
+    control = TuningControl(sim.heater)
+    sim.heater.set_control(control)
+    ambient = plant.read(sim.rng) # heater starts at ambient, await_ambient returns the reading
+    threshold = max(50.0, min(100, target - 100.0))
+    control.set_output(sim.heater.get_max_power(), target)
+    control.logging = True
+    heater_time = sim.run(MAX_CAL_TIME, until=lambda now: sim.heater.smoothed_temp >= target)
+    control.logging = False
+    try:
+        first = cal.process_first_pass(control.log, plant.heater_power, ambient,
+                                       threshold, args.use_analytic)
+        hold_target = round(first['post_block_temp'])
+        tau = first['block_heat_capacity'] / first['ambient_transfer']
+        settle = min(8. * tau, 3600.)
+        fan_powers = []
+        for speed in FAN_SPEEDS:
+            power, elapsed = hold_power(sim, first, ambient, hold_target, speed,
+                                        settle, 20., 5.)
+            heater_time += elapsed
+            fan_powers.append((speed, power))
+        sim.fan['speed'] = 0.
+        transfer = {'target_temp': hold_target, 'base_power': fan_powers[0][1],
+                    'fan_powers': fan_powers}
+        second = cal.process_second_pass(first, transfer, ambient, plant.heater_power)
+    except (ValueError, ZeroDivisionError, TypeError, IndexError) as e:
+        return None, heater_time, time.perf_counter() - start, str(e)
+    use_second = args.use_analytic
+    est = {
+        'block_heat_capacity': (second if use_second else first)['block_heat_capacity'],
+        'ambient_transfer': second['ambient_transfer'],
+        'sensor_responsiveness': (second if use_second else first)['sensor_responsiveness'],
+        'fan_ambient_transfer_max': second['fan_ambient_transfer'][-1],
+    }
+    return est, heater_time, time.perf_counter() - start, None
+
+
+ALGORITHMS = [('PP_CALIBRATE', bench_pp, pp_truth), ('MPC_CALIBRATE', bench_mpc, mpc_truth)]
+
+
+def summarize(values):
+    mean = sum(values) / len(values)
+    std = math.sqrt(sum((v - mean) ** 2 for v in values) / len(values))
+    return mean, std
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--plants', default=','.join(PLANTS))
+    parser.add_argument('--seeds', type=int, default=3)
+    parser.add_argument('--noise', type=float, default=0.05, help="sensor noise std [degC]")
+    parser.add_argument('--quantization', type=float, default=0.01, help="sensor resolution [degC]")
+    parser.add_argument('--jitter', type=float, default=0.1, help="report interval spread (fraction)")
+    parser.add_argument('--report-time', type=float, default=0.3)
+    parser.add_argument('--use-analytic', action='store_true',
+                        help="MPC_CALIBRATE USE_DELTA=1 (asymptotic method)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for plant_name in args.plants.split(','):
+        params, target = PLANTS[plant_name]
+        print("%s (target %.0f):" % (plant_name, target))
+        for algo, bench, truth_fn in ALGORITHMS:
+            truth = truth_fn(params, target)
+            errors = {key: [] for key in truth}
+            estimates = {key: [] for key in truth}
+            heater_times, wall_times, failures = [], [], []
+            for seed in range(args.seeds):
+                est, heater_time, wall_time, failure = bench(params, target, args, seed)
+                heater_times.append(heater_time)
+                wall_times.append(wall_time)
+                if est is None:
+                    failures.append(failure)
+                    continue
+                for key, value in truth.items():
+                    estimates[key].append(est[key])
+                    errors[key].append(100. * (est[key] - value) / value)
+            print("  %s: simulated heater time %.0fs, host time %.2fs per run%s"
+                  % (algo, summarize(heater_times)[0], summarize(wall_times)[0],
+                     ", %d/%d failed (%s)" % (len(failures), args.seeds, failures[0])
+                     if failures else ""))
+            for key, value in truth.items():
+                if not errors[key]:
+                    continue
+                err_mean, err_std = summarize(errors[key])
+                print("    %-26s true %10.5g  estimated %10.5g  error %+7.1f%% (std %.1f%%)"
+                      % (key, value, summarize(estimates[key])[0], err_mean, err_std))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# ApeControl per update cost of the control_modules controllers
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Heats a simulated heater to the target with each controller, then times
+# control_update calls in steady regulation (the state a heater spends hours
+# in) with fresh sensor readings. The shared TempFilter stage (spike
+# rejection and derivative of pid_control and pp_control) is timed on its own.
+#
+# Usage:
+#   control_bench.py [--controls pp_control,pipeline] [--calls 20000]
+#                    [--spike-window 3]
+import argparse, logging, time
+
+from thermal_sim import DEFAULT_OPTIONS, SimConfig, SimPrinter, Simulation
+from control_modules.signal_filter import TempFilter
+
+
+def bench(control, options, args):
+    sim = Simulation(control, options, report_time=args.report_time)
+    sim.run(args.settle, target=lambda now: args.target)
+    controller = sim.controller
+    plant, rng = sim.plant, sim.rng
+    reads = [plant.read(rng) for _ in range(1000)]
+    now = sim.time
+    update = controller.control_update
+    start = time.perf_counter()
+    for i in range(args.calls):
+        update(now + i * args.report_time, reads[i % 1000], args.target)
+    return (time.perf_counter() - start) / args.calls
+
+
+def bench_filter(args):
+    config = SimConfig(SimPrinter(), 'ape_control extruder', {'spike_window': args.spike_window})
+    sim = Simulation(report_time=args.report_time)
+    reads = [sim.plant.read(sim.rng) for _ in range(1000)]
+    temp_filter = TempFilter(config, 2.)
+    update = temp_filter.update
+    start = time.perf_counter()
+    for i in range(args.calls):
+        update(i * args.report_time, reads[i % 1000])
+    return (time.perf_counter() - start) / args.calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time control_update of each controller")
+    parser.add_argument('--controls', default=','.join(sorted(DEFAULT_OPTIONS)))
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--target', type=float, default=200.)
+    parser.add_argument('--settle', type=float, default=600., help="simulated seconds before timing")
+    parser.add_argument('--report-time', type=float, default=0.3)
+    parser.add_argument('--spike-window', type=int, default=3)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    for control in args.controls.split(','):
+        options = dict(DEFAULT_OPTIONS[control], spike_window=args.spike_window)
+        cost = bench(control, options, args)
+        print("%-12s %6.2f us per control_update" % (control, cost * 1e6))
+    print("%-12s %6.2f us per update (spike_window %d)"
+          % ("temp_filter", bench_filter(args) * 1e6, args.spike_window))
+
+
+if __name__ == '__main__':
+    main()
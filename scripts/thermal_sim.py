@@ -0,0 +1,660 @@
+#!/usr/bin/env python3
+# ApeControl closed loop simulation against a synthetic heater
+#
+# Author and code: Molomono
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+#
+# Runs the unmodified control_modules controllers against a simulated heater
+# block (heat capacity, ambient and fan losses, heater dead time) read by a
+# lagging, noisy sensor that reports at a fixed interval, the way Klipper's
+# heater calls temperature_update. Only the printer objects the controllers
+# use are simulated.
+#
+# Usage:
+#   thermal_sim.py [--control pp_control] [--target 200] [--duration 900]
+#   thermal_sim.py --check-decimation
+#   thermal_sim.py --check-allocations
+#   thermal_sim.py --check-filter
+import argparse, logging, os, random, sys, tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from control_modules.kpi_tracker import ControlKPIs
+
+MAX_HEAT_TIME = 3.0 # [s] Klipper's heater pwm refresh deadline
+PLANT_STEP = 0.01 # [s] integration step of the plant
+
+
+class SimConfigError(Exception):
+    pass
+
+
+class SimConfig:
+    """Config section from a dict, values as python values or strings"""
+    error = SimConfigError
+
+    def __init__(self, printer, name, options):
+        self.printer = printer
+        self.name = name
+        self.options = {key.lower(): value for key, value in options.items()}
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def _get(self, option, default, parse, minval=None, maxval=None, above=None, below=None):
+        option = option.lower()
+        if option not in self.options:
+            if default is SimConfigError:
+                raise self.error("Option '%s' in section '%s' must be specified"
+                                 % (option, self.name))
+            return default
+        value = parse(self.options[option])
+        for limit, bad in ((minval, lambda v, l: v < l), (maxval, lambda v, l: v > l),
+                           (above, lambda v, l: v <= l), (below, lambda v, l: v >= l)):
+            if limit is not None and bad(value, limit):
+                raise self.error("Option '%s' in section '%s' out of range" % (option, self.name))
+        return value
+
+    def get(self, option, default=SimConfigError, **kwargs):
+        return self._get(option, default, str)
+
+    def getint(self, option, default=SimConfigError, **kwargs):
+        return self._get(option, default, int, **kwargs)
+
+    def getfloat(self, option, default=SimConfigError, **kwargs):
+        kwargs.pop('note_valid', None)
+        return self._get(option, default, float, **kwargs)
+
+    def getboolean(self, option, default=SimConfigError, **kwargs):
+        return self._get(option, default,
+                         lambda v: v if isinstance(v, bool) else str(v).lower() in ('1', 'true', 'yes', 'on'))
+
+    def getchoice(self, option, choices, default=SimConfigError, **kwargs):
+        return choices[self._get(option, default, str)]
+
+    def getfloatlist(self, option, default=SimConfigError, sep=',', **kwargs):
+        return self._get(option, default,
+                         lambda v: list(v) if isinstance(v, (list, tuple))
+                         else [float(p) for p in v.split(sep) if p.strip()])
+
+    def getlist(self, option, default=SimConfigError, sep=',', **kwargs):
+        return self._get(option, default,
+                         lambda v: list(v) if isinstance(v, (list, tuple))
+                         else [p.strip() for p in v.split(sep) if p.strip()])
+
+
+class SimReactor:
+    NOW = 0.
+
+    def __init__(self):
+        self.now = 0.
+
+    def monotonic(self):
+        return self.now
+
+    def register_timer(self, callback, waketime=NOW):
+        return None
+
+    def register_callback(self, callback):
+        return None
+
+    def register_async_callback(self, callback):
+        return None
+
+
+class SimStatus:
+    def __init__(self, status):
+        self.status = status
+
+    def get_status(self, eventtime=None):
+        return self.status
+
+
+class SimFan(SimStatus):
+    """[fan] object, also its .fan for mpc's cooling_fan
+
+    A new status dict per call, as Klipper's.
+    """
+    def __init__(self, status):
+        SimStatus.__init__(self, status)
+        self.fan = self
+
+    @property
+    def last_fan_value(self):
+        return self.status['speed']
+
+    def get_status(self, eventtime=None):
+        return dict(self.status)
+
+    def set_speed(self, *args, **kwargs):
+        pass
+
+
+class SimGcodeMove:
+    """A new status dict per call, as Klipper's"""
+    def __init__(self, position):
+        self.last_position = position
+
+    def get_status(self, eventtime=None):
+        return {'position': list(self.last_position)}
+
+
+class SimToolhead:
+    def get_extruder(self):
+        return self # no find_past_position, mpc skips the filament model
+
+    def get_heater(self):
+        return None
+
+    def get_last_move_time(self):
+        return 0.
+
+
+class SimGcode:
+    def register_mux_command(self, *args, **kwargs):
+        pass
+
+    def register_command(self, *args, **kwargs):
+        return None
+
+    def respond_info(self, msg):
+        logging.info(msg)
+
+
+class SimPrinter:
+    config_error = SimConfigError
+
+    def __init__(self):
+        self.reactor = SimReactor()
+        self.objects = {'gcode': SimGcode()}
+        self.handlers = {}
+
+    def get_reactor(self):
+        return self.reactor
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def lookup_object(self, name, default=SimConfigError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is SimConfigError:
+            raise self.config_error("Unknown object '%s'" % (name,))
+        return default
+
+    def load_object(self, config, name, default=SimConfigError):
+        return self.lookup_object(name, default)
+
+    def register_event_handler(self, event, callback):
+        self.handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        for callback in self.handlers.get(event, []):
+            callback(*params)
+
+
+class HeaterPlant:
+    """Heater block and sensor
+
+    C dTb/dt = P u(t - dead_time) - (h + h_fan fan) (Tb - Ta)
+    dTs/dt = (Tb - Ts) * sensor_responsiveness
+    """
+    def __init__(self, heat_capacity=20., ambient_transfer=0.15, fan_transfer=0.1,
+                 heater_power=40., dead_time=1.5, sensor_responsiveness=0.5,
+                 ambient=25., noise=0.05):
+        self.heat_capacity = heat_capacity
+        self.ambient_transfer = ambient_transfer
+        self.fan_transfer = fan_transfer
+        self.heater_power = heater_power
+        self.sensor_responsiveness = sensor_responsiveness
+        self.ambient = ambient
+        self.noise = noise
+        self.block_temp = self.sensor_temp = ambient
+        self.delay = deque([0.] * max(1, int(round(dead_time / PLANT_STEP))))
+
+    def step(self, pwm, fan):
+        self.delay.append(pwm)
+        power = self.heater_power * self.delay.popleft()
+        loss = (self.ambient_transfer + self.fan_transfer * fan) * (self.block_temp - self.ambient)
+        self.block_temp += (power - loss) * PLANT_STEP / self.heat_capacity
+        self.sensor_temp += ((self.block_temp - self.sensor_temp)
+                             * self.sensor_responsiveness * PLANT_STEP)
+
+    def read(self, rng):
+        return self.sensor_temp + rng.gauss(0., self.noise)
+
+
+class SimAmbientSensor:
+    """Temperature sensor reading the plant's ambient"""
+    def __init__(self, plant):
+        self.plant = plant
+
+    def get_temp(self, eventtime):
+        return self.plant.ambient, 0.
+
+
+class SimHeater:
+    """The parts of Klipper's Heater the controllers call"""
+    def __init__(self, printer, name, max_power=1.):
+        self.printer = printer
+        self.name = name
+        self.max_power = max_power
+        self.control = None
+        self.target_temp = 0.
+        self.smoothed_temp = 0.
+        self.last_pwm_value = 0.
+        self.last_pwm_time = 0.
+        self.pwm_delay = 0.
+
+    def get_name(self):
+        return self.name
+
+    def set_control(self, control):
+        old, self.control = self.control, control
+        return old
+
+    def set_temp(self, degrees):
+        self.target_temp = degrees
+
+    def alter_target(self, degrees):
+        self.target_temp = degrees
+
+    def get_max_power(self):
+        return self.max_power
+
+    def get_pwm_delay(self):
+        return self.pwm_delay
+
+    def set_pwm(self, read_time, value):
+        self.last_pwm_value = max(0., min(self.max_power, value))
+        self.last_pwm_time = read_time
+
+    def get_temp(self, eventtime):
+        return self.smoothed_temp, self.target_temp
+
+    def get_status(self, eventtime):
+        return {'temperature': self.smoothed_temp, 'target': self.target_temp,
+                'power': self.last_pwm_value}
+
+
+class SimHeaters:
+    def __init__(self):
+        self.heaters = {}
+
+    def lookup_heater(self, name):
+        return self.heaters[name]
+
+
+class Simulation:
+    """One simulated heater, optionally driven by a control_modules controller
+
+    Without 'control' any object can be installed with heater.set_control
+    (calibration routines). Simulated time continues over run() calls.
+    """
+    def __init__(self, control=None, options=None, plant=None, report_time=0.3, seed=0,
+                 heater_name='extruder', jitter=0., quantization=0., objects=None):
+        self.printer = SimPrinter()
+        self.plant = plant if plant is not None else HeaterPlant()
+        self.report_time = report_time
+        self.jitter = jitter # report interval spread, fraction of report_time
+        self.quantization = quantization # [degC] sensor resolution
+        self.rng = random.Random(seed)
+        self.time = 0.
+        self.next_report = report_time
+        self.fan = {'speed': 0.}
+        self.motion = {'live_extruder_velocity': 0.}
+        heaters = SimHeaters()
+        self.heater = heaters.heaters[heater_name] = SimHeater(self.printer, heater_name)
+        self.heater.pwm_delay = report_time
+        self.heater.smoothed_temp = self.plant.sensor_temp
+        for name, obj in (('heaters', heaters), ('fan', SimFan(self.fan)), ('toolhead', SimToolhead()),
+                          ('motion_report', SimStatus(self.motion)),
+                          ('gcode_move', SimGcodeMove([0., 0., 10., 0.]))):
+            self.printer.add_object(name, obj)
+        for name, obj in (objects or {}).items():
+            self.printer.add_object(name, obj(self.plant))
+        self.controller = self.kpis = None
+        if control is not None:
+            config = SimConfig(self.printer, 'ape_control ' + heater_name, options or {})
+            self.controller = load_controller(control, config)
+            self.kpis = ControlKPIs(config)
+            self.controller.monitors = [self.kpis, self]
+            self.heater.set_control(self.controller)
+        self.printer.send_event("klippy:ready")
+        if hasattr(self.controller, 'post_init'):
+            self.controller.post_init()
+        self.control_updates = 0
+        self.pwm_stale = 0. # longest time without a pwm refresh while heating
+
+    def run(self, duration, target=None, fan=None, until=None):
+        """Simulate 'duration' seconds or until until(time) returns True
+
+        target(time) and fan(time) give the setpoint and part fan speed, without
+        'target' the installed control keeps setting it. Returns the simulated
+        seconds.
+        """
+        plant = self.plant
+        heater = self.heater
+        reactor = self.printer.reactor
+        start = self.time
+        steps = int(duration / PLANT_STEP)
+        for i in range(1, steps + 1):
+            now = self.time = start + i * PLANT_STEP
+            reactor.now = now
+            fan_speed = fan(now) if fan is not None else self.fan['speed']
+            self.fan['speed'] = fan_speed
+            pwm = heater.last_pwm_value
+            if heater.target_temp > 0. and now - heater.last_pwm_time > MAX_HEAT_TIME:
+                pwm = 0. # Klipper's MCU would have shut the heater off
+            plant.step(pwm, fan_speed)
+            if now + 1e-9 < self.next_report:
+                continue
+            spread = self.rng.uniform(-self.jitter, self.jitter) if self.jitter else 0.
+            self.next_report += self.report_time * (1. + spread)
+            temp = plant.read(self.rng)
+            if self.quantization:
+                temp = round(temp / self.quantization) * self.quantization
+            heater.smoothed_temp = temp
+            if target is not None:
+                heater.target_temp = target(now)
+            if heater.target_temp > 0.:
+                self.pwm_stale = max(self.pwm_stale, now - heater.last_pwm_time)
+            heater.control.temperature_update(now, temp, heater.target_temp)
+            if until is not None and until(now):
+                break
+        return self.time - start
+
+    def update(self, read_time, temp, target_temp, pwm):
+        # Monitors only run on control updates, count them
+        self.control_updates += 1
+
+
+def load_controller(control, config):
+    if control == 'pp_control':
+        from control_modules.pp_control import PPControl
+        return PPControl(config)
+    elif control == 'pid_control':
+        from control_modules.pid_control import PIDControl
+        return PIDControl(config)
+    elif control == 'mpc':
+        from control_modules.mpc_control import ControlMPC
+        return ControlMPC(config)
+    elif control == 'pipeline':
+        from control_modules.pipeline_control import PipelineControl
+        return PipelineControl(config)
+    raise SystemExit("thermal_sim: unsupported control '%s'" % (control,))
+
+
+# Named HeaterPlant parameters and a typical target
+PLANT_PRESETS = {
+    'hotend': (dict(heat_capacity=20., ambient_transfer=0.15, fan_transfer=0.1,
+                    heater_power=40., dead_time=1.5, sensor_responsiveness=0.5), 200.),
+    'hotend_fast': (dict(heat_capacity=10., ambient_transfer=0.12, fan_transfer=0.08,
+                         heater_power=60., dead_time=0.8, sensor_responsiveness=1.0), 220.),
+    'bed': (dict(heat_capacity=600., ambient_transfer=1.6, fan_transfer=0.2,
+                 heater_power=300., dead_time=6., sensor_responsiveness=0.1), 90.),
+}
+
+# Tuned for the default HeaterPlant
+DEFAULT_OPTIONS = {
+    'pid_control': {'pid_kp': 30., 'pid_ki': 1., 'pid_kd': 150.},
+    'pp_control': {'ss_map': [0.15 / 40.], 'ss_map_ambient': 25., 'tau': 133., 'dead_time': 3.5,
+                   'model_switching': True, 'pid_kp': 20., 'pid_ki': 0.5, 'pid_kd': 100.},
+    'mpc': {'heater_power': 40., 'block_heat_capacity': 20., 'ambient_transfer': 0.15,
+            'sensor_responsiveness': 0.2, 'fan_ambient_transfer': [0.15, 0.25], 'cooling_fan': 'fan'},
+    'pipeline': {'feedforward': 'steady_state, fan, extrusion', 'ss_map': [0.15 / 40.],
+                 'ss_map_ambient': 25., 'k_fan': 0.44, 'pid_kp': 20., 'pid_ki': 0.5, 'pid_kd': 100.},
+}
+
+
+def step_target(temp, start=5.):
+    return lambda now: temp if now >= start else 0.
+
+
+def check_decimation(args):
+    """Steady regulation with and without steady_update_interval"""
+    ok = True
+    for control in ('pid_control', 'pp_control'):
+        results = []
+        for interval in (0., 1.5):
+            options = dict(DEFAULT_OPTIONS[control], steady_update_interval=interval)
+            sim = Simulation(control, options, report_time=args.report_time, seed=args.seed)
+            sim.run(args.duration, step_target(args.target),
+                    fan=lambda now: 0.5 if now > args.duration * 0.6 else 0.)
+            results.append((interval, sim))
+        print("%s:" % (control,))
+        for interval, sim in results:
+            status = sim.kpis.get_status(0.)
+            current = status.get('current', {})
+            print("  steady_update_interval %.1f: %5d control updates, steady-state rms %s,"
+                  " overshoot %.2f, longest pwm refresh gap %.2fs"
+                  % (interval, sim.control_updates,
+                     "%.3f" % current['steady_state_rms'] if current.get('steady_state_rms') is not None else "n/a",
+                     current.get('overshoot', 0.), sim.pwm_stale))
+        full, decimated = results[0][1], results[1][1]
+        full_rms = full.kpis.get_status(0.)['current']['steady_state_rms'] or 0.
+        dec_rms = decimated.kpis.get_status(0.)['current']['steady_state_rms'] or 0.
+        if decimated.control_updates >= full.control_updates * 0.6:
+            print("  FAIL: decimation saved too few updates")
+            ok = False
+        if dec_rms > max(2. * full_rms, full_rms + 0.2):
+            print("  FAIL: steady-state error grew from %.3f to %.3f" % (full_rms, dec_rms))
+            ok = False
+        if decimated.pwm_stale >= MAX_HEAT_TIME:
+            print("  FAIL: pwm not refreshed within %.1fs" % (MAX_HEAT_TIME,))
+            ok = False
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+GC_MIN_BYTES = 40 # below the smallest object the garbage collector tracks (a 1-tuple, 48)
+
+
+class AllocationProbe:
+    """Heater control wrapper, traces the memory a controller's updates allocate
+
+    A tick allocates when the traced peak rises above the memory in use
+    before it (freed temporaries included) by more than the tracing itself
+    does, by at least GC_MIN_BYTES. Smaller rises are a float or int that
+    missed its free list; those are counted apart, they are not tracked by
+    the garbage collector and cannot cause collector pauses. Only updates for which measure(controller) is true are traced. The
+    probe stands in for the controller's heater during an update, Klipper's
+    heater allocates on its own and gets the pwm afterwards.
+    """
+    def __init__(self, controller, measure):
+        self.controller = controller
+        self.measure = measure
+        self.heater = controller.heater
+        self.pwm_time = self.pwm = 0.
+        self.ticks = self.allocating = self.untracked = self.worst = 0
+        self.overhead = 0
+
+    def set_pwm(self, read_time, value):
+        self.pwm_time = read_time
+        self.pwm = value
+
+    def _idle(self, read_time, temp, target_temp):
+        pass
+
+    def _traced(self, func, read_time, temp, target_temp):
+        tracemalloc.reset_peak()
+        start = tracemalloc.get_traced_memory()[0]
+        func(read_time, temp, target_temp)
+        return tracemalloc.get_traced_memory()[1] - start
+
+    def temperature_update(self, read_time, temp, target_temp):
+        controller = self.controller
+        if not self.measure(controller):
+            controller.control_update(read_time, temp, target_temp)
+            return
+        if not self.ticks:
+            self.overhead = max(self._traced(self._idle, read_time, temp, target_temp)
+                                for _ in range(10))
+        controller.heater = self
+        try:
+            grown = self._traced(controller.control_update, read_time, temp, target_temp)
+        finally:
+            controller.heater = self.heater
+        self.heater.set_pwm(self.pwm_time, self.pwm)
+        self.ticks += 1
+        grown -= self.overhead
+        if grown >= GC_MIN_BYTES:
+            self.allocating += 1
+            self.worst = max(self.worst, grown)
+        elif grown > 0:
+            self.untracked += 1
+
+
+def check_allocations(args):
+    """pp_control regulate updates (feed-forward learning, fan steps) allocate nothing"""
+    from control_modules.pp_control import REGULATE
+    options = dict(DEFAULT_OPTIONS['pp_control'], ff_learning=True)
+    sim = Simulation('pp_control', options, report_time=args.report_time, seed=args.seed)
+    sim.run(args.duration, step_target(args.target))
+    probe = AllocationProbe(sim.controller, lambda controller: controller.state == REGULATE)
+    sim.heater.set_control(probe)
+    tracemalloc.start()
+    try:
+        sim.run(300., fan=lambda now: 0.5 if int(now / 60.) % 2 else 0.)
+    finally:
+        tracemalloc.stop()
+    print("pp_control: %d regulate updates, %d allocated (largest %d bytes), "
+          "%d a single float/int" % (probe.ticks, probe.allocating, probe.worst, probe.untracked))
+    ok = probe.ticks > 0 and not probe.allocating
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+def run_filter(args, signal, spikes):
+    """Feed a TempFilter signal(time) with spikes at the given report indices
+
+    Returns the filter, the largest error of its output on clean readings and
+    the longest run of replaced readings.
+    """
+    from control_modules.signal_filter import TempFilter
+    config = SimConfig(SimPrinter(), 'ape_control extruder', {})
+    temp_filter = TempFilter(config, 2.)
+    rng = random.Random(args.seed)
+    worst = run = longest = 0.
+    for i in range(int(args.duration / args.report_time)):
+        now = i * args.report_time
+        true = signal(now)
+        reading = true + rng.gauss(0., 0.05)
+        if i in spikes:
+            reading += rng.choice((-1., 1.)) * rng.uniform(5., 40.)
+        value = temp_filter.update(now, reading)
+        run = run + 1 if value != reading else 0
+        longest = max(longest, run)
+        if i not in spikes and i > spikes_after(spikes, i):
+            worst = max(worst, abs(value - true))
+    return temp_filter, worst, longest
+
+
+def spikes_after(spikes, i):
+    """Index of the report after the last spike before i, -1 without one"""
+    before = [s for s in spikes if s < i]
+    return max(before) + 1 if before else -1
+
+
+def check_filter(args):
+    """TempFilter replaces single spikes and follows ramps"""
+    ok = True
+    rng = random.Random(args.seed)
+    reports = int(args.duration / args.report_time)
+    # Isolated single reading spikes, two in a row pass as a step with spike_window 3
+    spikes = set(3 * i for i in rng.sample(range(4, reports // 3), reports // 100))
+    temp_filter, worst, longest = run_filter(args, lambda now: 200., spikes)
+    print("steady, %d spikes: %d counted, largest error %.2f" % (len(spikes), temp_filter.spikes, worst))
+    if temp_filter.spikes != len(spikes) or worst > 1.:
+        print("  FAIL: spikes not rejected")
+        ok = False
+    for rate in (1., 5., 10.):
+        temp_filter, worst, longest = run_filter(
+            args, lambda now: 25. + max(0., now - 30.) * rate, set())
+        print("ramp %4.1f degC/s: %d replaced in a row, %d spikes counted, largest error %.2f"
+              % (rate, longest, temp_filter.spikes, worst))
+        if longest > temp_filter.window // 2 or temp_filter.spikes or worst > rate * args.report_time + 1.:
+            print("  FAIL: the ramp is clipped")
+            ok = False
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+def check_ident(args):
+    """mpc with wrong constants, perturbation identification corrects them"""
+    true_lag = 0.286 # sensor responsiveness with the plant's dead time lumped in
+    options = dict(DEFAULT_OPTIONS['mpc'], block_heat_capacity=26., sensor_responsiveness=0.4,
+                   ambient_transfer=0.195, fan_ambient_transfer=[0.195, 0.325],
+                   ambient_temp_sensor='temperature_sensor ambient', perturbation_ident=True)
+    objects = {'temperature_sensor ambient': SimAmbientSensor}
+    results = {}
+    for ident in (False, True):
+        sim = Simulation('mpc', dict(options, perturbation_ident=ident), objects=objects,
+                         report_time=args.report_time, seed=args.seed)
+        sim.run(4. * 3600., step_target(args.target))
+        results[ident] = sim
+    sim = results[True]
+    status = sim.controller.get_status(0.)
+    ident = status['ident']
+    print("mpc: %d periods identified" % (ident['periods'],))
+    ok = True
+    for name, attr, true_value, tolerance in (
+            ('block_heat_capacity', 'const_block_heat_capacity', 20., 0.15),
+            ('sensor_responsiveness', 'const_sensor_responsiveness', true_lag, 0.3),
+            ('ambient_transfer', 'const_ambient_transfer', 0.15, 0.1)):
+        applied = getattr(sim.controller, attr)
+        print("  %s: true %.3f, configured %.3f, estimate %s (rel std %s), applied %.3f"
+              % (name, true_value, options[name],
+                 "%.3f" % ident[name] if ident[name] is not None else "n/a",
+                 "%.3f" % ident[name + '_rel_std'] if ident[name + '_rel_std'] is not None else "n/a",
+                 applied))
+        if abs(applied - true_value) > tolerance * true_value:
+            print("  FAIL: %s not within %d%% of %.3f" % (name, tolerance * 100., true_value))
+            ok = False
+    rms = [results[i].kpis.get_status(0.)['current']['steady_state_rms'] or 0.
+           for i in (False, True)]
+    print("  steady-state rms %.3f without, %.3f with perturbation" % tuple(rms))
+    if rms[1] > max(2. * rms[0], rms[0] + 0.2):
+        print("  FAIL: the perturbation disturbs regulation")
+        ok = False
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--control', default='pp_control', choices=sorted(DEFAULT_OPTIONS))
+    parser.add_argument('--target', type=float, default=200.)
+    parser.add_argument('--duration', type=float, default=900.)
+    parser.add_argument('--report-time', type=float, default=0.3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--check-decimation', action='store_true',
+                        help="compare steady regulation with and without steady_update_interval")
+    parser.add_argument('--check-allocations', action='store_true',
+                        help="verify pp_control regulate updates allocate no memory")
+    parser.add_argument('--check-filter', action='store_true',
+                        help="verify spike rejection replaces spikes and follows ramps")
+    parser.add_argument('--check-ident', action='store_true',
+                        help="verify mpc perturbation identification corrects wrong constants")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.check_decimation:
+        sys.exit(check_decimation(args))
+    if args.check_allocations:
+        sys.exit(check_allocations(args))
+    if args.check_filter:
+        sys.exit(check_filter(args))
+    if args.check_ident:
+        sys.exit(check_ident(args))
+    sim = Simulation(args.control, DEFAULT_OPTIONS[args.control],
+                     report_time=args.report_time, seed=args.seed)
+    sim.run(args.duration, step_target(args.target))
+    print(sim.kpis.get_status(0.))
+
+
+if __name__ == '__main__':
+    main()